@@ -32,6 +32,7 @@ from io import open
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
 
 from .file_utils import cached_path, WEIGHTS_NAME, CONFIG_NAME
 
@@ -80,6 +81,8 @@ def load_tf_weights_in_bert(model, tf_checkpoint_path):
             print("Skipping {}".format("/".join(name)))
             continue
         pointer = model
+        # Index of query, key or value in the fused qkv projection
+        qkv_idx = None
         for m_name in name:
             if re.fullmatch(r'[A-Za-z]+_\d+', m_name):
                 l = re.split(r'_(\d+)', m_name)
@@ -93,6 +96,9 @@ def load_tf_weights_in_bert(model, tf_checkpoint_path):
                 pointer = getattr(pointer, 'weight')
             elif l[0] == 'squad':
                 pointer = getattr(pointer, 'classifier')
+            elif l[0] in QKV_NAMES and isinstance(pointer, BertSelfAttention):
+                qkv_idx = QKV_NAMES.index(l[0])
+                pointer = getattr(pointer, 'qkv')
             else:
                 try:
                     pointer = getattr(pointer, l[0])
@@ -106,13 +112,18 @@ def load_tf_weights_in_bert(model, tf_checkpoint_path):
             pointer = getattr(pointer, 'weight')
         elif m_name == 'kernel':
             array = np.transpose(array)
+        if qkv_idx is not None:
+            pointer = pointer.data.chunk(len(QKV_NAMES), dim=0)[qkv_idx]
         try:
             assert pointer.shape == array.shape
         except AssertionError as e:
             e.args += (pointer.shape, array.shape)
             raise
         print("Initialize PyTorch weight {}".format(name))
-        pointer.data = torch.from_numpy(array)
+        if qkv_idx is not None:
+            pointer.copy_(torch.from_numpy(array))
+        else:
+            pointer.data = torch.from_numpy(array)
     return model
 
 
@@ -244,6 +255,30 @@ class BertLayerNorm(nn.Module):
         x = (x - u) / torch.sqrt(s + self.variance_epsilon)
         return self.weight * x + self.bias
 
+def unpad_input(hidden_states, attention_mask):
+    """Removes the padding of a batch.
+    Params:
+        hidden_states: [batch_size, seq_length, hidden_size]
+        attention_mask: [batch_size, seq_length] with 1 for the tokens and 0 for the padding.
+    Returns: Tuple of (tokens, indices, cu_seqlens)
+        `tokens`: [num_tokens, hidden_size] tokens of all the sequences one after the other,
+        `indices`: [num_tokens] positions of the tokens in the flattened batch,
+        `cu_seqlens`: [batch_size + 1] cumulative sequence lengths, i.e. the tokens of
+            sequence i are tokens[cu_seqlens[i]:cu_seqlens[i + 1]].
+    """
+    seqlens = attention_mask.sum(dim=1).long()
+    indices = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
+    cu_seqlens = torch.cat([seqlens.new_zeros(1), torch.cumsum(seqlens, dim=0)])
+    return hidden_states.flatten(0, 1)[indices], indices, cu_seqlens
+
+
+def pad_input(tokens, indices, batch_size, seq_length):
+    """Inverse of unpad_input, with zeros at the padding positions."""
+    output = tokens.new_zeros(batch_size * seq_length, tokens.shape[-1])
+    output = output.index_copy(0, indices, tokens)
+    return output.view(batch_size, seq_length, -1)
+
+
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings.
     """
@@ -258,10 +293,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -275,6 +311,10 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+# Projections of the original BERT self attention, fused into BertSelfAttention.qkv
+QKV_NAMES = ['query', 'key', 'value']
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
         super(BertSelfAttention, self).__init__()
@@ -286,25 +326,75 @@ class BertSelfAttention(nn.Module):
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.key = nn.Linear(config.hidden_size, self.all_head_size)
-        self.value = nn.Linear(config.hidden_size, self.all_head_size)
+        # The query, key and value projections as one linear, see fuse_qkv_state_dict
+        self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
+        self._register_load_state_dict_pre_hook(self.fuse_qkv_state_dict)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # scaled_dot_product_attention, see attend
+        self.fused = hasattr(nn.functional, 'scaled_dot_product_attention')
+
+    def fuse_qkv_state_dict(self, state_dict, prefix, *args):
+        """Loads state dicts with separate query, key and value projections into qkv."""
+        for param_name in ['weight', 'bias']:
+            keys = [prefix + name + '.' + param_name for name in QKV_NAMES]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + 'qkv.' + param_name] = torch.cat(
+                    [state_dict.pop(key) for key in keys], dim=0)
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, attention_mask):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
+    def forward(self, hidden_states, attention_mask, cu_seqlens=None):
+        """
+        cu_seqlens: If given, hidden_states are the unpadded [num_tokens, hidden_size] tokens
+            of the batch (see unpad_input), and every sequence only attends to itself. A list
+            of ints, so that it's read from the device once per batch instead of per layer.
+        """
+        mixed_query_layer, mixed_key_layer, mixed_value_layer = self.project_qkv(hidden_states)
+        if cu_seqlens is not None:
+            return self.unpadded_attention(
+                mixed_query_layer, mixed_key_layer, mixed_value_layer, cu_seqlens)
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
+        context_layer = self.attend(query_layer, key_layer, value_layer, attention_mask)
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        context_layer = context_layer.view(*new_context_layer_shape)
+        return context_layer
+
+    def project_qkv(self, hidden_states):
+        """Query, key and value projections, as one matmul."""
+        return self.qkv(hidden_states).split(self.all_head_size, dim=-1)
+
+    def unpadded_attention(self, mixed_query_layer, mixed_key_layer, mixed_value_layer,
+                           cu_seqlens):
+        """Attention of every sequence over itself, with the sequence offsets in cu_seqlens."""
+        context_layers = []
+        for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+            # [num_heads, seq_length, head_size]
+            query_layer, key_layer, value_layer = [
+                layer[start:end].view(end - start, self.num_attention_heads,
+                                      self.attention_head_size).transpose(0, 1)
+                for layer in (mixed_query_layer, mixed_key_layer, mixed_value_layer)]
+            context_layer = self.attend(query_layer, key_layer, value_layer)
+            context_layers.append(
+                context_layer.transpose(0, 1).reshape(end - start, self.all_head_size))
+        return torch.cat(context_layers, dim=0)
+
+    def attend(self, query_layer, key_layer, value_layer, attention_mask=None):
+        # The fused kernel doesn't clamp the scores to [-10000, 10000]. That only matters when
+        # they overflow, which can happen in fp16 but not in the fp32 range of fp32 and bf16.
+        if self.fused and query_layer.dtype != torch.float16:
+            if attention_mask is not None:
+                attention_mask = attention_mask.to(dtype=query_layer.dtype)
+            return nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer, attn_mask=attention_mask,
+                dropout_p=(self.dropout.p if self.training else 0.0))
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
@@ -312,8 +402,9 @@ class BertSelfAttention(nn.Module):
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         # assert not torch.isnan(attention_scores).any()
         attention_scores = torch.clamp(attention_scores, -10000., 10000.)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
+        if attention_mask is not None:
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
         attention_probs = nn.Softmax(dim=-1)(attention_scores)
@@ -322,11 +413,7 @@ class BertSelfAttention(nn.Module):
         # seem a bit unusual, but is taken from the original Transformer paper.
         attention_probs = self.dropout(attention_probs)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
-        return context_layer
+        return torch.matmul(attention_probs, value_layer)
 
 
 class BertSelfOutput(nn.Module):
@@ -349,8 +436,8 @@ class BertAttention(nn.Module):
         self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, input_tensor, attention_mask):
-        self_output = self.self(input_tensor, attention_mask)
+    def forward(self, input_tensor, attention_mask, cu_seqlens=None):
+        self_output = self.self(input_tensor, attention_mask, cu_seqlens=cu_seqlens)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -391,8 +478,9 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def forward(self, hidden_states, attention_mask, cu_seqlens=None):
+        # The feed-forward blocks are per token, so they also run on unpadded tokens
+        attention_output = self.attention(hidden_states, attention_mask, cu_seqlens=cu_seqlens)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output
@@ -404,10 +492,19 @@ class BertEncoder(nn.Module):
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True,
+                num_layers=None, cu_seqlens=None, checkpoint_layers=0):
+        # num_layers: Only run the first num_layers layers
+        # cu_seqlens: Cumulative sequence lengths of unpadded hidden states (see unpad_input)
+        # checkpoint_layers: Recompute the activations of the first checkpoint_layers layers
+        #   in the backward pass
         all_encoder_layers = []
-        for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+        for layer_idx, layer_module in enumerate(self.layer[:num_layers]):
+            if layer_idx < checkpoint_layers and torch.is_grad_enabled():
+                hidden_states = checkpoint(layer_module, hidden_states, attention_mask,
+                                           cu_seqlens=cu_seqlens, use_reentrant=False)
+            else:
+                hidden_states = layer_module(hidden_states, attention_mask, cu_seqlens=cu_seqlens)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -673,6 +770,13 @@ class BertModel(BertPreTrainedModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `output_embedding`: boolean, if `True` (and `output_all_encoded_layers`) the embedding output is
+            the first entry of `encoded_layers`. Default: `False`.
+        `num_layers`: optional int, only the first `num_layers` attention blocks are run. Default: all.
+        `unpad`: boolean, if `True` the padding is removed after the embeddings, the attention of each
+            sequence is computed separately and the padding positions of the outputs are zeros. Default: `False`.
+        `checkpoint_layers`: int, the activations of the first `checkpoint_layers` attention blocks are
+            recomputed in the backward pass instead of stored. Default: 0.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -706,7 +810,8 @@ class BertModel(BertPreTrainedModel):
         # self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                output_embedding=False, num_layers=None, unpad=False, checkpoint_layers=0):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -728,9 +833,27 @@ class BertModel(BertPreTrainedModel):
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
         embedding_output = self.embeddings(input_ids, token_type_ids)
-        encoded_layers = self.encoder(embedding_output,
-                                      extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+        if unpad:
+            # Run the layers on just the tokens and restore the padding at the end
+            batch_size, seq_length = input_ids.shape
+            tokens, indices, cu_seqlens = unpad_input(embedding_output, attention_mask)
+            # The layers take the offsets as ints, synced from the device just once
+            cu_seqlens = cu_seqlens.tolist()
+            encoded_layers = self.encoder(tokens, None,
+                                          output_all_encoded_layers=output_all_encoded_layers,
+                                          num_layers=num_layers, cu_seqlens=cu_seqlens,
+                                          checkpoint_layers=checkpoint_layers)
+            encoded_layers = [pad_input(layer, indices, batch_size, seq_length)
+                              for layer in encoded_layers]
+        else:
+            encoded_layers = self.encoder(embedding_output,
+                                          extended_attention_mask,
+                                          output_all_encoded_layers=output_all_encoded_layers,
+                                          num_layers=num_layers,
+                                          checkpoint_layers=checkpoint_layers)
+        if output_embedding and output_all_encoded_layers:
+            # Embedding output as the 0th layer, without running the embeddings again
+            encoded_layers = [embedding_output] + encoded_layers
         # sequence_output = encoded_layers[-1]
         # pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -1220,3 +1343,64 @@ class BertForQuestionAnswering(BertPreTrainedModel):
             return total_loss
         else:
             return start_logits, end_logits
+
+
+if __name__ == '__main__':
+    # Parity of the fused attention with the reference math
+    def set_fused(model, fused):
+        for module in model.modules():
+            if isinstance(module, BertSelfAttention):
+                module.fused = fused
+
+    torch.manual_seed(0)
+    config = BertConfig(200, hidden_size=64, num_hidden_layers=3, num_attention_heads=4,
+                        intermediate_size=128, hidden_dropout_prob=0.0,
+                        attention_probs_dropout_prob=0.0)
+    model = BertModel(config)
+    input_ids = torch.randint(1, 200, (4, 20))
+    attention_mask = torch.ones_like(input_ids)
+    for idx, input_len in enumerate([20, 13, 7, 2]):
+        attention_mask[idx, input_len:] = 0
+        input_ids[idx, input_len:] = 0
+
+    for dtype, tolerance in [(torch.float32, 1e-5), (torch.bfloat16, 5e-2)]:
+        model.to(dtype=dtype)
+        for unpad in [False, True]:
+            outputs = []
+            for fused in [True, False]:
+                set_fused(model, fused)
+                output = model(input_ids, attention_mask=attention_mask,
+                               output_all_encoded_layers=False, unpad=unpad)
+                outputs.append(output[attention_mask.bool()].float())
+            max_diff = (outputs[0] - outputs[1]).abs().max().item()
+            print("%s unpad=%s: max abs difference %.2e" % (dtype, unpad, max_diff))
+            assert max_diff < tolerance
+
+    # Gradients of the weights
+    model.float().train()
+    grads = []
+    for fused in [True, False]:
+        set_fused(model, fused)
+        model.zero_grad()
+        output = model(input_ids, attention_mask=attention_mask, output_all_encoded_layers=False)
+        output[attention_mask.bool()].pow(2).sum().backward()
+        grads.append(torch.cat([param.grad.flatten() for param in model.parameters()
+                                if param.grad is not None]))
+    max_diff = ((grads[0] - grads[1]).abs().max() / grads[1].abs().max()).item()
+    print("Gradients: max relative difference %.2e" % max_diff)
+    assert max_diff < 1e-5
+
+    # State dicts with separate query, key and value projections load into qkv
+    set_fused(model, True)
+    model.eval()
+    state_dict = model.state_dict()
+    for key in [key for key in state_dict if '.qkv.' in key]:
+        prefix, param_name = key.rsplit('.qkv.', 1)
+        for name, param in zip(QKV_NAMES, state_dict.pop(key).chunk(len(QKV_NAMES), dim=0)):
+            state_dict['%s.%s.%s' % (prefix, name, param_name)] = param
+    unfused_model = BertModel(config).eval()
+    unfused_model.load_state_dict(state_dict)
+    assert torch.equal(unfused_model(input_ids, attention_mask=attention_mask,
+                                     output_all_encoded_layers=False)[0],
+                       model(input_ids, attention_mask=attention_mask,
+                             output_all_encoded_layers=False)[0])
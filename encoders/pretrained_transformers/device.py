@@ -0,0 +1,62 @@
+"""Device selection and CPU backend configuration.
+
+The encoder and the task models run on a single device: the model is moved there
+once and every batch is moved there once, before the encoder runs. On CPU hosts the
+intra-op (within an op) and inter-op (across independent ops) thread pools are
+sized explicitly, and the threads can be pinned to a fixed set of cores so that
+several inference processes on one host don't compete for the same cores.
+"""
+import os
+import logging
+
+import torch
+
+
+def get_device(device=None):
+    """
+    device: Name of the device, e.g. cpu, cuda or cuda:1.
+        Defaults to cuda if available else cpu.
+    """
+    if device is None:
+        device = ('cuda' if torch.cuda.is_available() else 'cpu')
+    return torch.device(device)
+
+
+def configure_cpu_backend(num_threads=None, num_interop_threads=None, pin_threads=False,
+                          first_core=0):
+    """
+    Configure the CPU thread pools. Should be called before any model is run, since the
+    inter-op pool can't be resized once it has been used.
+    num_threads: Number of intra-op threads. Defaults to the torch default (# of cores).
+    num_interop_threads: Number of inter-op threads.
+    pin_threads: Restrict the process to the cores first_core, ..., first_core +
+        num_threads - 1 (of the cores available to it) and bind the OpenMP threads to them.
+    """
+    if pin_threads:
+        cores = sorted(os.sched_getaffinity(0))
+        if num_threads is None:
+            num_threads = len(cores) - first_core
+        cores = cores[first_core: first_core + num_threads]
+        assert cores, "No cores left to pin the threads to"
+        # Only effective if OpenMP hasn't started its thread pool yet
+        os.environ.setdefault('OMP_PROC_BIND', 'close')
+        os.environ.setdefault('OMP_PLACES', 'cores')
+        os.sched_setaffinity(0, cores)
+        logging.info("Pinned threads to cores: %s" % cores)
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    logging.info("CPU backend: %d intra-op threads, %d inter-op threads"
+                 % (torch.get_num_threads(), torch.get_num_interop_threads()))
+
+
+def setup_device(device=None, num_threads=None, num_interop_threads=None,
+                 pin_threads=False):
+    """Returns the device, after configuring the CPU backend if it is the CPU."""
+    device = get_device(device)
+    if device.type == 'cpu':
+        configure_cpu_backend(num_threads=num_threads, num_interop_threads=num_interop_threads,
+                              pin_threads=pin_threads)
+    return device
@@ -1,26 +1,66 @@
+import atexit
 import torch
 import torch.nn as nn
 import logging
-from packaging import version
+from contextlib import nullcontext
+from torch.utils.checkpoint import checkpoint
 
-import transformers
 from transformers import BertModel, RobertaModel, XLNetModel
 from transformers import BertTokenizer, RobertaTokenizer, XLNetTokenizer
 
 from encoders.pretrained_transformers.SpanBERT import BertModel as SpanbertModel
+from encoders.pretrained_transformers.SpanBERT.modeling import unpad_input, pad_input
+from encoders.pretrained_transformers.feature_store import FeatureStore
+from encoders.pretrained_transformers.packing import Packing
+from encoders.pretrained_transformers.tokenization import CachedWordTokenizer
+from encoders.pretrained_transformers.windowing import get_windows, stitch_windows
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
 
 # Constants
 MODEL_LIST = ['bert', 'spanbert', 'roberta', 'xlnet']
 BERT_MODEL_SIZES = ['base', 'large']
+# Precision in which the pretrained model runs
+PRECISION_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+PRECISION_LIST = list(PRECISION_DTYPES)
 
 
 class Encoder(nn.Module):
     def __init__(self, model='bert', model_size='base', cased=True,
-                 fine_tune=False, use_proj=False, proj_dim=256):
+                 fine_tune=False, use_proj=False, proj_dim=256, stream_mix=False, dtype='fp32',
+                 window_size=None, window_stride=None, layers=None, unpad=False,
+                 pack_max_len=None, checkpoint_layers=0):
+        """
+        dtype: Precision of the pretrained model, one of PRECISION_LIST. When frozen its
+            weights are stored in this dtype, when fine tuned they stay in fp32 and the model
+            runs under autocast. The layer weights, projection and everything downstream
+            (span heads, losses) stay in fp32 in either case.
+        window_size: If set, sequences longer than this (in tokens, with special tokens) are
+            encoded in overlapping windows of this size and stitched back together.
+        window_stride: # of tokens between the starts of consecutive windows.
+            Defaults to half the window (without special tokens).
+        layers: Indices of the layers which are mixed (0th is the embedding layer). The model
+            only runs up to the last of them, which is also the output for just_last_layer.
+            Defaults to all the layers.
+        unpad: Run the layers of SpanBERT on just the tokens, without the padding.
+        pack_max_len: If set, the sequences of a batch are packed into rows of up to this many
+            tokens, see pack.
+        checkpoint_layers: # of transformer blocks, from the bottom, whose activations are
+            recomputed in the backward pass instead of kept (BERT variants only). Only the
+            output of a checkpointed block is kept, which the layer mix needs anyway.
+        """
         super(Encoder, self).__init__()
         assert(model in MODEL_LIST)
+        assert (dtype in PRECISION_LIST)
+        assert (not unpad or model == 'spanbert'), "Only the SpanBERT layers run unpadded"
+        assert (not checkpoint_layers or model != 'xlnet'), \
+            "Only the BERT variants support gradient checkpointing"
+        if pack_max_len is not None:
+            assert (model != 'xlnet'), "Only the BERT variants can be packed"
+            assert (window_size is None and not unpad), \
+                "Packing can't be combined with windowing or unpadding"
+        # fp16 gradients would need loss scaling, bf16 has the fp32 exponent range
+        assert (not (fine_tune and dtype == 'fp16')), "Use bf16 for reduced precision fine tuning"
 
         self.base_name = model
         self.model = None
@@ -28,6 +68,15 @@ class Encoder(nn.Module):
         self.num_layers = None
         self.hidden_size = None
         self.fine_tune = fine_tune
+        self.feature_store = None
+        # Accumulate the weighted avg of layers as the model runs (BERT variants only)
+        self.stream_mix = stream_mix
+        self.compute_dtype = PRECISION_DTYPES[dtype]
+        self.unpad = unpad
+        self.pack_max_len = pack_max_len
+        self.checkpoint_layers = checkpoint_layers
+        # Whether the linear layers of the pretrained model are dynamic int8 ones
+        self.quantized = False
 
         # First initialize the model and tokenizer
         model_name = ''
@@ -98,10 +147,23 @@ class Encoder(nn.Module):
             self.start_shift = (1 if self.tokenizer._cls_token else 0)
             self.end_shift = (1 if self.tokenizer._sep_token else 0)
 
+        # Sequences longer than window_size are encoded in overlapping windows
+        self.window_size = window_size
+        self.window_stride = window_stride
+        if window_size is not None and window_stride is None:
+            self.window_stride = max((window_size - self.start_shift - self.end_shift) // 2, 1)
+
+        # Word level tokenizer with a cache of the subword ids of words
+        self.word_tokenizer = CachedWordTokenizer(
+            self.tokenizer, self.start_shift, self.end_shift,
+            add_prefix_space=(self.base_name == 'roberta'))
+
         # Set requires_grad to False if not fine tuning
         if not fine_tune:
             for param in self.model.parameters():
                 param.requires_grad = False
+            # Frozen weights are only ever read, so just store them in reduced precision
+            self.model.to(dtype=self.compute_dtype)
 
         if use_proj:
             # Apply a projection layer to output of pretrained models
@@ -110,8 +172,81 @@ class Encoder(nn.Module):
             self.hidden_size = proj_dim
         else:
             self.proj = None
+        if layers is None:
+            layers = range(self.num_layers)
+        self.layers = sorted(set(layers))
+        assert (0 <= self.layers[0] and self.layers[-1] < self.num_layers)
         # Set parameters required on top of pre-trained models
-        self.weighing_params = nn.Parameter(torch.ones(self.num_layers))
+        self.weighing_params = nn.Parameter(torch.ones(len(self.layers)))
+
+    @property
+    def device(self):
+        """Device of the encoder. The inputs are moved here once and stay on it."""
+        return self.weighing_params.device
+
+    def autocast(self):
+        """Context in which the pretrained model runs."""
+        if self.fine_tune and self.compute_dtype != torch.float32:
+            return torch.autocast(self.device.type, dtype=self.compute_dtype)
+        return nullcontext()
+
+    def quantize(self):
+        """
+        Converts the linear layers of the frozen pretrained model to dynamic int8 ones, i.e.
+        int8 weights with the activations quantized on the fly. The embeddings, layer norms,
+        layer weights and projection stay in fp32. Quantized models only run on CPU.
+        """
+        assert (not self.fine_tune), "Only a frozen model can be quantized"
+        assert (self.compute_dtype == torch.float32), "Quantize the fp32 model"
+        if not self.quantized:
+            qconfig_spec = {nn.Linear: torch.quantization.default_dynamic_qconfig}
+            # The fused query/key/value projection of SpanBERT gets a scale per output
+            # channel, rather than one for all three
+            qconfig_spec.update({name: torch.quantization.per_channel_dynamic_qconfig
+                                 for name, _ in self.model.named_modules()
+                                 if name.endswith('.qkv')})
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, qconfig_spec, dtype=torch.qint8)
+            self.quantized = True
+
+    def save_quantized(self, path):
+        """Saves the quantized pretrained model, to be loaded with load_quantized."""
+        assert self.quantized
+        torch.save({'model_name': self.model_name, 'model': self.model.state_dict()}, path)
+
+    def load_quantized(self, path):
+        """Quantizes the pretrained model and loads the weights saved by save_quantized."""
+        checkpoint = torch.load(path, map_location='cpu')
+        assert (checkpoint['model_name'] == self.model_name)
+        self.quantize()
+        self.model.load_state_dict(checkpoint['model'])
+
+    def use_windows(self, batch_ids):
+        """Whether the batch has to be encoded in windows."""
+        return self.window_size is not None and batch_ids.shape[1] > self.window_size
+
+    def get_windows(self, batch_ids):
+        return get_windows(batch_ids, self.window_size, self.window_stride,
+                           start_shift=self.start_shift, end_shift=self.end_shift,
+                           pad_token_id=self.tokenizer.pad_token_id)
+
+    def pack(self, batch_ids):
+        """
+        Packs the sequences of a batch into rows of up to pack_max_len tokens.
+        batch_ids: B x L
+        Returns: The Packing to pass to forward, or None if packing is off. The output of
+            forward is then in packed coordinates, to which spans are moved with
+            Packing.remap.
+        """
+        if self.pack_max_len is None or self.feature_store is not None:
+            # The feature store has the hidden states of every sequence separately
+            return None
+        position_offset = 0
+        if self.base_name == 'roberta':
+            # RoBERTa positions start after its padding index
+            position_offset = self.tokenizer.pad_token_id + 1
+        return Packing(batch_ids, self.pack_max_len, pad_token_id=self.tokenizer.pad_token_id,
+                       position_offset=position_offset)
 
     def tokenize(self, sentence, get_subword_indices=False, force_split=False):
         """
@@ -125,7 +260,6 @@ class Encoder(nn.Module):
             if get_subword_indices is set to True.
         """
         tokenizer = self.tokenizer
-        subword_to_word_idx = []
 
         if not get_subword_indices:
             # Operate directly on a string
@@ -148,40 +282,25 @@ class Encoder(nn.Module):
                     # Basic tokenizer is not a part of Roberta
                     sentence = sentence.strip().split()
 
-            if self.base_name in ['bert', 'spanbert', 'xlnet']:
-                token_ids = []
-                for word_idx, word in enumerate(sentence):
-                    subword_list = tokenizer.tokenize(word)
-                    subword_ids = tokenizer.convert_tokens_to_ids(subword_list)
-
-                    subword_to_word_idx += [word_idx] * len(subword_ids)
-                    token_ids += subword_ids
-
-            elif self.base_name in ['roberta']:
-                token_ids = []
-                for word_idx, word in enumerate(sentence):
-                    subword_list = tokenizer.tokenize(word, add_prefix_space=True)
-                    subword_ids = tokenizer.convert_tokens_to_ids(subword_list)
-
-                    subword_to_word_idx += [word_idx] * len(subword_ids)
-                    token_ids += subword_ids
-            else:
+            if self.base_name not in ['bert', 'spanbert', 'xlnet', 'roberta']:
                 raise Exception("%s doesn't support getting word indices"
                                 % self.base_name)
 
-            # Add special tokens
-            if version.parse(transformers.__version__) > version.parse('2.0.0'):
-                # Long term API
-                final_token_ids = tokenizer.build_inputs_with_special_tokens(token_ids)
-            else:
-                # This API was in use when we started
-                final_token_ids = tokenizer.add_special_tokens_single_sequence(token_ids)
-
-            # Add -1 to denote the special symbols
-            subword_to_word_idx = (
-                [-1] * self.start_shift + subword_to_word_idx + [-1] * self.end_shift)
+            # Special tokens are denoted by -1 in the word indices
+            final_token_ids, word_offsets = self.word_tokenizer.tokenize_words(sentence)
+            subword_to_word_idx = self.word_tokenizer.get_subword_to_word_idx(
+                word_offsets, len(final_token_ids))
             return final_token_ids, subword_to_word_idx
 
+    def tokenize_words(self, words):
+        """
+        words: A pre-split sentence as a list of W words.
+
+        Returns: A list of the L token ids (with special tokens), and an int64 array of
+            size W + 1 where the subwords of word i are token_ids[o[i]:o[i + 1]].
+        """
+        return self.word_tokenizer.tokenize_words(words)
+
     def tokenize_sentence(self, sentence, get_subword_indices=False, force_split=False):
         """
         sentence: A single sentence where the sentence is either a string or list.
@@ -197,10 +316,10 @@ class Encoder(nn.Module):
             force_split=force_split
         )
         if get_subword_indices:
-            return (torch.tensor(output[0]).unsqueeze(dim=0).cuda(),
-                    torch.tensor(output[1]).unsqueeze(dim=0).cuda())
+            return (torch.tensor(output[0], device=self.device).unsqueeze(dim=0),
+                    torch.tensor(output[1], device=self.device).unsqueeze(dim=0))
         else:
-            return torch.tensor(output).unsqueeze(dim=0).cuda()
+            return torch.tensor(output, device=self.device).unsqueeze(dim=0)
 
     def tokenize_batch(self, list_of_sentences, get_subword_indices=False, force_split=False):
         """
@@ -246,56 +365,234 @@ class Encoder(nn.Module):
             ]
 
         # Tensorize the list
-        batch_token_ids = torch.tensor(all_token_ids).cuda()
-        batch_lens = torch.tensor(sentence_len_list).cuda()
+        batch_token_ids = torch.tensor(all_token_ids, device=self.device)
+        batch_lens = torch.tensor(sentence_len_list, device=self.device)
         if get_subword_indices:
             return (batch_token_ids, batch_lens,
                     torch.tensor(all_subword_to_word_idx))
         else:
             return (batch_token_ids, batch_lens)
 
-    def forward(self, batch_ids, just_last_layer=False):
+    def attach_feature_store(self, store_dir, dtype='float16'):
+        """
+        Serve the hidden states of the frozen pretrained model from an on-disk FeatureStore.
+        Sentences missing from the store are encoded once and added to it. The store is
+        closed, which persists the entries added since its last flush, at exit.
+        """
+        assert (not self.fine_tune), "Feature store can't be used when fine tuning"
+        num_layers = self.model.config.num_hidden_layers + 1
+        self.feature_store = FeatureStore(
+            store_dir, self.get_store_name(), num_layers, self.model.config.hidden_size,
+            dtype=dtype)
+        atexit.register(self.feature_store.close)
+
+    def get_store_name(self):
+        """Name of the feature store, with everything besides the model which sets the states."""
+        store_name = self.model_name
+        if self.compute_dtype != torch.float32:
+            # Reduced precision states are kept apart from the fp32 ones
+            precision = {value: key for key, value in PRECISION_DTYPES.items()}
+            store_name += '_' + precision[self.compute_dtype]
+        if self.window_size is not None:
+            # Stitched states of long sequences depend on the windows
+            store_name += '_w%d_s%d' % (self.window_size, self.window_stride)
+        return store_name
+
+    def run_layer(self, layer_idx, layer_module, *inputs, **kwargs):
+        """
+        Run the layer_idx-th transformer block. The activations of the first
+        checkpoint_layers blocks are recomputed in the backward pass.
+        """
+        if layer_idx < self.checkpoint_layers and torch.is_grad_enabled():
+            return checkpoint(layer_module, *inputs, use_reentrant=False, **kwargs)
+        return layer_module(*inputs, **kwargs)
+
+    def iter_layers(self, batch_ids, num_layers, packing=None):
+        """
+        Generator over the hidden states of the first num_layers layers of a BERT variant
+        (0th is the embedding layer), computed layer by layer. The embedding layer runs once,
+        and the model stops after the last requested layer.
+        batch_ids: B x L
+        packing: Packing of batch_ids, in which case the packed rows are encoded.
+        Yields: Tensors of size B x L x E (R x L' x E when packed) in the compute dtype.
+        """
+        mask_dtype = next(self.model.parameters()).dtype
+        embedding_kwargs = {}
+        if packing is not None:
+            batch_ids = packing.packed_ids
+            extended_attention_mask = packing.get_attention_mask(dtype=mask_dtype)
+            embedding_kwargs['position_ids'] = packing.position_ids
+        else:
+            input_mask = (batch_ids != self.tokenizer.pad_token_id).float()
+            # Same attention mask as the one computed inside BertModel
+            extended_attention_mask = input_mask[:, None, None, :].to(dtype=mask_dtype)
+            extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+
+        # The contexts are entered per layer since the caller runs in between
+        grad_enabled = self.fine_tune and torch.is_grad_enabled()
+        with torch.set_grad_enabled(grad_enabled), self.autocast():
+            hidden_states = self.model.embeddings(
+                batch_ids, token_type_ids=torch.zeros_like(batch_ids), **embedding_kwargs)
+        yield hidden_states
+
+        if self.unpad:
+            batch_size, max_len = batch_ids.shape
+            hidden_states, indices, cu_seqlens = unpad_input(hidden_states, input_mask)
+            # The layers take the offsets as ints, synced from the device just once
+            cu_seqlens = cu_seqlens.tolist()
+            for layer_idx, layer_module in enumerate(self.model.encoder.layer[:num_layers - 1]):
+                with torch.set_grad_enabled(grad_enabled), self.autocast():
+                    hidden_states = self.run_layer(layer_idx, layer_module, hidden_states, None,
+                                                   cu_seqlens=cu_seqlens)
+                yield pad_input(hidden_states, indices, batch_size, max_len)
+            return
+
+        for layer_idx, layer_module in enumerate(self.model.encoder.layer[:num_layers - 1]):
+            with torch.set_grad_enabled(grad_enabled), self.autocast():
+                hidden_states = self.run_layer(layer_idx, layer_module, hidden_states,
+                                               extended_attention_mask)
+                if isinstance(hidden_states, tuple):
+                    # HuggingFace layers return a tuple, SpanBERT layers a tensor
+                    hidden_states = hidden_states[0]
+            yield hidden_states
+
+    def encode_layers(self, batch_ids, layers=None, packing=None):
+        """
+        Run the pretrained model on a batch of token IDs.
+        batch_ids: B x L
+        layers: Indices of the layers to return (0th is the embedding layer).
+            Defaults to the layers of the encoder. The model only runs up to the last of them.
+        packing: Packing of batch_ids, in which case the outputs are in packed coordinates.
+        Returns: Output of the last of the layers of size B x L x E, and the list of tensors
+            of size B x L x E of the layers, in the compute dtype.
+        """
+        if layers is None:
+            layers = self.layers
+        if self.use_windows(batch_ids):
+            window_ids, gather_ids = self.get_windows(batch_ids)
+            last_layer_states, encoded_layers = self.encode_layers(window_ids, layers=layers)
+            return (stitch_windows(last_layer_states, gather_ids),
+                    [stitch_windows(layer_states, gather_ids) for layer_states in encoded_layers])
+
+        if self.base_name == 'xlnet':
+            input_mask = (batch_ids != self.tokenizer.pad_token_id).float()
+            with torch.set_grad_enabled(self.fine_tune and torch.is_grad_enabled()), \
+                    self.autocast():
+                # Encoded layers also has the embedding layer - 0th entry
+                _, _, all_layers = self.model(batch_ids, attention_mask=input_mask)
+            encoded_layers = [all_layers[layer] for layer in layers]
+        else:
+            encoded_layers = []
+            for layer, hidden_states in enumerate(
+                    self.iter_layers(batch_ids, max(layers) + 1, packing=packing)):
+                if layer in layers:
+                    encoded_layers.append(hidden_states)
+
+        return encoded_layers[-1], encoded_layers
+
+    def encode_into_store(self, list_of_token_ids):
+        """
+        Encode a list of (unpadded) token ID lists and add them to the feature store.
+        Returns: List of num_layers x L_i x E tensors read back from the store.
+        """
+        device = self.device
+        max_len = max([len(token_ids) for token_ids in list_of_token_ids])
+        batch_ids = torch.tensor(
+            [list(token_ids) + [self.tokenizer.pad_token_id] * (max_len - len(token_ids))
+             for token_ids in list_of_token_ids], device=device)
+
+        # The store has all the layers
+        _, encoded_layers = self.encode_layers(batch_ids, layers=range(self.num_layers))
+        encoded_layers = torch.stack(encoded_layers, dim=0)  # num_layers x B x L x E
+        for idx, token_ids in enumerate(list_of_token_ids):
+            self.feature_store.put(token_ids, encoded_layers[:, idx, :len(token_ids), :])
+
+        return [self.feature_store.get(token_ids) for token_ids in list_of_token_ids]
+
+    def get_stored_layers(self, batch_ids):
+        """
+        Same as encode_layers but reads the hidden states from the feature store.
+        Only the sentences missing from the store are run through the pretrained model.
+        """
+        batch_size, max_len = batch_ids.shape
+        input_lens = (batch_ids != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        list_of_token_ids = [batch_ids[idx, :input_lens[idx]].tolist()
+                             for idx in range(batch_size)]
+
+        states_list = [self.feature_store.get(token_ids) for token_ids in list_of_token_ids]
+        missing = [idx for idx, states in enumerate(states_list) if states is None]
+        if missing:
+            missing_states = self.encode_into_store(
+                [list_of_token_ids[idx] for idx in missing])
+            for idx, states in zip(missing, missing_states):
+                states_list[idx] = states
+
+        output = torch.zeros(len(states_list[0]), batch_size, max_len, states_list[0].shape[2],
+                             device=batch_ids.device)
+        for idx, states in enumerate(states_list):
+            output[:, idx, :input_lens[idx], :] = states.to(batch_ids.device)
+
+        return list(torch.unbind(output, dim=0))
+
+    def stream_mix_layers(self, batch_ids, packing=None):
+        """
+        Compute the (learned) wtd avg of layers layer by layer as the pretrained model runs.
+        Only a running sum is kept instead of all the hidden states. This reduces peak memory
+        when no gradients are computed, e.g. in eval, since otherwise autograd keeps every
+        layer around for the gradient of the layer weights anyway.
+        batch_ids: B x L
+        packing: Packing of batch_ids, in which case the output is in packed coordinates.
+        Returns: Wtd avg of layers of size B x L x E
+        """
+        if self.use_windows(batch_ids):
+            # Stitching commutes with the (per token) weighted avg
+            window_ids, gather_ids = self.get_windows(batch_ids)
+            return stitch_windows(self.stream_mix_layers(window_ids), gather_ids)
+
+        soft_weight = nn.functional.softmax(self.weighing_params, dim=0)
+        # The running sum is kept in fp32
+        wtd_encoded_repr = 0
+        layer_weights = dict(zip(self.layers, soft_weight))
+        for layer, hidden_states in enumerate(
+                self.iter_layers(batch_ids, self.layers[-1] + 1, packing=packing)):
+            if layer in layer_weights:
+                wtd_encoded_repr = wtd_encoded_repr + layer_weights[layer] * hidden_states.float()
+
+        return wtd_encoded_repr
+
+    def forward(self, batch_ids, just_last_layer=False, packing=None):
         """
         Encode a batch of token IDs.
         batch_ids: B x L
-        just_last_layer: If True return the last layer else return a (learned) wtd avg of layers.
+        just_last_layer: If True return the last of the layers else return a (learned)
+            wtd avg of the layers.
+        packing: Output of pack(batch_ids). If given, the output is R x L' x E for the packed
+            rows instead of B x L x E.
         """
-        input_mask = (batch_ids != self.tokenizer.pad_token_id).cuda().float()
-        if 'spanbert' in self.model_name:
-            # SpanBERT is based on old APIs
-            if not self.fine_tune:
-                # Get the embedding output separately
-                with torch.no_grad():
-                    embedding_output = self.model.embeddings(
-                        batch_ids, token_type_ids=torch.zeros_like(batch_ids))
-                    encoded_layers = self.model(batch_ids, attention_mask=input_mask)
+        if (self.stream_mix and (not just_last_layer) and self.feature_store is None
+                and self.base_name != 'xlnet'):
+            output = self.stream_mix_layers(batch_ids, packing=packing)
+            if self.proj:
+                return self.proj(output)
             else:
-                # Get the embedding output separately
-                embedding_output = self.model.embeddings(
-                    batch_ids, token_type_ids=torch.zeros_like(batch_ids))
-                encoded_layers = self.model(batch_ids, attention_mask=input_mask)
+                return output
 
-            # Add the embedding layer to the rest of the outputs
-            encoded_layers = [embedding_output] + encoded_layers
+        if self.feature_store is not None and not self.fine_tune:
+            stored_layers = self.get_stored_layers(batch_ids)
+            encoded_layers = [stored_layers[layer] for layer in self.layers]
             last_layer_states = encoded_layers[-1]
         else:
-            if not self.fine_tune:
-                with torch.no_grad():
-                    last_layer_states, _,  encoded_layers = self.model(
-                        batch_ids, attention_mask=input_mask)  # B x L x E
-            else:
-                last_layer_states, _,  encoded_layers = self.model(
-                    batch_ids, attention_mask=input_mask)  # B x L x E
-            # # Encoded layers also has the embedding layer - 0th entry
+            last_layer_states, encoded_layers = self.encode_layers(batch_ids, packing=packing)
 
+        # The pretrained model may run in reduced precision, the rest is in fp32
         if just_last_layer:
-            output = last_layer_states
+            output = last_layer_states.float()
         else:
             wtd_encoded_repr = 0
             soft_weight = nn.functional.softmax(self.weighing_params, dim=0)
 
-            for i in range(self.num_layers):
-                wtd_encoded_repr += soft_weight[i] * encoded_layers[i]
+            for i in range(len(self.layers)):
+                wtd_encoded_repr += soft_weight[i] * encoded_layers[i].float()
 
             output = wtd_encoded_repr
 
@@ -306,7 +603,9 @@ class Encoder(nn.Module):
 
 
 if __name__ == '__main__':
-    model = Encoder(model='spanbert', model_size='base', use_proj=False).cuda()
+    from encoders.pretrained_transformers.device import get_device
+
+    model = Encoder(model='spanbert', model_size='base', use_proj=False).to(get_device())
     tokenized_input, input_lengths = model.tokenize_batch(
         ["Hello beautiful world!", "Chomsky says hello."], get_subword_indices=False)
     output = model(tokenized_input)
@@ -0,0 +1,222 @@
+"""Persistent on-disk store of the hidden states of a frozen encoder.
+
+The states of all layers (num_layers x L x H) of every sentence are appended to a
+single flat binary file and indexed by a content hash of (model_name, token ids).
+Reads are zero-copy torch views of a memory-mapped numpy array, so once the store
+is populated the probing models can be trained without running the transformer.
+
+Several jobs can share a store: appends and index rewrites hold an exclusive lock on
+a lock file next to the store, entries are appended at the current end of the data
+file, and the index on disk is merged into the index of the process before it's
+rewritten. Data appended by a job which dies before its index flush is never indexed
+and just takes up space.
+
+Precompute the store for a set of JSONL files (with a "text" field) via:
+    python -m encoders.pretrained_transformers.feature_store -model bert \
+        -model_size base -store_dir <dir> -data_files train.json dev.json
+"""
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import argparse
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+STORE_DTYPES = ['float16', 'float32']
+# Number of new entries after which the index is rewritten
+FLUSH_EVERY = 1000
+
+
+class FeatureStore(object):
+    def __init__(self, store_dir, model_name, num_layers, hidden_size, dtype='float16'):
+        """
+        store_dir: Directory holding the data and index files.
+        model_name: Name of the encoder, e.g. bert-base-cased. Part of the key of every entry.
+        num_layers: Number of hidden layers (including the embedding layer).
+        hidden_size: Hidden size of the encoder.
+        dtype: Storage dtype. float16 halves the disk footprint.
+        """
+        assert (dtype in STORE_DTYPES)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.model_name = model_name
+        self.num_layers = num_layers
+        self.hidden_size = hidden_size
+        self.dtype = np.dtype(dtype)
+
+        self.data_path = os.path.join(store_dir, model_name + '.' + dtype + '.bin')
+        self.index_path = os.path.join(store_dir, model_name + '.' + dtype + '.index.json')
+        self.lock_path = os.path.join(store_dir, model_name + '.' + dtype + '.lock')
+
+        with self.locked():
+            # Key -> (offset, length) where offset is in number of elements
+            self.index = self.read_index()
+            open(self.data_path, 'ab').close()
+
+        self.writer = None
+        self.mmap = None
+        self.num_unflushed = 0
+
+    @contextmanager
+    def locked(self):
+        """Exclusive lock on the store, shared by all the processes using it."""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self):
+        """Index on disk. Must hold the lock."""
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            index_info = json.load(f)
+        assert (index_info['num_layers'] == self.num_layers)
+        assert (index_info['hidden_size'] == self.hidden_size)
+        return {key: tuple(entry) for key, entry in index_info['index'].items()}
+
+    def get_key(self, token_ids):
+        """Content hash of the model name and the token ids of a sentence."""
+        hasher = hashlib.sha1(self.model_name.encode('utf-8'))
+        hasher.update(np.asarray(token_ids, dtype=np.int64).tobytes())
+        return hasher.hexdigest()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, token_ids):
+        return self.get_key(token_ids) in self.index
+
+    def get(self, token_ids):
+        """
+        Returns the hidden states of the sentence as a num_layers x L x H tensor
+        (a view of the memory-mapped file), or None if the sentence is not in the store.
+        """
+        entry = self.index.get(self.get_key(token_ids), None)
+        if entry is None:
+            return None
+        offset, length = entry
+        size = self.num_layers * length * self.hidden_size
+        if self.mmap is None or offset + size > self.mmap.shape[0]:
+            self._remap()
+
+        states = self.mmap[offset: offset + size]
+        return torch.from_numpy(states).view(self.num_layers, length, self.hidden_size)
+
+    def put(self, token_ids, states):
+        """
+        Append the hidden states of a sentence to the store.
+        states: num_layers x L x H tensor
+        """
+        key = self.get_key(token_ids)
+        if key in self.index:
+            return
+        num_layers, length, hidden_size = states.shape
+        assert (num_layers == self.num_layers and hidden_size == self.hidden_size)
+
+        if self.writer is None:
+            self.writer = open(self.data_path, 'ab')
+        array = states.detach().cpu().float().numpy().astype(self.dtype)
+        with self.locked():
+            # Append after the entries of all the processes, at an element boundary even
+            # after a partial write of a dead process
+            num_bytes = os.fstat(self.writer.fileno()).st_size
+            offset = -(-num_bytes // self.dtype.itemsize)
+            self.writer.truncate(offset * self.dtype.itemsize)
+            self.writer.write(array.tobytes())
+            self.writer.flush()
+        self.index[key] = (offset, length)
+
+        self.num_unflushed += 1
+        if self.num_unflushed >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Flush the data file and atomically rewrite the index, merged with the one on disk."""
+        if self.writer is not None:
+            self.writer.flush()
+        with self.locked():
+            # Entries added by other processes since this one read the index
+            disk_index = self.read_index()
+            disk_index.update(self.index)
+            self.index = disk_index
+            index_info = {'model_name': self.model_name, 'num_layers': self.num_layers,
+                          'hidden_size': self.hidden_size, 'index': self.index}
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index_info, f)
+            os.replace(tmp_path, self.index_path)
+        self.num_unflushed = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.mmap = None
+
+    def _remap(self):
+        if self.writer is not None:
+            self.writer.flush()
+        # Other processes may have appended since the last remap
+        num_elements = os.path.getsize(self.data_path) // self.dtype.itemsize
+        # Copy-on-write mode gives writable arrays (required by torch.from_numpy)
+        # without ever modifying the file.
+        self.mmap = np.memmap(self.data_path, dtype=self.dtype, mode='c',
+                              shape=(num_elements,))
+
+
+def precompute(encoder, store, data_files, batch_size=32):
+    """Encode all sentences in the JSONL data files and add them to the store."""
+    sentences = set()
+    for data_file in data_files:
+        with open(data_file) as f:
+            for line in f:
+                instance = json.loads(line)
+                token_ids = encoder.tokenize(instance["text"].split(),
+                                             get_subword_indices=True)[0]
+                sentences.add(tuple(token_ids))
+
+    # Sort by length to minimize padding
+    sentences = sorted((token_ids for token_ids in sentences if token_ids not in store),
+                       key=lambda token_ids: (len(token_ids), token_ids))
+    logging.info("Encoding %d sentences" % len(sentences))
+    for i in range(0, len(sentences), batch_size):
+        encoder.encode_into_store(list(sentences[i: i + batch_size]))
+        if (i // batch_size) % 100 == 0:
+            logging.info("Encoded %d sentences" % min(i + batch_size, len(sentences)))
+    store.close()
+    logging.info("Store size: %d sentences" % len(store))
+
+
+if __name__ == '__main__':
+    from encoders.pretrained_transformers import Encoder
+    from encoders.pretrained_transformers.encoder import PRECISION_LIST
+    from encoders.pretrained_transformers.device import setup_device
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-model", type=str, default="bert")
+    parser.add_argument("-model_size", type=str, default="base")
+    parser.add_argument("-uncased", default=False, action="store_true")
+    parser.add_argument("-store_dir", type=str, required=True)
+    parser.add_argument("-store_dtype", type=str, default="float16", choices=STORE_DTYPES)
+    parser.add_argument("-data_files", type=str, nargs='+', required=True)
+    parser.add_argument("-batch_size", type=int, default=32)
+    parser.add_argument("-dtype", type=str, default="fp32", choices=PRECISION_LIST,
+                        help="Precision of the pretrained model.")
+    parser.add_argument("-device", type=str, default=None,
+                        help="Device to run on, e.g. cpu or cuda. Defaults to cuda if available.")
+    args = parser.parse_args()
+
+    encoder = Encoder(model=args.model, model_size=args.model_size, cased=not args.uncased,
+                      dtype=args.dtype)
+    encoder = encoder.to(setup_device(args.device))
+    encoder.attach_feature_store(args.store_dir, dtype=args.store_dtype)
+    precompute(encoder, encoder.feature_store, args.data_files, batch_size=args.batch_size)
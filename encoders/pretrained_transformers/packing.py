@@ -0,0 +1,119 @@
+"""Packing of several short sequences into one row of the batch.
+
+The sequences of a batch (each with its own special tokens) are concatenated into rows of
+at most max_len tokens. Every token only attends to the tokens of its own sequence (a
+block-diagonal attention mask) and the position ids restart at every sequence, so the
+hidden states are the same as when the sequences are encoded separately. The hidden
+states come out in packed coordinates: the spans of sequence i are shifted by its offset
+in its row, after which every span module works unchanged.
+"""
+import torch
+
+
+def get_packed_rows(input_lens, max_len):
+    """
+    First fit decreasing packing of the sequences into rows of at most max_len tokens.
+    A sequence longer than max_len gets a row of its own.
+    Returns: (rows, offsets) with the row of every sequence and its offset in the row.
+    """
+    rows = [0] * len(input_lens)
+    offsets = [0] * len(input_lens)
+    row_lens = []
+    for idx in sorted(range(len(input_lens)), key=lambda idx: -input_lens[idx]):
+        for row, row_len in enumerate(row_lens):
+            if row_len + input_lens[idx] <= max_len:
+                break
+        else:
+            row = len(row_lens)
+            row_lens.append(0)
+        rows[idx], offsets[idx] = row, row_lens[row]
+        row_lens[row] += input_lens[idx]
+    return rows, offsets
+
+
+class Packing(object):
+    def __init__(self, batch_ids, max_len, pad_token_id=0, position_offset=0):
+        """
+        batch_ids: B x L padded token ids.
+        max_len: Max # of tokens of a packed row.
+        position_offset: Position id of the first token of a sequence, e.g. RoBERTa
+            positions start after its padding index.
+        """
+        batch_size, seq_len = batch_ids.shape
+        device = batch_ids.device
+        input_lens = (batch_ids != pad_token_id).sum(dim=1).tolist()
+        rows, offsets = get_packed_rows(input_lens, max_len)
+        num_rows = max(rows) + 1
+        packed_len = max([offset + input_len for offset, input_len in zip(offsets, input_lens)])
+
+        # Row and column in the packed rows of every (unpadded) token of the batch
+        positions = torch.arange(seq_len, device=device).unsqueeze(0).expand(batch_size, -1)
+        token_mask = positions < torch.tensor(input_lens, device=device).unsqueeze(1)
+        self.rows = torch.tensor(rows, device=device)
+        self.offsets = torch.tensor(offsets, device=device)
+        token_rows = self.rows.unsqueeze(1).expand(-1, seq_len)[token_mask]
+        token_cols = (positions + self.offsets.unsqueeze(1))[token_mask]
+
+        self.packed_ids = torch.full((num_rows, packed_len), pad_token_id,
+                                     dtype=batch_ids.dtype, device=device)
+        self.packed_ids[token_rows, token_cols] = batch_ids[token_mask]
+        self.position_ids = torch.full((num_rows, packed_len), position_offset,
+                                       dtype=torch.long, device=device)
+        self.position_ids[token_rows, token_cols] = positions[token_mask] + position_offset
+        # Index of the sequence of every packed token, -1 for padding
+        self.segment_ids = torch.full((num_rows, packed_len), -1, dtype=torch.long,
+                                      device=device)
+        self.segment_ids[token_rows, token_cols] = torch.arange(
+            batch_size, device=device).unsqueeze(1).expand(-1, seq_len)[token_mask]
+
+        self.token_mask = token_mask
+        self.token_rows = token_rows
+        self.token_cols = token_cols
+
+    def get_attention_mask(self, dtype=torch.float32):
+        """
+        Returns: R x 1 x L x L additive mask which lets every token attend to the tokens of
+            its own sequence only.
+        """
+        same_sequence = ((self.segment_ids.unsqueeze(2) == self.segment_ids.unsqueeze(1))
+                         & (self.segment_ids.unsqueeze(1) >= 0))
+        return (1.0 - same_sequence.unsqueeze(1).to(dtype=dtype)) * -10000.0
+
+    def remap(self, span_indices, sent_ids=None):
+        """
+        span_indices: N x K token indices, e.g. the start and end of N spans.
+        sent_ids: Sequence of every span. Defaults to span i belonging to sequence i.
+        Returns: (span_indices, sent_ids) in packed coordinates, i.e. the indices in and
+            the rows of the packed hidden states.
+        """
+        if sent_ids is None:
+            sent_ids = torch.arange(span_indices.shape[0], device=span_indices.device)
+        return span_indices + self.offsets[sent_ids].unsqueeze(1), self.rows[sent_ids]
+
+    def unpack(self, packed_states):
+        """
+        packed_states: R x L' x E hidden states of the packed rows.
+        Returns: B x L x E hidden states of the sequences, zero for padding.
+        """
+        batch_size, seq_len = self.token_mask.shape
+        states = packed_states.new_zeros((batch_size, seq_len, packed_states.shape[2]))
+        states[self.token_mask] = packed_states[self.token_rows, self.token_cols]
+        return states
+
+
+if __name__ == '__main__':
+    # Unpacking the packed token ids gives back the original sequences
+    batch_ids = torch.tensor([[101] + list(range(1, 31)) + [102],
+                              [101] + list(range(1, 8)) + [102] + [0] * 23,
+                              [101, 5, 102] + [0] * 29,
+                              [101] + list(range(1, 12)) + [102] + [0] * 19])
+    for max_len in [16, 32, 64]:
+        packing = Packing(batch_ids, max_len)
+        unpacked_ids = packing.unpack(packing.packed_ids.unsqueeze(2)).squeeze(2)
+        assert torch.equal(unpacked_ids, batch_ids)
+        assert packing.packed_ids.shape[1] <= max(max_len, batch_ids.shape[1])
+        spans, sent_ids = torch.tensor([[1, 2], [3, 5], [1, 1]]), torch.tensor([0, 1, 3])
+        packed_spans, rows = packing.remap(spans, sent_ids)
+        assert torch.equal(packing.packed_ids[rows.unsqueeze(1), packed_spans],
+                           batch_ids[sent_ids.unsqueeze(1), spans])
+        print(max_len, tuple(packing.packed_ids.shape))
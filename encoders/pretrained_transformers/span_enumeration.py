@@ -0,0 +1,129 @@
+"""Representations of all the spans (up to a max width) of a batch of encoded sentences.
+
+Spans are enumerated width by width. The avg, max and attention based poolings keep a
+running accumulator over the start positions which is extended by one token per width
+(running sum, running max and an online softmax respectively), so each width costs
+O(B x L x H) irrespective of the width. The endpoint based methods just gather.
+"""
+import torch
+
+from encoders.pretrained_transformers.span_reprs import AvgSpanRepr, MaxSpanRepr, AttnSpanRepr
+
+
+def get_valid_starts(input_lens, num_starts, width, start_shift=1, end_shift=1):
+    """
+    Returns the (B x num_starts) mask of the start positions of width-sized spans which
+    lie within the tokens of the sentence, i.e. exclude the special tokens and padding.
+    input_lens: Tensor of size (B,) with the # of tokens (including special tokens).
+    """
+    start_ids = torch.arange(num_starts, device=input_lens.device).unsqueeze(0)
+    end_ids = start_ids + width - 1
+    return (start_ids >= start_shift) & (end_ids < (input_lens - end_shift).unsqueeze(1))
+
+
+def iter_all_span_reprs(span_module, encoded_input, input_lens, max_width,
+                        start_shift=1, end_shift=1):
+    """
+    Generator over the representations of all spans of up to max_width tokens. One chunk is
+    yielded per width, so memory stays bounded by the spans of a single width.
+    span_module: Instance of a span_reprs.SpanRepr class.
+    encoded_input: B x L x H
+    input_lens: Tensor of size (B,) with the # of tokens (including special tokens).
+    start_shift, end_shift: # of special tokens at the start/end of every sentence.
+
+    Yields: (sent_ids, start_ids, end_ids, span_reprs) where the first three are tensors
+        of size (N,) with the sentence index and the (inclusive) span endpoints, and
+        span_reprs is N x span_module.get_output_dim().
+    """
+    max_len = encoded_input.shape[1]
+    if isinstance(span_module, (AvgSpanRepr, MaxSpanRepr, AttnSpanRepr)):
+        if span_module.use_proj:
+            encoded_input = span_module.proj(encoded_input)
+        if isinstance(span_module, AttnSpanRepr):
+            attn_logits = span_module.attention_params(encoded_input)
+
+    running_repr = None
+    for width in range(1, min(max_width, max_len) + 1):
+        num_starts = max_len - width + 1
+        # Tokens which extend the width - 1 spans to width
+        new_tokens = encoded_input[:, width - 1:, :]
+
+        if isinstance(span_module, AvgSpanRepr):
+            if width == 1:
+                running_repr = new_tokens
+            else:
+                running_repr = running_repr[:, :num_starts, :] + new_tokens
+            width_repr = running_repr / width
+        elif isinstance(span_module, MaxSpanRepr):
+            if width == 1:
+                running_repr = new_tokens
+            else:
+                running_repr = torch.max(running_repr[:, :num_starts, :], new_tokens)
+            width_repr = running_repr
+        elif isinstance(span_module, AttnSpanRepr):
+            # Online softmax: running max logit, sum of exponents, and weighted sum
+            new_logits = attn_logits[:, width - 1:, :]
+            if width == 1:
+                running_repr = (new_logits, torch.ones_like(new_logits), new_tokens)
+            else:
+                max_logits, exp_sum, wtd_sum = [
+                    term[:, :num_starts, :] for term in running_repr]
+                updated_max_logits = torch.max(max_logits, new_logits)
+                old_scale = torch.exp(max_logits - updated_max_logits)
+                new_scale = torch.exp(new_logits - updated_max_logits)
+                running_repr = (updated_max_logits,
+                                exp_sum * old_scale + new_scale,
+                                wtd_sum * old_scale + new_tokens * new_scale)
+            width_repr = running_repr[2] / running_repr[1]
+        else:
+            width_repr = None
+
+        valid_starts = get_valid_starts(input_lens, num_starts, width,
+                                        start_shift=start_shift, end_shift=end_shift)
+        sent_ids, start_ids = torch.nonzero(valid_starts, as_tuple=True)
+        end_ids = start_ids + width - 1
+        if sent_ids.shape[0] == 0:
+            continue
+
+        if width_repr is None:
+            span_reprs = span_module(encoded_input, start_ids, end_ids, sent_ids=sent_ids)
+        else:
+            span_reprs = width_repr[sent_ids, start_ids, :]
+            if isinstance(span_module, AttnSpanRepr) and span_module.use_endpoints:
+                span_reprs = torch.cat([encoded_input[sent_ids, start_ids, :],
+                                        encoded_input[sent_ids, end_ids, :],
+                                        span_reprs], dim=1)
+
+        yield sent_ids, start_ids, end_ids, span_reprs
+
+
+def get_all_span_reprs(span_module, encoded_input, input_lens, max_width,
+                       start_shift=1, end_shift=1):
+    """
+    Same as iter_all_span_reprs but returns all the spans at once.
+    Returns: (sent_ids, start_ids, end_ids, span_reprs) with spans ordered by width.
+    """
+    chunks = list(iter_all_span_reprs(
+        span_module, encoded_input, input_lens, max_width,
+        start_shift=start_shift, end_shift=end_shift))
+    if not chunks:
+        empty_ids = torch.zeros(0, dtype=torch.long, device=encoded_input.device)
+        return (empty_ids, empty_ids, empty_ids,
+                encoded_input.new_zeros(0, span_module.get_output_dim()))
+    return tuple(torch.cat(outputs, dim=0) for outputs in zip(*chunks))
+
+
+if __name__ == '__main__':
+    from encoders.pretrained_transformers.span_reprs import get_span_module
+
+    # Check against the span modules applied to the enumerated spans
+    encoded_input = torch.randn(3, 20, 64)
+    input_lens = torch.tensor([20, 12, 5])
+    for method in ["avg", "max", "attn", "coref", "diff", "endpoint"]:
+        span_module = get_span_module(64, method=method, use_proj=True, proj_dim=32)
+        with torch.no_grad():
+            sent_ids, start_ids, end_ids, span_reprs = get_all_span_reprs(
+                span_module, encoded_input, input_lens, max_width=8)
+            ref_reprs = span_module(encoded_input, start_ids, end_ids, sent_ids=sent_ids)
+        print(method, span_reprs.shape[0],
+              torch.max(torch.abs(span_reprs - ref_reprs)).item())
@@ -1,7 +1,7 @@
 """Different batched non-parametric span representations."""
 import torch
 import torch.nn as nn
-from encoders.pretrained_transformers.utils import get_span_mask
+from encoders.pretrained_transformers.utils import get_span_mask, get_span_token_ids
 from abc import ABC, abstractmethod
 
 
@@ -17,9 +17,20 @@ class SpanRepr(ABC, nn.Module):
             self.proj = nn.Linear(input_dim, proj_dim)
 
     @abstractmethod
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
+        """encoded_input: B x L x H
+        start_ids, end_ids: Tensors of size (N,) with the (inclusive) span endpoints.
+        sent_ids: Tensor of size (N,) with the row of encoded_input each span belongs to.
+            When None, span i is taken from row i (which requires N == B).
+        """
         raise NotImplementedError
 
+    @staticmethod
+    def get_sent_ids(start_ids, sent_ids=None):
+        if sent_ids is None:
+            sent_ids = torch.arange(start_ids.shape[0], device=start_ids.device)
+        return sent_ids
+
     def get_input_dim(self):
         return self.input_dim
 
@@ -31,9 +42,11 @@ class SpanRepr(ABC, nn.Module):
 class AvgSpanRepr(SpanRepr, nn.Module):
     """Class implementing the avg span representation."""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
+        if sent_ids is not None:
+            encoded_input = encoded_input[sent_ids]
         span_lengths = (end_ids - start_ids + 1).unsqueeze(1)
         span_masks = get_span_mask(start_ids, end_ids, encoded_input.shape[1])
         span_repr = torch.sum(encoded_input * span_masks, dim=1) / span_lengths.float()
@@ -49,17 +62,17 @@ class AvgSpanRepr(SpanRepr, nn.Module):
 class DiffSpanRepr(SpanRepr, nn.Module):
     """Class implementing the diff span representation - [h_j - h_{i-1}]"""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
-        batch_size = encoded_input.shape[0]
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
         # first_comp = (encoded_input[torch.arange(batch_size), end_ids, :]
         #               - encoded_input[torch.arange(batch_size), start_ids - 1, :])
         # second_comp = (encoded_input[torch.arange(batch_size), start_ids, :]
         #                - encoded_input[torch.arange(batch_size), end_ids + 1, :])
         # span_repr = torch.cat([first_comp, second_comp], dim=1)
-        span_repr = (encoded_input[torch.arange(batch_size), end_ids, :]
-                     - encoded_input[torch.arange(batch_size), start_ids - 1, :])
+        span_repr = (encoded_input[sent_ids, end_ids, :]
+                     - encoded_input[sent_ids, start_ids - 1, :])
         return span_repr
 
     def get_output_dim(self):
@@ -72,12 +85,12 @@ class DiffSpanRepr(SpanRepr, nn.Module):
 class EndPointRepr(SpanRepr, nn.Module):
     """Class implementing the diff span representation - [h_j; h_i]"""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
-        batch_size = encoded_input.shape[0]
-        span_repr = torch.cat([encoded_input[torch.arange(batch_size), start_ids, :],
-                               encoded_input[torch.arange(batch_size), end_ids, :]], dim=1)
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
+        span_repr = torch.cat([encoded_input[sent_ids, start_ids, :],
+                               encoded_input[sent_ids, end_ids, :]], dim=1)
         return span_repr
 
     def get_output_dim(self):
@@ -90,15 +103,15 @@ class EndPointRepr(SpanRepr, nn.Module):
 class DiffSumSpanRepr(SpanRepr, nn.Module):
     """Class implementing the diff_sum span representation - [h_j - h_i; h_j + h_i]"""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
-        batch_size = encoded_input.shape[0]
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
         span_repr = torch.cat([
-            encoded_input[torch.arange(batch_size), end_ids, :]
-            - encoded_input[torch.arange(batch_size), start_ids, :],
-            encoded_input[torch.arange(batch_size), end_ids, :]
-            + encoded_input[torch.arange(batch_size), start_ids, :]
+            encoded_input[sent_ids, end_ids, :]
+            - encoded_input[sent_ids, start_ids, :],
+            encoded_input[sent_ids, end_ids, :]
+            + encoded_input[sent_ids, start_ids, :]
             ], dim=1)
         return span_repr
 
@@ -112,9 +125,11 @@ class DiffSumSpanRepr(SpanRepr, nn.Module):
 class MaxSpanRepr(SpanRepr, nn.Module):
     """Class implementing the max-pool span representation."""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
+        if sent_ids is not None:
+            encoded_input = encoded_input[sent_ids]
         span_masks = get_span_mask(start_ids, end_ids, encoded_input.shape[1])
         # put -inf to irrelevant positions
         tmp_repr = encoded_input * span_masks - 1e10 * (1 - span_masks)
@@ -131,13 +146,13 @@ class MaxSpanRepr(SpanRepr, nn.Module):
 class CoherentSpanRepr(SpanRepr, nn.Module):
     """Class implementing the coherent span representation."""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
-        batch_size = encoded_input.shape[0]
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
         p_size = int(encoded_input.shape[2]/4)
-        h_start = encoded_input[torch.arange(batch_size), start_ids, :]
-        h_end = encoded_input[torch.arange(batch_size), end_ids, :]
+        h_start = encoded_input[sent_ids, start_ids, :]
+        h_end = encoded_input[sent_ids, end_ids, :]
 
         coherence_term = torch.sum(
             h_start[:, 2*p_size:3*p_size] * h_end[:, 3*p_size:], dim=1, keepdim=True)
@@ -154,14 +169,14 @@ class CoherentSpanRepr(SpanRepr, nn.Module):
 class CoherentOrigSpanRepr(SpanRepr, nn.Module):
     """Class implementing the coherent span representation."""
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
-        batch_size = encoded_input.shape[0]
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
         d_b = (int(encoded_input.shape[2]) * 480)//1024
         d_c = (int(encoded_input.shape[2]) * 32)//1024
-        h_start = encoded_input[torch.arange(batch_size), start_ids, :]
-        h_end = encoded_input[torch.arange(batch_size), end_ids, :]
+        h_start = encoded_input[sent_ids, start_ids, :]
+        h_end = encoded_input[sent_ids, end_ids, :]
 
         coherence_term = torch.sum(
             h_start[:, 2*d_b:2*d_b + d_c] * h_end[:, 2*d_b + d_c:], dim=1, keepdim=True)
@@ -191,19 +206,24 @@ class AttnSpanRepr(SpanRepr, nn.Module):
         # self.attention_params.weight.data.fill_(0)
         # self.attention_params.bias.data.fill_(0)
 
-    def forward(self, encoded_input, start_ids, end_ids):
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
         if self.use_proj:
             encoded_input = self.proj(encoded_input)
 
+        # Attention logits are computed once per sentence and then gathered for each span
+        attn_logits = self.attention_params(encoded_input)
+        if sent_ids is not None:
+            encoded_input = encoded_input[sent_ids]
+            attn_logits = attn_logits[sent_ids]
         span_mask = get_span_mask(start_ids, end_ids, encoded_input.shape[1])
         attn_mask = (1 - span_mask) * (-1e10)
-        attn_logits = self.attention_params(encoded_input) + attn_mask
+        attn_logits = attn_logits + attn_mask
         attention_wts = nn.functional.softmax(attn_logits, dim=1)
         attention_term = torch.sum(attention_wts * encoded_input, dim=1)
         if self.use_endpoints:
-            batch_size = encoded_input.shape[0]
-            h_start = encoded_input[torch.arange(batch_size), start_ids, :]
-            h_end = encoded_input[torch.arange(batch_size), end_ids, :]
+            span_idx = torch.arange(encoded_input.shape[0], device=start_ids.device)
+            h_start = encoded_input[span_idx, start_ids, :]
+            h_end = encoded_input[span_idx, end_ids, :]
             return torch.cat([h_start, h_end, attention_term], dim=1)
         else:
             return attention_term
@@ -221,12 +241,80 @@ class AttnSpanRepr(SpanRepr, nn.Module):
                 return 3 * self.input_dim
 
 
-def get_span_module(input_dim, method="avg", use_proj=False, proj_dim=256):
+class PrefixAvgSpanRepr(AvgSpanRepr):
+    """Avg span representation computed as a difference of prefix sums.
+    Equivalent to AvgSpanRepr but the cost doesn't grow with # of spans x sentence length."""
+
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
+        if self.use_proj:
+            encoded_input = self.proj(encoded_input)
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
+        input_dtype = encoded_input.dtype
+        encoded_input = encoded_input.float()
+        # Prefix sums (in fp32) are over the states minus their mean over the sentence, which
+        # keeps the sums small and so the cancellation error of their differences - B x (L + 1) x H
+        sent_means = encoded_input.mean(dim=1, keepdim=True)
+        prefix_sums = nn.functional.pad(
+            torch.cumsum(encoded_input - sent_means, dim=1), (0, 0, 1, 0))
+        span_sums = prefix_sums[sent_ids, end_ids + 1, :] - prefix_sums[sent_ids, start_ids, :]
+        span_lengths = (end_ids - start_ids + 1).unsqueeze(1)
+        span_repr = span_sums / span_lengths + sent_means[sent_ids, 0, :]
+        return span_repr.to(input_dtype)
+
+
+class SegmentMaxSpanRepr(MaxSpanRepr):
+    """Max-pool span representation computed over just the tokens of every span.
+    Equivalent to MaxSpanRepr but the cost is # of spans x max span width."""
+
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
+        if self.use_proj:
+            encoded_input = self.proj(encoded_input)
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
+        # Padding positions repeat the last token of the span and so don't change the max
+        token_ids, _ = get_span_token_ids(start_ids, end_ids)
+        span_tokens = encoded_input[sent_ids.unsqueeze(1), token_ids, :]  # N x W x H
+        span_repr = torch.max(span_tokens, dim=1)[0]
+        return span_repr
+
+
+class SegmentAttnSpanRepr(AttnSpanRepr):
+    """Attention-based span representation with a softmax over just the tokens of every span.
+    Equivalent to AttnSpanRepr but the cost is # of spans x max span width."""
+
+    def forward(self, encoded_input, start_ids, end_ids, sent_ids=None):
+        if self.use_proj:
+            encoded_input = self.proj(encoded_input)
+        sent_ids = self.get_sent_ids(start_ids, sent_ids)
+
+        attn_logits = self.attention_params(encoded_input)
+        token_ids, token_mask = get_span_token_ids(start_ids, end_ids)
+        span_tokens = encoded_input[sent_ids.unsqueeze(1), token_ids, :]  # N x W x H
+        span_logits = attn_logits[sent_ids.unsqueeze(1), token_ids, :]  # N x W x 1
+        attn_mask = (~token_mask).unsqueeze(2).float() * (-1e10)
+        attention_wts = nn.functional.softmax(span_logits + attn_mask, dim=1)
+        attention_term = torch.sum(attention_wts * span_tokens, dim=1)
+        if self.use_endpoints:
+            h_start = encoded_input[sent_ids, start_ids, :]
+            h_end = encoded_input[sent_ids, end_ids, :]
+            return torch.cat([h_start, h_end, attention_term], dim=1)
+        else:
+            return attention_term
+
+
+def get_span_module(input_dim, method="avg", use_proj=False, proj_dim=256,
+                    segment_pooling=False):
     """Initializes the appropriate span representation class and returns the object.
+    segment_pooling: If True, the avg/max/attention based methods pool over just the span
+        tokens (prefix sums for avg) instead of masking the whole sentence.
+        The outputs and parameters are the same as with the masked versions.
     """
     if method == "avg":
+        if segment_pooling:
+            return PrefixAvgSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
         return AvgSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
     elif method == "max":
+        if segment_pooling:
+            return SegmentMaxSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
         return MaxSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
     elif method == "diff":
         return DiffSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
@@ -239,8 +327,13 @@ def get_span_module(input_dim, method="avg", use_proj=False, proj_dim=256):
     elif method == "coherent_original":
         return CoherentOrigSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
     elif method == "attn":
+        if segment_pooling:
+            return SegmentAttnSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
         return AttnSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim)
     elif method == "coref":
+        if segment_pooling:
+            return SegmentAttnSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim,
+                                       use_endpoints=True)
         return AttnSpanRepr(input_dim, use_proj=use_proj, proj_dim=proj_dim, use_endpoints=True)
     else:
         raise NotImplementedError
@@ -250,3 +343,23 @@ if __name__ == '__main__':
     span_model = AttnSpanRepr(768, use_endpoints=True, use_proj=True)
     print(span_model.get_output_dim())
     print(span_model.use_proj)
+
+    # Check that the segment pooling versions match the masked ones
+    encoded_input = torch.randn(4, 30, 768)
+    sent_ids = torch.randint(4, (50,))
+    start_ids = torch.randint(1, 29, (50,))
+    end_ids = torch.min(start_ids + torch.randint(10, (50,)), torch.tensor(28))
+    for method in ["avg", "max", "attn", "coref"]:
+        span_model = get_span_module(768, method=method, use_proj=True)
+        segment_model = get_span_module(768, method=method, use_proj=True, segment_pooling=True)
+        segment_model.load_state_dict(span_model.state_dict())
+        if torch.cuda.is_available():
+            span_model, segment_model = span_model.cuda(), segment_model.cuda()
+            encoded_input, sent_ids = encoded_input.cuda(), sent_ids.cuda()
+            start_ids, end_ids = start_ids.cuda(), end_ids.cuda()
+        with torch.no_grad():
+            masked_output = span_model(encoded_input, start_ids, end_ids, sent_ids=sent_ids)
+            segment_output = segment_model(encoded_input, start_ids, end_ids, sent_ids=sent_ids)
+        max_diff = torch.max(torch.abs(masked_output - segment_output)).item()
+        print(method, max_diff)
+        assert max_diff < 1e-5
@@ -0,0 +1,113 @@
+"""Subword tokenization of pre-split sentences with a per-tokenizer word cache.
+
+Tokenizing a word is deterministic, so the subword ids of each distinct word are
+computed once and kept in a bounded LRU cache. A sentence is then tokenized in one
+call which returns the token ids (with the special tokens) and a word offset array
+from which the subword to word alignment follows directly.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import transformers
+from packaging import version
+
+# Default max number of distinct words kept in the cache
+CACHE_SIZE = 2 ** 18
+
+
+class CachedWordTokenizer(object):
+    def __init__(self, tokenizer, start_shift, end_shift, add_prefix_space=False,
+                 cache_size=CACHE_SIZE):
+        """
+        tokenizer: HuggingFace tokenizer.
+        start_shift, end_shift: # of special tokens added at the start/end of a sentence.
+        add_prefix_space: Tokenize every word with a leading space (RoBERTa).
+        cache_size: Max number of distinct words whose subword ids are cached.
+        """
+        self.tokenizer = tokenizer
+        self.start_shift = start_shift
+        self.end_shift = end_shift
+        self.add_prefix_space = add_prefix_space
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # The special tokens don't depend on the sentence, so get them once
+        if version.parse(transformers.__version__) > version.parse('2.0.0'):
+            special_ids = tokenizer.build_inputs_with_special_tokens([])
+        else:
+            special_ids = tokenizer.add_special_tokens_single_sequence([])
+        assert (len(special_ids) == start_shift + end_shift)
+        self.prefix_ids = list(special_ids[:start_shift])
+        self.suffix_ids = list(special_ids[start_shift:])
+
+    def __getstate__(self):
+        # Don't pickle the cache, e.g. when sent to worker processes
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    def get_word_ids(self, word):
+        """Returns the tuple of subword ids of a word."""
+        subword_ids = self.cache.get(word, None)
+        if subword_ids is None:
+            if self.add_prefix_space:
+                subword_list = self.tokenizer.tokenize(word, add_prefix_space=True)
+            else:
+                subword_list = self.tokenizer.tokenize(word)
+            subword_ids = tuple(self.tokenizer.convert_tokens_to_ids(subword_list))
+            self.cache[word] = subword_ids
+            if len(self.cache) > self.cache_size:
+                # Evict the least recently used word
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(word)
+        return subword_ids
+
+    def tokenize_words(self, words):
+        """
+        words: List of W words.
+        Returns: List of the L token ids (including the special tokens), and an int64
+            array of size W + 1 where the subwords of word i are token_ids[o[i]:o[i + 1]].
+        """
+        token_ids = list(self.prefix_ids)
+        word_offsets = np.empty(len(words) + 1, dtype=np.int64)
+        word_offsets[0] = len(token_ids)
+        for word_idx, word in enumerate(words):
+            token_ids.extend(self.get_word_ids(word))
+            word_offsets[word_idx + 1] = len(token_ids)
+        token_ids.extend(self.suffix_ids)
+        return token_ids, word_offsets
+
+    def get_subword_to_word_idx(self, word_offsets, num_tokens):
+        """
+        Expands the word offsets to the list of the word index of every token,
+        with -1 for the special tokens.
+        """
+        subword_to_word_idx = np.full(num_tokens, -1, dtype=np.int64)
+        subword_to_word_idx[word_offsets[0]: word_offsets[-1]] = np.repeat(
+            np.arange(len(word_offsets) - 1), np.diff(word_offsets))
+        return subword_to_word_idx.tolist()
+
+
+# unit test
+if __name__ == '__main__':
+    from transformers import BertTokenizer
+
+    tokenizer = BertTokenizer.from_pretrained('bert-base-cased')
+    word_tokenizer = CachedWordTokenizer(tokenizer, start_shift=1, end_shift=1, cache_size=4)
+    words = "Chomsky says hello to the unbelievably beautiful world ! Chomsky".split()
+    token_ids, word_offsets = word_tokenizer.tokenize_words(words)
+
+    # Reference: word by word tokenization
+    ref_token_ids, ref_word_idx = [], []
+    for word_idx, word in enumerate(words):
+        subword_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word))
+        ref_token_ids += subword_ids
+        ref_word_idx += [word_idx] * len(subword_ids)
+    ref_token_ids = tokenizer.build_inputs_with_special_tokens(ref_token_ids)
+    assert (token_ids == ref_token_ids)
+    assert (word_tokenizer.get_subword_to_word_idx(word_offsets, len(token_ids))
+            == [-1] + ref_word_idx + [-1])
+    assert (len(word_tokenizer.cache) == 4)
+    print(tokenizer.convert_ids_to_tokens(token_ids))
+    print(word_offsets)
@@ -7,17 +7,29 @@ def get_sequence_mask(sequence_len):
     """
     batch_size = sequence_len.size()[0]
     max_len = torch.max(sequence_len)
-    return (torch.arange(max_len).expand(batch_size, max_len).cuda()
+    return (torch.arange(max_len, device=sequence_len.device).expand(batch_size, max_len)
             < sequence_len.unsqueeze(1))
 
 
 def get_span_mask(start_ids, end_ids, max_len):
-    tmp = torch.arange(max_len).unsqueeze(0).expand(start_ids.shape[0], -1)
+    tmp = torch.arange(max_len, device=start_ids.device).unsqueeze(0).expand(
+        start_ids.shape[0], -1)
     batch_start_ids = start_ids.unsqueeze(1).expand_as(tmp)
     batch_end_ids = end_ids.unsqueeze(1).expand_as(tmp)
-    if torch.cuda.is_available():
-        tmp = tmp.cuda()
-        batch_start_ids = batch_start_ids.cuda()
-        batch_end_ids = batch_end_ids.cuda()
     mask = ((tmp >= batch_start_ids).float() * (tmp <= batch_end_ids).float()).unsqueeze(2)
     return mask
+
+
+def get_span_token_ids(start_ids, end_ids):
+    """Returns the token indices of the spans padded to the max span width.
+    start_ids, end_ids: Tensors of size (N,) with the (inclusive) span endpoints.
+
+    Returns: Tensor of size (N x W) with the token indices, where the padding positions
+        repeat the last token of the span, and the (N x W) mask of valid positions.
+    """
+    span_widths = end_ids - start_ids + 1
+    max_width = (int(torch.max(span_widths)) if span_widths.shape[0] > 0 else 1)
+    offsets = torch.arange(max_width, device=start_ids.device).unsqueeze(0)
+    token_mask = offsets < span_widths.unsqueeze(1)
+    token_ids = torch.min(start_ids.unsqueeze(1) + offsets, end_ids.unsqueeze(1))
+    return token_ids, token_mask
@@ -0,0 +1,100 @@
+"""Encoding of sequences longer than the position limit of the pretrained model.
+
+Every sequence is split into overlapping windows of at most window_size tokens, each
+with the special tokens of the sequence around it. The windows of a whole batch are
+encoded in a single call of the pretrained model, and stitched back into one sequence
+where every token takes its hidden state from the window in which it has the most
+context, i.e. where min(# of tokens to its left, # of tokens to its right) is largest.
+"""
+import numpy as np
+import torch
+
+
+def get_window_starts(num_tokens, window_len, stride):
+    """Returns the start offsets of the windows covering num_tokens tokens."""
+    starts = [0]
+    while starts[-1] + window_len < num_tokens:
+        starts.append(starts[-1] + stride)
+    return starts
+
+
+def get_windows(batch_ids, window_size, stride, start_shift=1, end_shift=1, pad_token_id=0):
+    """
+    batch_ids: B x L padded token ids, with start_shift (end_shift) special tokens at the
+        start (end) of every sequence.
+    window_size: Max # of tokens of a window, including the special tokens.
+    stride: # of tokens between the starts of consecutive windows, excluding special tokens.
+
+    Returns: (window_ids, gather_ids) where window_ids is N x L' (L' <= window_size) with the
+        N windows of the batch, and gather_ids is B x L with the index of the hidden state of
+        every token in the flattened (N * L') window tokens.
+    """
+    window_len = window_size - start_shift - end_shift
+    assert (0 < stride <= window_len)
+    batch_size, max_len = batch_ids.shape
+    input_lens = (batch_ids != pad_token_id).sum(dim=1).tolist()
+    ids_list = batch_ids.tolist()
+
+    windows = []
+    # Window and position in the window of every token. Padding points to the first window.
+    window_idx = np.zeros((batch_size, max_len), dtype=np.int64)
+    window_pos = np.zeros((batch_size, max_len), dtype=np.int64)
+    for idx, input_len in enumerate(input_lens):
+        token_ids = ids_list[idx]
+        prefix = token_ids[:start_shift]
+        inner = token_ids[start_shift: input_len - end_shift]
+        suffix = token_ids[input_len - end_shift: input_len]
+
+        first_window = len(windows)
+        positions = np.arange(len(inner))
+        best_score = np.full(len(inner), -1.0)
+        for start in get_window_starts(len(inner), window_len, stride):
+            end = min(start + window_len, len(inner))
+            cur_positions = positions[start:end]
+            # Ties go to the longer window
+            score = (np.minimum(cur_positions - start, end - 1 - cur_positions)
+                     + 0.01 * (end - start))
+            better = cur_positions[score > best_score[start:end]]
+            best_score[better] = score[better - start]
+            window_idx[idx, start_shift + better] = len(windows)
+            window_pos[idx, start_shift + better] = start_shift + better - start
+            windows.append(prefix + inner[start:end] + suffix)
+
+        # Special tokens at the start come from the first window, the ones at the end from
+        # the last window
+        window_idx[idx, :start_shift] = first_window
+        window_pos[idx, :start_shift] = np.arange(start_shift)
+        window_idx[idx, input_len - end_shift: input_len] = len(windows) - 1
+        window_pos[idx, input_len - end_shift: input_len] = (
+            len(windows[-1]) - end_shift + np.arange(end_shift))
+        window_idx[idx, input_len:] = first_window
+
+    num_window_tokens = max([len(window) for window in windows])
+    window_ids = torch.tensor(
+        [window + [pad_token_id] * (num_window_tokens - len(window)) for window in windows],
+        device=batch_ids.device)
+    gather_ids = torch.from_numpy(window_idx * num_window_tokens + window_pos).to(
+        batch_ids.device)
+    return window_ids, gather_ids
+
+
+def stitch_windows(window_states, gather_ids):
+    """
+    window_states: N x L' x E hidden states of the windows.
+    gather_ids: B x L output of get_windows.
+    Returns: B x L x E
+    """
+    return window_states.flatten(0, 1)[gather_ids]
+
+
+if __name__ == '__main__':
+    # Stitching the token ids of the windows gives back the original sequences
+    batch_ids = torch.tensor([[101] + list(range(1, 31)) + [102],
+                              [101] + list(range(1, 8)) + [102] + [0] * 23])
+    for window_size, stride in [(10, 4), (10, 8), (12, 3), (40, 20)]:
+        window_ids, gather_ids = get_windows(batch_ids, window_size, stride)
+        stitched_ids = stitch_windows(window_ids.unsqueeze(2), gather_ids).squeeze(2)
+        mask = (batch_ids != 0)
+        assert (window_ids.shape[1] <= window_size)
+        assert torch.equal(stitched_ids[mask], batch_ids[mask])
+        print(window_size, stride, tuple(window_ids.shape))
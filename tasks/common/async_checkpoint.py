@@ -0,0 +1,126 @@
+"""Checkpoint writer which serializes and writes checkpoints on a background thread.
+
+save() copies the tensors of a checkpoint to the CPU, which is all the training loop
+waits for, and queues it. A background thread writes the queued checkpoints, each to a
+temporary file in the same directory which is then renamed over the checkpoint, so a
+crash mid write never leaves a truncated checkpoint. A checkpoint still in the queue
+when a newer one for the same path is saved is dropped. flush() waits for the queue to
+be written, e.g. before a checkpoint is read back, and is also run at exit.
+"""
+import os
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+
+def to_cpu(obj):
+    """Copy of the (nested dicts, lists and tuples of) tensors of obj on the CPU."""
+    if isinstance(obj, nn.Parameter):
+        # Stays a parameter, e.g. weighing_params which is assigned back to the encoder
+        return nn.Parameter(obj.detach().to('cpu', copy=True), requires_grad=obj.requires_grad)
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((key, to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, location):
+    """torch.save to a temporary file which then replaces location."""
+    tmp_location = "%s.tmp.%d" % (location, os.getpid())
+    try:
+        torch.save(obj, tmp_location)
+        os.replace(tmp_location, location)
+    finally:
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+
+
+class AsyncCheckpointer(object):
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.num_writing = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def save(self, obj, location):
+        """Queue obj to be written to location. Returns once its tensors are on the CPU."""
+        obj = to_cpu(obj)
+        with self.condition:
+            self.raise_error()
+            if location in self.pending:
+                logging.info("Dropping queued checkpoint superseded for: %s" % location)
+                del self.pending[location]
+            self.pending[location] = obj
+            if self.thread is None:
+                # Started on the first save
+                self.thread = threading.Thread(target=self.write_loop, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                location, obj = self.pending.popitem(last=False)
+                self.num_writing += 1
+            try:
+                atomic_save(obj, location)
+                logging.info("Checkpoint written: %s" % location)
+            except Exception as error:
+                logging.error("Writing checkpoint %s failed: %s" % (location, error))
+                with self.condition:
+                    self.error = error
+            with self.condition:
+                self.num_writing -= 1
+                self.condition.notify_all()
+
+    def flush(self):
+        """Wait until the queued checkpoints are written."""
+        with self.condition:
+            while self.pending or self.num_writing:
+                self.condition.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        """Re-raise the error of a failed write in the training thread."""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+# unit test
+if __name__ == '__main__':
+    import tempfile
+
+    checkpointer = AsyncCheckpointer()
+    weights = torch.zeros(1000, 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        location = os.path.join(tmp_dir, "model.pt")
+        for step in range(5):
+            weights.fill_(step)
+            checkpointer.save({'weights': weights, 'step': step}, location)
+        # The queued checkpoints are snapshots, and the last one is written
+        weights.fill_(-1)
+        checkpointer.flush()
+        checkpoint = torch.load(location)
+        assert checkpoint['step'] == 4 and torch.all(checkpoint['weights'] == 4)
+        assert os.listdir(tmp_dir) == ["model.pt"]
+
+        # Parameters are saved as parameters, so they can be assigned back to a module
+        module = nn.Linear(2, 2)
+        checkpointer.save({'weight': module.weight}, location)
+        checkpointer.flush()
+        checkpoint = torch.load(location)
+        assert isinstance(checkpoint['weight'], nn.Parameter)
+        module.weight = checkpoint['weight']
+        print("OK")
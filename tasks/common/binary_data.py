@@ -0,0 +1,180 @@
+"""Compact binary format of the preprocessed (tokenized) task data.
+
+Every split of a task is tokenized once per encoder tokenizer and written to
+<out_dir>/<model_name>/<split>/ as flat, memory-mappable numpy arrays:
+    tokens.npy          int32 (total # of subword tokens,)  token ids of all sentences
+    token_offsets.npy   int64 (S + 1,)  tokens of sentence i are tokens[o[i]:o[i + 1]]
+    target_offsets.npy  int64 (S + 1,)  targets of sentence i are rows o[i]:o[i + 1]
+    spans.npy           int32 (T, 2 x num_spans)  subword spans, end index inclusive
+    orig_spans.npy      int32 (T, 2 x num_spans)  word spans as in the JSON file
+    labels.npy          int32 (T,)  index of the label of every target in labels.json
+    labels.json         list of the distinct (raw) labels
+    meta.json           model name and sizes
+
+Preprocess the train/development/test files of a task via:
+    python -m tasks.common.binary_data -model bert -model_size base \
+        -data_dir tasks/srl/data -out_dir tasks/srl/data/binary
+"""
+import os
+import json
+import logging
+import argparse
+
+import numpy as np
+
+from tasks.common.preprocess import preprocess_lines
+
+SPLITS = ['train', 'development', 'test']
+ARRAY_NAMES = ['tokens', 'token_offsets', 'target_offsets', 'spans', 'orig_spans', 'labels']
+
+
+def get_tokenized_span_indices(subword_to_word_idx, orig_span_indices):
+    """Maps a word span (end exclusive) to the subword span (end inclusive)."""
+    orig_start_idx, orig_end_idx = orig_span_indices
+    start_idx = subword_to_word_idx.index(orig_start_idx)
+    # Search for the index of the last subword
+    end_idx = len(subword_to_word_idx) - 1 - subword_to_word_idx[::-1].index(orig_end_idx - 1)
+    return [start_idx, end_idx]
+
+
+def write_split(path, split_dir, encoder, num_workers=1):
+    """Tokenize the JSONL file at path with the encoder and write it to split_dir."""
+    tokens, token_offsets = [], [0]
+    spans, orig_spans, label_ids, target_offsets = [], [], [], [0]
+    label_list, label_to_id = [], {}
+    num_spans = None
+
+    with open(path, encoding="utf-8") as f:
+        lines = f.readlines()
+    for token_ids, targets in preprocess_lines(lines, encoder.word_tokenizer,
+                                               num_workers=num_workers):
+        tokens.extend(token_ids)
+        token_offsets.append(len(tokens))
+
+        for target in targets:
+            # target is [span, orig_span, ..., label]
+            if num_spans is None:
+                num_spans = (len(target) - 1) // 2
+            span_row, orig_span_row = [], []
+            for i in range(num_spans):
+                span_row += target[2 * i]
+                orig_span_row += target[2 * i + 1]
+            spans.append(span_row)
+            orig_spans.append(orig_span_row)
+
+            label = target[-1]
+            if label not in label_to_id:
+                label_to_id[label] = len(label_list)
+                label_list.append(label)
+            label_ids.append(label_to_id[label])
+        target_offsets.append(len(spans))
+
+    if num_spans is None:
+        num_spans = 1
+    arrays = {
+        'tokens': np.array(tokens, dtype=np.int32),
+        'token_offsets': np.array(token_offsets, dtype=np.int64),
+        'target_offsets': np.array(target_offsets, dtype=np.int64),
+        'spans': np.array(spans, dtype=np.int32).reshape(-1, 2 * num_spans),
+        'orig_spans': np.array(orig_spans, dtype=np.int32).reshape(-1, 2 * num_spans),
+        'labels': np.array(label_ids, dtype=np.int32),
+    }
+
+    if not os.path.exists(split_dir):
+        os.makedirs(split_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(split_dir, name + '.npy'), array)
+    with open(os.path.join(split_dir, 'labels.json'), 'w') as f:
+        json.dump(label_list, f)
+    with open(os.path.join(split_dir, 'meta.json'), 'w') as f:
+        json.dump({'model_name': encoder.model_name, 'num_spans': num_spans,
+                   'num_sentences': len(token_offsets) - 1, 'num_targets': len(spans)}, f)
+
+
+class BinarySplit(object):
+    """Memory-mapped view of a split written by write_split."""
+
+    def __init__(self, split_dir):
+        self.split_dir = split_dir
+        with open(os.path.join(split_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.model_name = meta['model_name']
+        self.num_spans = meta['num_spans']
+        with open(os.path.join(split_dir, 'labels.json')) as f:
+            self.label_list = json.load(f)
+        self.open()
+
+    def open(self):
+        for name in ARRAY_NAMES:
+            setattr(self, name, np.load(os.path.join(self.split_dir, name + '.npy'),
+                                        mmap_mode='r'))
+
+    def __getstate__(self):
+        # Pickle just the location, not the (memory-mapped) arrays
+        state = self.__dict__.copy()
+        for name in ARRAY_NAMES:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        """Number of sentences."""
+        return len(self.token_offsets) - 1
+
+    def get_lengths(self):
+        """Returns an array with the number of tokens of every sentence."""
+        return np.diff(self.token_offsets)
+
+    def get_num_targets(self):
+        """Returns an array with the number of targets of every sentence."""
+        return np.diff(self.target_offsets)
+
+    def get_target_sent_ids(self):
+        """Returns an array with the sentence index of every target."""
+        return np.repeat(np.arange(len(self)), self.get_num_targets())
+
+    def get_text(self, sent_idx):
+        """Token ids of a sentence as a list."""
+        return self.tokens[self.token_offsets[sent_idx]: self.token_offsets[sent_idx + 1]].tolist()
+
+    def get_target(self, target_idx):
+        """
+        Returns a target as the list [span, orig_span, ..., label], i.e. the subword and the
+        word span for each of its spans followed by its (raw) label.
+        """
+        span_row = self.spans[target_idx].tolist()
+        orig_span_row = self.orig_spans[target_idx].tolist()
+        target = []
+        for i in range(self.num_spans):
+            target += [span_row[2 * i: 2 * i + 2], orig_span_row[2 * i: 2 * i + 2]]
+        target.append(self.label_list[self.labels[target_idx]])
+        return target
+
+    def get_targets(self, sent_idx):
+        return [self.get_target(target_idx) for target_idx in
+                range(self.target_offsets[sent_idx], self.target_offsets[sent_idx + 1])]
+
+
+if __name__ == '__main__':
+    from encoders.pretrained_transformers import Encoder
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-model", type=str, default="bert")
+    parser.add_argument("-model_size", type=str, default="base")
+    parser.add_argument("-uncased", default=False, action="store_true")
+    parser.add_argument("-data_dir", type=str, required=True,
+                        help="Directory with the train/development/test JSON files.")
+    parser.add_argument("-out_dir", type=str, required=True)
+    parser.add_argument("-num_workers", type=int, default=1,
+                        help="Number of processes which tokenize the JSON files.")
+    args = parser.parse_args()
+
+    encoder = Encoder(model=args.model, model_size=args.model_size, cased=not args.uncased)
+    for split in SPLITS:
+        split_dir = os.path.join(args.out_dir, encoder.model_name, split)
+        write_split(os.path.join(args.data_dir, split + '.json'), split_dir, encoder,
+                    num_workers=args.num_workers)
+        logging.info("Wrote %d sentences to %s" % (len(BinarySplit(split_dir)), split_dir))
@@ -0,0 +1,85 @@
+"""Checkpoints with just the trainable parameters of a model.
+
+A probe only trains its span module(s), label net and layer weights, on top of a frozen
+pretrained model which can be rebuilt from its name. So a checkpoint stores the
+parameters with requires_grad (everything when fine tuning) and a reference to the
+pretrained base model: its name and a hash of the names and shapes of its parameters.
+On load, the model is built as usual (which loads the pretrained weights) and the
+trainable parameters are loaded into it. Checkpoints with full state dicts, as written
+before, load the same way.
+"""
+import hashlib
+
+import torch
+
+
+def trainable_state_dict(module):
+    """State dict of just the parameters of module with requires_grad."""
+    return {name: param for name, param in module.named_parameters() if param.requires_grad}
+
+
+def snapshot(module):
+    """CPU copy of the trainable parameters of module, e.g. of the best model so far."""
+    return {name: param.detach().cpu().clone()
+            for name, param in trainable_state_dict(module).items()}
+
+
+def get_model_hash(module):
+    """Hash of the names and shapes of the parameters of module."""
+    model_hash = hashlib.sha1()
+    for name, param in module.named_parameters():
+        model_hash.update(("%s:%s;" % (name, tuple(param.shape))).encode('utf-8'))
+    return model_hash.hexdigest()
+
+
+def get_base_model_ref(encoder):
+    """Reference to the pretrained model of an Encoder."""
+    return {'model_name': encoder.model_name, 'model_hash': get_model_hash(encoder.model)}
+
+
+def check_base_model(checkpoint, encoder):
+    """Checks that the checkpoint was trained on top of the pretrained model of encoder."""
+    base_model = checkpoint.get('base_model')
+    if base_model is None:
+        # Written before base model references, with full state dicts
+        return
+    if base_model != get_base_model_ref(encoder):
+        raise ValueError("Checkpoint was trained with %s, got an encoder with %s"
+                         % (base_model['model_name'], encoder.model_name))
+
+
+def load_trainable_state_dict(module, state_dict):
+    """
+    Loads a state dict of trainable_state_dict (or a full state dict) into module.
+    Only frozen parameters may be missing from it.
+    """
+    missing_keys, unexpected_keys = module.load_state_dict(state_dict, strict=False)
+    trainable_names = set(trainable_state_dict(module))
+    missing_trainable = [name for name in missing_keys if name in trainable_names]
+    if missing_trainable or unexpected_keys:
+        raise RuntimeError("Error(s) in loading state_dict for %s: missing %s, unexpected %s"
+                           % (module.__class__.__name__, missing_trainable, unexpected_keys))
+
+
+if __name__ == '__main__':
+    import io
+    import torch.nn as nn
+
+    frozen, head = nn.Linear(512, 512), nn.Linear(512, 2)
+    for param in frozen.parameters():
+        param.requires_grad = False
+    model = nn.Sequential(frozen, head)
+
+    buffer = io.BytesIO()
+    torch.save(trainable_state_dict(model), buffer)
+    print("Trainable only: %d bytes, full: %d bytes"
+          % (buffer.tell(), sum(param.numel() * 4 for param in model.parameters())))
+
+    best = snapshot(model)
+    with torch.no_grad():
+        head.weight.add_(1.0)
+    assert not torch.equal(best['1.weight'], head.weight)
+    load_trainable_state_dict(model, best)
+    assert torch.equal(best['1.weight'], head.weight)
+    # Full state dicts load as well
+    load_trainable_state_dict(model, model.state_dict())
@@ -0,0 +1,73 @@
+"""torchtext examples read lazily from a BinarySplit."""
+import numpy as np
+from torchtext.data import Example
+
+
+class LazyExamples(object):
+    """Sequence of torchtext Examples which are only built when accessed.
+
+    With group_by_sentence every example is a sentence with all of its targets
+    (sentences without targets are skipped), otherwise every example is one target.
+    The example values are laid out exactly as in the JSON based data modules.
+    """
+
+    def __init__(self, binary_split, fields, group_by_sentence=False,
+                 num_sentences=None, num_targets=None, index=None, sent_num_targets=None):
+        """
+        num_sentences: If set, only the first num_sentences sentences are used.
+        num_targets: If set, only the first num_targets targets (of those sentences) are
+            used, so the last sentence may keep only some of its targets.
+        index: Sentence (or target) indices of the examples, used for slicing.
+        sent_num_targets: # of targets used of every sentence, used for slicing.
+        """
+        self.binary_split = binary_split
+        self.fields = fields
+        self.group_by_sentence = group_by_sentence
+        if index is None:
+            if num_sentences is None:
+                num_sentences = len(binary_split)
+            total_targets = binary_split.target_offsets[num_sentences]
+            if num_targets is not None:
+                total_targets = min(total_targets, num_targets)
+            if group_by_sentence:
+                sent_num_targets = np.clip(
+                    total_targets - binary_split.target_offsets[:num_sentences], 0,
+                    binary_split.get_num_targets()[:num_sentences])
+                index = np.nonzero(sent_num_targets)[0]
+            else:
+                index = np.arange(total_targets)
+        self.index = index
+        self.sent_num_targets = sent_num_targets
+        if not group_by_sentence:
+            self.target_sent_ids = binary_split.get_target_sent_ids()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return LazyExamples(self.binary_split, self.fields, self.group_by_sentence,
+                                index=self.index[idx], sent_num_targets=self.sent_num_targets)
+
+        if self.group_by_sentence:
+            sent_idx = self.index[idx]
+            targets = self.binary_split.get_targets(sent_idx)[:self.sent_num_targets[sent_idx]]
+            values = ([self.binary_split.get_text(sent_idx)]
+                      + [list(column) for column in zip(*targets)] + [len(targets)])
+        else:
+            target_idx = self.index[idx]
+            sent_idx = self.target_sent_ids[target_idx]
+            values = ([self.binary_split.get_text(sent_idx)]
+                      + self.binary_split.get_target(target_idx))
+        return Example.fromlist(values, self.fields)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def get_lengths(self):
+        """Returns the number of tokens of every example without building the examples."""
+        lengths = self.binary_split.get_lengths()
+        if self.group_by_sentence:
+            return lengths[self.index].tolist()
+        return lengths[self.target_sent_ids[self.index]].tolist()
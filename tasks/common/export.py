@@ -0,0 +1,180 @@
+"""Export of a trained probe as a single TorchScript or ONNX inference graph.
+
+The graph runs the pretrained model, the (fixed) weighted avg of its layers, the span
+module(s) and the label net. It takes the padded token ids (B x L), the subword spans of
+the targets (N x 2 per span, end inclusive) and the row of every target (N,), and returns
+the N x C label probabilities. The batch, length and target axes are dynamic. The export
+is checked against the eager probe on a batch of a different shape than the traced one.
+
+    python -m tasks.common.export -task ner -model_path <model_dir>/best_models/model.pt \
+        -format onnx -output <model_dir>/best_models/probe.onnx
+"""
+import copy
+import inspect
+import logging
+import argparse
+
+import torch
+import torch.nn as nn
+
+from encoders.pretrained_transformers.device import setup_device
+from encoders.pretrained_transformers.span_reprs import SegmentMaxSpanRepr, SegmentAttnSpanRepr
+from tasks.common.infer import add_probe_args, load_probe
+
+# Sentences of the traced inputs and of the parity check
+EXAMPLE_SENTENCES = [
+    "Chomsky says hello to the world .",
+    "The quick brown fox jumps over the lazy dog near the river bank .",
+    "Hello !",
+]
+INPUT_NAMES = ['token_ids', 'spans', 'sent_ids']
+OUTPUT_NAMES = ['probs']
+DYNAMIC_AXES = {'token_ids': {0: 'batch', 1: 'length'}, 'spans': {0: 'num_spans'},
+                'sent_ids': {0: 'num_spans'}, 'probs': {0: 'num_spans'}}
+
+
+def get_traceable_span_module(span_module):
+    """
+    The segment pooled max and attention modules pad the spans to the max span width of
+    the batch, which a trace would fix. They are swapped for the masked versions, which
+    have the same parameters and outputs.
+    """
+    if isinstance(span_module, (SegmentMaxSpanRepr, SegmentAttnSpanRepr)):
+        span_module = copy.copy(span_module)
+        span_module.__class__ = span_module.__class__.__bases__[0]
+    return span_module
+
+
+class ExportedProbe(nn.Module):
+    """Probe as one graph, with the softmax of the layer weights baked in as constants."""
+
+    def __init__(self, probe):
+        super(ExportedProbe, self).__init__()
+        encoder = probe.encoder
+        assert (encoder.base_name != 'xlnet'), "Only the BERT variants can be exported"
+        assert (encoder.window_size is None), "Windowed encoding can't be exported"
+        assert (encoder.feature_store is None)
+        assert (not encoder.unpad), "Unpadded attention loops over the sequences"
+        self.encoder = encoder
+        self.span_modules = nn.ModuleList(
+            [get_traceable_span_module(span_module) for span_module in probe.span_modules])
+        self.label_net = probe.label_net
+        if probe.just_last_layer:
+            self.layer_weights = {encoder.layers[-1]: 1.0}
+        else:
+            soft_weight = nn.functional.softmax(encoder.weighing_params, dim=0).tolist()
+            self.layer_weights = dict(zip(encoder.layers, soft_weight))
+        self.num_layers = encoder.layers[-1] + 1
+
+    def forward(self, token_ids, spans, sent_ids):
+        encoded_input = 0
+        for layer, hidden_states in enumerate(
+                self.encoder.iter_layers(token_ids, self.num_layers)):
+            if layer in self.layer_weights:
+                encoded_input = encoded_input + self.layer_weights[layer] * hidden_states.float()
+        if self.encoder.proj:
+            encoded_input = self.encoder.proj(encoded_input)
+
+        span_reprs = []
+        for idx, span_module in enumerate(self.span_modules):
+            span_reprs.append(span_module(encoded_input, spans[:, 2 * idx], spans[:, 2 * idx + 1],
+                                          sent_ids=sent_ids))
+        return self.label_net(torch.cat(span_reprs, dim=-1))
+
+
+def get_example_inputs(probe, sentences):
+    """Token ids of the sentences, with a one token and a whole sentence span for each."""
+    encoder = probe.encoder
+    token_ids, input_lens = encoder.tokenize_batch(sentences)
+    spans, sent_ids = [], []
+    for idx, input_len in enumerate(input_lens.tolist()):
+        first, last = encoder.start_shift, input_len - encoder.end_shift - 1
+        for span in [[first, first], [first, last]]:
+            spans.append(span * len(probe.span_modules))
+            sent_ids.append(idx)
+    device = token_ids.device
+    return (token_ids, torch.tensor(spans, device=device),
+            torch.tensor(sent_ids, device=device))
+
+
+def export_torchscript(exported_probe, inputs, path):
+    traced_probe = torch.jit.trace(exported_probe, inputs, check_trace=False)
+    torch.jit.save(traced_probe, path)
+
+    def run(*run_inputs):
+        return torch.jit.load(path, map_location=run_inputs[0].device)(*run_inputs)
+    return run
+
+
+def export_onnx(exported_probe, inputs, path, opset_version=14):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Dynamic axes are specified for the TorchScript based exporter
+        kwargs['dynamo'] = False
+    torch.onnx.export(exported_probe, inputs, path, input_names=INPUT_NAMES,
+                      output_names=OUTPUT_NAMES, dynamic_axes=DYNAMIC_AXES,
+                      opset_version=opset_version, **kwargs)
+
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(*run_inputs):
+        outputs = session.run(None, {name: run_input.cpu().numpy()
+                                     for name, run_input in zip(INPUT_NAMES, run_inputs)})
+        return torch.from_numpy(outputs[0])
+    return run
+
+
+def check_parity(probe, run, inputs, tolerance):
+    """Max abs difference of the exported and the eager probe on the inputs."""
+    token_ids, spans, sent_ids = inputs
+    with torch.no_grad():
+        expected = probe.predict(probe.encode(token_ids), spans, sent_ids)
+        actual = run(token_ids, spans, sent_ids)
+    max_diff = torch.max(torch.abs(actual.to(expected.device) - expected)).item()
+    logging.info("Max abs difference from the eager probe: %.2e" % max_diff)
+    assert (max_diff <= tolerance), "Exported probe differs from the eager one"
+    return max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_probe_args(parser)
+    parser.add_argument("-format", type=str, default="torchscript",
+                        choices=["torchscript", "onnx"])
+    parser.add_argument("-output", type=str, required=True)
+    parser.add_argument("-opset", type=int, default=14, help="ONNX opset version.")
+    parser.add_argument("-tolerance", type=float, default=1e-4,
+                        help="Max abs difference of the probabilities in the parity check.")
+    args = parser.parse_args()
+    if args.format == 'onnx' and (args.quantize or args.quantized_model):
+        parser.error("Dynamic int8 models can only be exported to TorchScript")
+
+    device = setup_device(args.device, num_threads=args.num_threads,
+                          num_interop_threads=args.num_interop_threads,
+                          pin_threads=args.pin_threads)
+    probe = load_probe(args).to(device)
+    probe.eval()
+    exported_probe = ExportedProbe(probe)
+
+    # Trace with fewer and shorter sentences than the parity check to test dynamic axes
+    trace_inputs = get_example_inputs(probe, EXAMPLE_SENTENCES[:1])
+    with torch.no_grad():
+        if args.format == 'torchscript':
+            run = export_torchscript(exported_probe, trace_inputs, args.output)
+        else:
+            run = export_onnx(exported_probe, trace_inputs, args.output,
+                              opset_version=args.opset)
+    logging.info("Exported the probe to %s" % args.output)
+
+    if run is None:
+        logging.info("onnxruntime is not installed, skipping the parity check")
+    else:
+        check_parity(probe, run, get_example_inputs(probe, EXAMPLE_SENTENCES), args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
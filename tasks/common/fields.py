@@ -0,0 +1,62 @@
+"""torchtext fields for sentence-grouped examples.
+
+In the sentence-grouped data mode every example is a sentence together with the
+list of all its targets. The fields below flatten those per-sentence lists into a
+single ragged batch of targets, so that each sentence is encoded only once.
+"""
+import torch
+from torchtext.data import Field
+
+
+class RaggedField(Field):
+    """Field whose value is a list of items per example, flattened over the batch.
+
+    Numericalization (and the vocab lookup, if use_vocab is set) is applied to the
+    flattened list, so a batch of K sentences with N targets in total yields a
+    tensor with N rows.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['sequential'] = False
+        kwargs['batch_first'] = True
+        super(RaggedField, self).__init__(**kwargs)
+
+    def process(self, batch, device=None):
+        flat_batch = [item for example in batch for item in example]
+        return self.numericalize(flat_batch, device=device)
+
+
+class SentenceIndexField(Field):
+    """Field holding the number of targets of each example.
+
+    When batched, it is expanded into a tensor of size (N,) which maps each of the
+    N flattened targets to the row of its sentence in the batch.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['sequential'] = False
+        kwargs['use_vocab'] = False
+        kwargs['batch_first'] = True
+        super(SentenceIndexField, self).__init__(**kwargs)
+
+    def process(self, batch, device=None):
+        num_targets = torch.tensor(batch, dtype=torch.long, device=device)
+        return torch.arange(len(batch), device=device).repeat_interleave(num_targets)
+
+
+def get_sentence_fields(text_field, span_names, label_field=None):
+    """Returns the list of fields for sentence-grouped examples.
+
+    text_field: Field used for the token ids of the sentence.
+    span_names: Names of the span fields, e.g. ['span1', 'span2'].
+    label_field: Optional RaggedField for labels (defaults to a raw integer label).
+    """
+    if label_field is None:
+        label_field = RaggedField(use_vocab=False)
+    fields = [('text', text_field)]
+    for span_name in span_names:
+        fields.append((span_name, RaggedField(use_vocab=False)))
+        fields.append(('orig_' + span_name, RaggedField(use_vocab=False)))
+    fields.append(('label', label_field))
+    fields.append(('sent_ids', SentenceIndexField()))
+    return fields
@@ -0,0 +1,452 @@
+"""Batched inference with a trained probe on raw text.
+
+Loads a saved probe (layer weights + span_net + label_net, or a constituent
+checkpoint), streams sentences from a file or stdin, batches them by a max-tokens
+budget and writes one JSON line of predictions per input line as it goes. Only
+chunk_size sentences are held in memory at a time.
+
+Input is either JSONL with a "text" field (whitespace tokenized) and optional
+"targets" as in the task data files, or plain text with one sentence per line.
+For NER, mention detection and constituent labeling, sentences without targets
+are tagged over all spans of up to max_width subword tokens which start and end at
+word boundaries. SRL and coreference need the (pairs of) spans in "targets".
+
+    python -m tasks.common.infer -task ner -model_path <model_dir>/best_models/model.pt \
+        -input sentences.txt -input_format text -output predictions.json
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+from os import path
+
+import torch
+import torch.nn as nn
+
+from encoders.pretrained_transformers import Encoder
+from encoders.pretrained_transformers.encoder import PRECISION_LIST
+from encoders.pretrained_transformers.device import setup_device
+from encoders.pretrained_transformers.span_enumeration import iter_all_span_reprs
+from tasks.common.binary_data import get_tokenized_span_indices
+from tasks.common.checkpoint import check_base_model, load_trainable_state_dict
+from tasks.common.sampler import TokenBudgetBatchSampler
+
+# Task -> (module, class) of the torchtext task models
+TASK_MODELS = {
+    'ner': ('tasks.ner.model', 'NERModel'),
+    'mention': ('tasks.mention_detection.model', 'TaskModel'),
+    'srl': ('tasks.srl.model', 'SRLModel'),
+    'coref': ('tasks.coref.model', 'CorefModel'),
+    'coref_fine_tune': ('tasks.coref.fine_tune.model', 'CorefModel'),
+}
+TASKS = list(TASK_MODELS) + ['constituent']
+# Tasks whose targets are a pair of spans
+PAIRWISE_TASKS = ['srl', 'coref', 'coref_fine_tune']
+# Tasks with named labels (the others predict a single probability)
+LABELED_TASKS = ['ner', 'srl', 'constituent']
+
+
+class Probe(nn.Module):
+    """Encoder with the span module(s) and the label net of a trained task model."""
+
+    def __init__(self, encoder, span_modules, label_net, label_list=None,
+                 just_last_layer=False, multi_label=False):
+        """
+        span_modules: One span module per span of a target, e.g. two for SRL.
+        label_list: Names of the outputs of label_net, None if it outputs a probability.
+        """
+        super(Probe, self).__init__()
+        self.encoder = encoder
+        self.span_modules = nn.ModuleList(span_modules)
+        self.label_net = label_net
+        self.label_list = label_list
+        self.just_last_layer = just_last_layer
+        self.multi_label = multi_label
+
+    def encode(self, batch_ids):
+        return self.encoder(batch_ids, just_last_layer=self.just_last_layer)
+
+    def predict(self, encoded_input, spans, sent_ids):
+        """
+        spans: N x (2 x # of span modules) subword spans (end inclusive).
+        sent_ids: Row of encoded_input of every target.
+        Returns: N x C label probabilities.
+        """
+        span_reprs = []
+        for idx, span_module in enumerate(self.span_modules):
+            span_reprs.append(span_module(encoded_input, spans[:, 2 * idx], spans[:, 2 * idx + 1],
+                                          sent_ids=sent_ids))
+        return self.label_net(torch.cat(span_reprs, dim=-1))
+
+    def predict_all(self, encoded_input, input_lens, max_width):
+        """
+        Generator over the label probabilities of all spans of up to max_width tokens.
+        Yields: (sent_ids, start_ids, end_ids, N x C probabilities), one chunk per width.
+        """
+        assert (len(self.span_modules) == 1)
+        for sent_ids, start_ids, end_ids, span_reprs in iter_all_span_reprs(
+                self.span_modules[0], encoded_input, input_lens, max_width,
+                start_shift=self.encoder.start_shift, end_shift=self.encoder.end_shift):
+            yield sent_ids, start_ids, end_ids, self.label_net(span_reprs)
+
+
+def read_label_list(label_file):
+    with open(label_file) as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def load_constituent_probe(args):
+    """Probe from a tasks.constituent.main checkpoint (<model_name>.ckpt)."""
+    from tasks.constituent.models import SpanClassifier
+
+    model_prefix = path.splitext(args.model_path)[0]
+    train_args = torch.load(model_prefix + '.args.pt')
+    if args.labels:
+        label_list = read_label_list(args.labels)
+    else:
+        # Label dict pickled alongside the data loaders
+        loader_path = model_prefix + '.loader.pt'
+        if not path.exists(loader_path):
+            loader_path = model_prefix + '.sent.loader.pt'
+        label_dict = torch.load(loader_path)['label_dict']
+        label_list = sorted(label_dict, key=lambda label: label_dict[label])
+
+    encoder = Encoder(train_args.model_type, train_args.model_size, train_args.cased,
+                      use_proj=False, dtype=args.dtype, window_size=args.window_size,
+                      window_stride=args.window_stride,
+                      layers=getattr(train_args, 'layers', None), unpad=args.unpad)
+    model = SpanClassifier(
+        encoder, train_args.use_proj, train_args.proj_dim, train_args.hidden_dims,
+        len(label_list), pooling_method=train_args.encoding_method,
+        segment_pooling=getattr(train_args, 'segment_pooling', False))
+
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    check_base_model(checkpoint, encoder)
+    # The layer weights are part of the encoder state
+    if checkpoint['best_model'] is not None:
+        load_trainable_state_dict(model, checkpoint['best_model'])
+        load_trainable_state_dict(encoder, checkpoint['best_encoder'])
+    else:
+        load_trainable_state_dict(model, checkpoint['model'])
+        load_trainable_state_dict(encoder, checkpoint['encoder'])
+
+    return Probe(encoder, [model.span_repr], model.mlp, label_list=label_list,
+                 multi_label=True)
+
+
+def load_task_probe(args):
+    """Builds the task model described by args and loads the saved probe into it."""
+    label_list = None
+    if args.task in LABELED_TASKS:
+        # Written by final_eval of the task next to the best_models directory
+        label_file = args.labels
+        if label_file is None:
+            label_file = path.join(path.dirname(path.dirname(args.model_path)), "labels.txt")
+        label_list = read_label_list(label_file)
+
+    module_name, class_name = TASK_MODELS[args.task]
+    model_class = getattr(importlib.import_module(module_name), class_name)
+    model_kwargs = {'span_dim': args.span_dim, 'pool_method': args.pool_method,
+                    'segment_pooling': args.segment_pooling,
+                    'just_last_layer': args.just_last_layer, 'no_proj': args.no_proj,
+                    'dtype': args.dtype, 'window_size': args.window_size,
+                    'window_stride': args.window_stride, 'layers': args.layers,
+                    'unpad': args.unpad}
+    if args.task.startswith('coref'):
+        model = model_class(model=args.model, model_size=args.model_size, **model_kwargs)
+    else:
+        encoder = Encoder(model=args.model, model_size=args.model_size, cased=True,
+                          dtype=args.dtype, window_size=args.window_size,
+                          window_stride=args.window_stride, layers=args.layers,
+                          unpad=args.unpad)
+        num_labels = (len(label_list) if label_list is not None else 1)
+        model = model_class(encoder, num_labels=num_labels, **model_kwargs)
+
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    model.span_net.load_state_dict(checkpoint['span_net'])
+    model.label_net.load_state_dict(checkpoint['label_net'])
+    model.encoder.weighing_params.data = checkpoint['weighing_params'].data
+    check_base_model(checkpoint, model.encoder)
+    if 'encoder' in checkpoint:
+        # Trainable (i.e. fine-tuned) parameters of the pretrained model, if any
+        load_trainable_state_dict(model.encoder.model, checkpoint['encoder'])
+
+    if args.task in PAIRWISE_TASKS:
+        # Coreference shares the span module between the two spans
+        span_modules = [model.span_net['0'],
+                        model.span_net['1' if model.num_spans > 1 else '0']]
+    else:
+        span_modules = [model.span_net['0']]
+    return Probe(model.encoder, span_modules, model.label_net, label_list=label_list,
+                 just_last_layer=getattr(model, 'just_last_layer', False))
+
+
+def load_probe(args):
+    """Loads the saved probe of the task, with a dynamic int8 encoder if asked for."""
+    if args.task == 'constituent':
+        probe = load_constituent_probe(args)
+    else:
+        probe = load_task_probe(args)
+
+    if args.quantized_model:
+        probe.encoder.load_quantized(args.quantized_model)
+    elif args.quantize:
+        probe.encoder.quantize()
+    return probe
+
+
+def read_instances(input_file, input_format):
+    """Generator over the instances (dicts with a "text" field) of the input."""
+    for line in input_file:
+        if input_format == 'text':
+            if line.strip():
+                yield {"text": line.strip()}
+        elif line.strip():
+            yield json.loads(line)
+
+
+def iter_chunks(instances, chunk_size):
+    chunk = []
+    for instance in instances:
+        chunk.append(instance)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_prediction(probe, scores, threshold):
+    """Returns the prediction fields of a target from its label probabilities (C,)."""
+    if probe.label_list is None:
+        return {'pred_label': bool(scores[0] > threshold), 'score': float(scores[0])}
+    if probe.multi_label:
+        return {'pred_label': [probe.label_list[idx] for idx, score in enumerate(scores)
+                               if score > threshold],
+                'score': [float(score) for score in scores]}
+    best_idx = max(range(len(scores)), key=lambda idx: scores[idx])
+    return {'pred_label': probe.label_list[best_idx], 'score': float(scores[best_idx])}
+
+
+def get_word_boundaries(subword_to_word_idx):
+    """Masks of the subwords which start and end a word respectively."""
+    padded_idx = [-1] + subword_to_word_idx + [-1]
+    is_start = [(padded_idx[i] != -1 and padded_idx[i] != padded_idx[i - 1])
+                for i in range(1, len(padded_idx) - 1)]
+    is_end = [(padded_idx[i] != -1 and padded_idx[i] != padded_idx[i + 1])
+              for i in range(1, len(padded_idx) - 1)]
+    return is_start, is_end
+
+
+def tag_all_spans(probe, encoded_input, input_lens, sentences, outputs, batch, args):
+    """Adds the spans (word aligned, above threshold) of every sentence to its output."""
+    max_len = encoded_input.shape[1]
+    device = encoded_input.device
+    is_start = torch.zeros(len(batch), max_len, dtype=torch.bool)
+    is_end = torch.zeros(len(batch), max_len, dtype=torch.bool)
+    for row, idx in enumerate(batch):
+        sent_is_start, sent_is_end = get_word_boundaries(sentences[idx][1])
+        is_start[row, :len(sent_is_start)] = torch.tensor(sent_is_start)
+        is_end[row, :len(sent_is_end)] = torch.tensor(sent_is_end)
+    is_start, is_end = is_start.to(device), is_end.to(device)
+
+    for sent_ids, start_ids, end_ids, probs in probe.predict_all(
+            encoded_input, input_lens, args.max_width):
+        keep = (is_start[sent_ids, start_ids] & is_end[sent_ids, end_ids]
+                & (torch.max(probs, dim=1)[0] > args.threshold))
+        for sent_id, start_idx, end_idx, scores in zip(
+                sent_ids[keep].tolist(), start_ids[keep].tolist(), end_ids[keep].tolist(),
+                probs[keep].tolist()):
+            subword_to_word_idx = sentences[batch[sent_id]][1]
+            target = {'span1': [subword_to_word_idx[start_idx], subword_to_word_idx[end_idx] + 1]}
+            target.update(get_prediction(probe, scores, args.threshold))
+            outputs[batch[sent_id]]['targets'].append(target)
+
+
+def tag_targets(probe, encoded_input, sentences, outputs, batch, args):
+    """Adds the predictions of the given targets of every sentence to its output."""
+    spans, sent_ids = [], []
+    for row, idx in enumerate(batch):
+        spans.extend(sentences[idx][2])
+        sent_ids.extend([row] * len(sentences[idx][2]))
+    if not spans:
+        return
+    device = encoded_input.device
+    probs = probe.predict(encoded_input, torch.tensor(spans, device=device),
+                          torch.tensor(sent_ids, device=device)).tolist()
+
+    offset = 0
+    for idx in batch:
+        for target in outputs[idx]['targets']:
+            target.update(get_prediction(probe, probs[offset], args.threshold))
+            offset += 1
+
+
+def process_chunk(probe, chunk, args):
+    """Returns the list of outputs of the chunk of instances, in input order."""
+    encoder = probe.encoder
+    device = encoder.device
+    span_names = ['span1', 'span2'][:len(probe.span_modules)]
+    # Longer sentences can only be encoded in windows
+    max_len = getattr(encoder.tokenizer, 'max_len', 512)
+    if encoder.window_size is not None:
+        max_len = float('inf')
+
+    outputs = []
+    # (token ids, subword to word indices, subword spans of the targets) of every sentence
+    sentences = []
+    for instance in chunk:
+        output = dict(instance)
+        words = instance["text"]
+        if isinstance(words, str):
+            words = words.split()
+        token_ids, subword_to_word_idx = encoder.tokenize(words, get_subword_indices=True)
+
+        if len(token_ids) > max_len:
+            output['error'] = "Sentence has %d tokens, more than the max of %d" % (
+                len(token_ids), max_len)
+            token_ids = []
+        targets = [dict(target) for target in instance.get("targets", [])]
+        spans = []
+        if token_ids:
+            try:
+                for target in targets:
+                    span_row = []
+                    for span_name in span_names:
+                        span_row += get_tokenized_span_indices(subword_to_word_idx,
+                                                               target[span_name])
+                    spans.append(span_row)
+            except ValueError:
+                output['error'] = "Target span %s doesn't align to the words" % (
+                    target[span_name],)
+                token_ids, spans = [], []
+        output['targets'] = targets
+
+        outputs.append(output)
+        sentences.append((token_ids, subword_to_word_idx, spans))
+
+    # Sentences with given targets are tagged on them, the others over all spans
+    tag_all = [(not spans) and ("targets" not in instance) and len(probe.span_modules) == 1
+               for instance, (_, _, spans) in zip(chunk, sentences)]
+    valid = [idx for idx, (token_ids, _, spans) in enumerate(sentences)
+             if token_ids and (spans or tag_all[idx])]
+    batch_sampler = TokenBudgetBatchSampler(
+        [len(sentences[idx][0]) for idx in valid], args.max_tokens,
+        max_batch_size=args.max_batch_size)
+    pad_id = encoder.tokenizer.pad_token_id
+    for batch in batch_sampler:
+        batch = [valid[idx] for idx in batch]
+        batch_len = max([len(sentences[idx][0]) for idx in batch])
+        batch_ids = torch.tensor(
+            [sentences[idx][0] + [pad_id] * (batch_len - len(sentences[idx][0]))
+             for idx in batch], device=device)
+        encoded_input = probe.encode(batch_ids)
+
+        given_batch = [idx for idx in batch if not tag_all[idx]]
+        if given_batch:
+            if len(given_batch) < len(batch):
+                rows = torch.tensor([batch.index(idx) for idx in given_batch], device=device)
+                tag_targets(probe, encoded_input[rows], sentences, outputs, given_batch, args)
+            else:
+                tag_targets(probe, encoded_input, sentences, outputs, batch, args)
+
+        all_batch = [idx for idx in batch if tag_all[idx]]
+        if all_batch:
+            rows = torch.tensor([batch.index(idx) for idx in all_batch], device=device)
+            input_lens = torch.tensor([len(sentences[idx][0]) for idx in all_batch],
+                                      device=device)
+            tag_all_spans(probe, encoded_input[rows], input_lens, sentences, outputs,
+                          all_batch, args)
+
+    return outputs
+
+
+def add_probe_args(parser):
+    """Arguments which describe the saved probe and where it runs."""
+    parser.add_argument("-task", type=str, required=True, choices=TASKS)
+    parser.add_argument("-model_path", type=str, required=True,
+                        help="best_models/model.pt of a task, or the .ckpt of constituent.")
+    parser.add_argument("-labels", type=str, default=None,
+                        help="File with one label per line. Defaults to the labels.txt "
+                        "written by the task (or the label dict of the constituent loader).")
+    parser.add_argument("-model", type=str, default="bert")
+    parser.add_argument("-model_size", type=str, default="base")
+    parser.add_argument("-span_dim", type=int, default=256)
+    parser.add_argument("-pool_method", default="avg", type=str)
+    parser.add_argument("-segment_pooling", default=False, action="store_true")
+    parser.add_argument("-just_last_layer", default=False, action="store_true")
+    parser.add_argument("-no_proj", default=False, action="store_true")
+    parser.add_argument("-dtype", default="fp32", type=str, choices=PRECISION_LIST,
+                        help="Precision of the pretrained model. The span heads stay in fp32.")
+    parser.add_argument("-layers", default=None, type=int, nargs='+',
+                        help="Encoder layers the probe was trained with. Defaults to all.")
+    parser.add_argument("-unpad", default=False, action="store_true",
+                        help="Run the SpanBERT layers without the padding tokens.")
+    parser.add_argument("-window_size", default=None, type=int,
+                        help="Encode sentences longer than this many subwords in windows.")
+    parser.add_argument("-window_stride", default=None, type=int,
+                        help="Subwords between the starts of consecutive windows.")
+    parser.add_argument("-quantize", default=False, action="store_true",
+                        help="Convert the linear layers of the encoder to dynamic int8 (CPU only).")
+    parser.add_argument("-quantized_model", type=str, default=None,
+                        help="Encoder saved by tasks.common.quantize, loaded instead of quantizing.")
+    parser.add_argument("-device", default=None, type=str,
+                        help="Device to run on, e.g. cpu or cuda. Defaults to cuda if available.")
+    parser.add_argument("-num_threads", default=None, type=int,
+                        help="Number of intra-op threads on CPU.")
+    parser.add_argument("-num_interop_threads", default=None, type=int,
+                        help="Number of inter-op threads on CPU.")
+    parser.add_argument("-pin_threads", default=False, action="store_true",
+                        help="Pin the CPU threads to a fixed set of cores.")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_probe_args(parser)
+    parser.add_argument("-input", type=str, default="-", help="Input file, - for stdin.")
+    parser.add_argument("-input_format", type=str, default="jsonl", choices=["jsonl", "text"])
+    parser.add_argument("-output", type=str, default="-", help="Output file, - for stdout.")
+    parser.add_argument("-max_tokens", type=int, default=4096,
+                        help="Max number of (padded) tokens in a batch.")
+    parser.add_argument("-max_batch_size", type=int, default=None)
+    parser.add_argument("-chunk_size", type=int, default=10000,
+                        help="Number of sentences read (and kept in memory) at a time.")
+    parser.add_argument("-max_width", type=int, default=10,
+                        help="Max width (in subword tokens) of the spans tagged in raw text.")
+    parser.add_argument("-threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    device = setup_device(args.device, num_threads=args.num_threads,
+                          num_interop_threads=args.num_interop_threads,
+                          pin_threads=args.pin_threads)
+    if (args.quantize or args.quantized_model) and device.type != 'cpu':
+        parser.error("Quantized models only run on CPU")
+    probe = load_probe(args).to(device)
+    probe.eval()
+
+    input_file = (sys.stdin if args.input == "-" else open(args.input, encoding="utf-8"))
+    output_file = (sys.stdout if args.output == "-" else open(args.output, 'w'))
+
+    start_time = time.time()
+    num_sentences = 0
+    with torch.no_grad():
+        for chunk in iter_chunks(read_instances(input_file, args.input_format),
+                                 args.chunk_size):
+            for output in process_chunk(probe, chunk, args):
+                output_file.write(json.dumps(output) + "\n")
+            output_file.flush()
+
+            num_sentences += len(chunk)
+            logging.info("Tagged %d sentences (%.1f sentences/s)"
+                         % (num_sentences, num_sentences / (time.time() - start_time)))
+
+    if input_file is not sys.stdin:
+        input_file.close()
+    if output_file is not sys.stdout:
+        output_file.close()
+
+
+if __name__ == '__main__':
+    main()
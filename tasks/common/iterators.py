@@ -0,0 +1,50 @@
+"""torchtext iterator which batches with a TokenBudgetBatchSampler."""
+import random
+import itertools
+
+import torchtext.data as data
+
+from tasks.common.sampler import TokenBudgetBatchSampler
+
+
+class TokenBudgetIterator(data.Iterator):
+    def __init__(self, dataset, max_tokens, max_batch_size=None, packed=False, **kwargs):
+        """
+        dataset: torchtext Dataset whose sort_key gives the length of an example.
+        max_tokens: Max number of tokens in a padded batch.
+        packed: The budget is on the total # of tokens since the encoder packs the batch.
+        Remaining arguments are passed on to torchtext's Iterator.
+        """
+        kwargs['sort'] = False
+        super(TokenBudgetIterator, self).__init__(dataset, max_tokens, **kwargs)
+        if hasattr(dataset.examples, 'get_lengths'):
+            # Lazily built examples (LazyExamples) know their lengths
+            lengths = dataset.examples.get_lengths()
+        else:
+            lengths = [dataset.sort_key(example) for example in dataset.examples]
+        self.batch_sampler = TokenBudgetBatchSampler(
+            lengths, max_tokens, shuffle=self.shuffle, max_batch_size=max_batch_size,
+            packed=packed)
+
+    def create_batches(self):
+        if self.shuffle:
+            # Draw the seed from torchtext's random state, so that restoring the
+            # state of the iterator also restores its batches
+            with self.random_shuffler.use_internal_state():
+                self.batch_sampler.set_epoch(random.getrandbits(31))
+        # torchtext fast-forwards a restored iterator by drawing the batches before the
+        # restored position, so seek past them instead of building them
+        num_skipped = self._iterations_this_epoch if self._restored_from_state else 0
+        self.batch_sampler.seek(num_skipped)
+        self.batches = itertools.chain(
+            [None] * num_skipped,
+            ([self.dataset[idx] for idx in batch] for batch in self.batch_sampler))
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    @classmethod
+    def splits(cls, datasets, max_tokens, **kwargs):
+        """Create iterators for the splits. Only the first one (train) is shuffled."""
+        return tuple(cls(dataset, max_tokens, train=(idx == 0), shuffle=(idx == 0), **kwargs)
+                     for idx, dataset in enumerate(datasets))
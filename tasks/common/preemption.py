@@ -0,0 +1,64 @@
+"""Checkpointing on preemption.
+
+Schedulers of preemptible queues signal a job before killing it (e.g. SLURM sends
+SIGTERM, or SIGUSR1 with --signal). The handler only records the request; the trainer
+checks it after every (accumulated) batch, writes a checkpoint with the position in the
+training data and the RNG states, and exits, so the requeued job resumes where it
+stopped instead of at the last eval.
+"""
+import random
+import signal
+import logging
+
+import numpy as np
+import torch
+
+
+class PreemptionHandler(object):
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGUSR1)):
+        self.signals = signals
+        self.requested = False
+
+    def install(self):
+        """Install the signal handlers. Must be called from the main thread."""
+        for signum in self.signals:
+            signal.signal(signum, self.handle)
+
+    def handle(self, signum, frame):
+        logging.info("Received %s, checkpointing after the current batch"
+                     % signal.Signals(signum).name)
+        self.requested = True
+
+
+def get_rng_states():
+    """States of the python, numpy, torch and cuda RNGs."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': (torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None),
+    }
+
+
+def set_rng_states(rng_states):
+    random.setstate(rng_states['python'])
+    np.random.set_state(rng_states['numpy'])
+    torch.set_rng_state(rng_states['torch'])
+    if torch.cuda.is_available() and rng_states['cuda'] is not None:
+        torch.cuda.set_rng_state_all(rng_states['cuda'])
+
+
+# unit test
+if __name__ == '__main__':
+    import os
+
+    handler = PreemptionHandler()
+    handler.install()
+    os.kill(os.getpid(), signal.SIGUSR1)
+    assert handler.requested
+
+    rng_states = get_rng_states()
+    expected = (random.random(), np.random.rand(), torch.rand(1).item())
+    set_rng_states(rng_states)
+    assert (random.random(), np.random.rand(), torch.rand(1).item()) == expected
+    print("OK")
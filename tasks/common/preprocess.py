@@ -0,0 +1,79 @@
+"""Parallel tokenization of the JSONL task data.
+
+Every line (a sentence with "text" and "targets") is parsed, tokenized and its word
+spans are aligned to subword spans independently, so the lines are sharded over a
+process pool. Pool.imap returns the results in the original line order, hence the
+output does not depend on the number of workers.
+"""
+import json
+from multiprocessing import Pool
+
+# Max number of span fields of a target
+SPAN_NAMES = ['span1', 'span2']
+
+# Tokenizer of a worker process, set by init_worker
+_worker_tokenizer = None
+
+
+def get_subword_span(word_offsets, orig_span_indices):
+    """Maps a word span (end exclusive) to the subword span (end inclusive)."""
+    orig_start_idx, orig_end_idx = orig_span_indices
+    return [int(word_offsets[orig_start_idx]), int(word_offsets[orig_end_idx]) - 1]
+
+
+def process_line(line, word_tokenizer):
+    """
+    Parses and tokenizes a line of a JSONL file.
+    word_tokenizer: CachedWordTokenizer of the encoder.
+
+    Returns: (token_ids, targets) where every target is the list
+        [span, orig_span, ..., label] with the subword (end inclusive) and the word
+        span for each of its spans, followed by its raw label.
+    """
+    instance = json.loads(line)
+    token_ids, word_offsets = word_tokenizer.tokenize_words(instance["text"].split())
+    targets = []
+    for target in instance["targets"]:
+        processed_target = []
+        for span_name in SPAN_NAMES:
+            if span_name in target:
+                processed_target += [get_subword_span(word_offsets, target[span_name]),
+                                     target[span_name]]
+        processed_target.append(target["label"])
+        targets.append(processed_target)
+    return token_ids, targets
+
+
+def init_worker(word_tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = word_tokenizer
+
+
+def process_line_in_worker(line):
+    return process_line(line, _worker_tokenizer)
+
+
+def take_targets(sentences, num_targets):
+    """
+    First num_targets targets of the process_line outputs of the sentences, with their
+    sentences. The last sentence may keep only some of its targets.
+    """
+    taken = []
+    for token_ids, targets in sentences:
+        if num_targets <= 0:
+            break
+        taken.append((token_ids, targets[:num_targets]))
+        num_targets -= len(targets)
+    return taken
+
+
+def preprocess_lines(lines, word_tokenizer, num_workers=1, chunksize=256):
+    """
+    Returns the list of process_line outputs of all lines, in order.
+    num_workers: Number of processes. With 1 the lines are processed in this process.
+    chunksize: Number of lines sent to a worker at a time.
+    """
+    if num_workers <= 1:
+        return [process_line(line, word_tokenizer) for line in lines]
+    with Pool(num_workers, initializer=init_worker, initargs=(word_tokenizer,)) as pool:
+        return list(pool.imap(process_line_in_worker, lines, chunksize=chunksize))
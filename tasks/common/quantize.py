@@ -0,0 +1,107 @@
+"""Dynamic int8 quantization of the frozen encoder of a trained probe.
+
+Only the span module(s) and label net of a probe are trained, so the linear layers of
+the frozen pretrained model can be converted to dynamic int8 ones for CPU serving. The
+quantized encoder is saved for tasks.common.infer -quantized_model, and the predictions
+of the fp32 and the int8 probe on the targets of the dev set are compared.
+
+    python -m tasks.common.quantize -task ner -model_path <model_dir>/best_models/model.pt \
+        -dev_file data/development.json -output <model_dir>/best_models/encoder.int8.pt
+"""
+import os
+import time
+import logging
+import argparse
+
+import torch
+
+from encoders.pretrained_transformers.device import setup_device
+from tasks.common.infer import (
+    add_probe_args, load_probe, read_instances, iter_chunks, process_chunk)
+
+
+def is_correct(probe, pred_label, label):
+    """Whether the prediction of a target matches its gold label."""
+    if probe.label_list is None:
+        return pred_label == bool(int(label))
+    if probe.multi_label:
+        return set(pred_label) == set(label if isinstance(label, list) else [label])
+    return pred_label == label
+
+
+def predict(probe, instances, args):
+    """Returns the list of outputs of the instances, and the # of sentences per second."""
+    start_time = time.time()
+    outputs = []
+    with torch.no_grad():
+        for chunk in iter_chunks(instances, args.chunk_size):
+            outputs.extend(process_chunk(probe, chunk, args))
+    return outputs, len(instances) / (time.time() - start_time)
+
+
+def compare(probe, instances, fp32_outputs, int8_outputs):
+    """Returns the fp32 and int8 accuracies on the targets, and their agreement."""
+    num_targets = fp32_correct = int8_correct = num_agree = num_skipped = 0
+    for instance, fp32_output, int8_output in zip(instances, fp32_outputs, int8_outputs):
+        if 'error' in fp32_output or 'error' in int8_output:
+            # e.g. sentences over the position limit, whose targets aren't tagged
+            num_skipped += 1
+            continue
+        for target, fp32_target, int8_target in zip(
+                instance["targets"], fp32_output["targets"], int8_output["targets"]):
+            num_targets += 1
+            fp32_correct += is_correct(probe, fp32_target['pred_label'], target["label"])
+            int8_correct += is_correct(probe, int8_target['pred_label'], target["label"])
+            num_agree += (fp32_target['pred_label'] == int8_target['pred_label'])
+    if num_skipped:
+        logging.info("Skipped %d sentences which couldn't be tagged" % num_skipped)
+    num_targets = max(num_targets, 1)
+    return fp32_correct / num_targets, int8_correct / num_targets, num_agree / num_targets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_probe_args(parser)
+    parser.add_argument("-dev_file", type=str, required=True,
+                        help="JSONL file with gold targets, e.g. the development split.")
+    parser.add_argument("-output", type=str, required=True,
+                        help="Path of the quantized encoder.")
+    parser.add_argument("-max_tokens", type=int, default=4096,
+                        help="Max number of (padded) tokens in a batch.")
+    parser.add_argument("-max_batch_size", type=int, default=None)
+    parser.add_argument("-chunk_size", type=int, default=10000)
+    parser.add_argument("-threshold", type=float, default=0.5)
+    args = parser.parse_args()
+    if args.device not in [None, 'cpu']:
+        parser.error("Quantized models only run on CPU")
+    # The fp32 probe is the reference
+    args.quantize, args.quantized_model = False, None
+    # Only the given targets are tagged
+    args.max_width = 0
+
+    setup_device('cpu', num_threads=args.num_threads,
+                 num_interop_threads=args.num_interop_threads, pin_threads=args.pin_threads)
+    probe = load_probe(args)
+    probe.eval()
+
+    with open(args.dev_file, encoding="utf-8") as f:
+        instances = [instance for instance in read_instances(f, 'jsonl')
+                     if instance.get("targets")]
+
+    fp32_outputs, fp32_speed = predict(probe, instances, args)
+    probe.encoder.quantize()
+    int8_outputs, int8_speed = predict(probe, instances, args)
+
+    probe.encoder.save_quantized(args.output)
+    logging.info("Saved the quantized encoder to %s (%.1f MB)"
+                 % (args.output, os.path.getsize(args.output) / 2 ** 20))
+
+    fp32_acc, int8_acc, agreement = compare(probe, instances, fp32_outputs, int8_outputs)
+    logging.info("Dev accuracy: fp32 %.4f, int8 %.4f, delta %+.4f"
+                 % (fp32_acc, int8_acc, int8_acc - fp32_acc))
+    logging.info("Predictions unchanged: %.4f" % agreement)
+    logging.info("Speed: fp32 %.1f sentences/s, int8 %.1f sentences/s" % (fp32_speed, int8_speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Seekable batch samplers, incl. a length-bucketed one with a max-tokens budget.
+
+The batches of an epoch only depend on the seed and the epoch, so the position of a
+sampler is saved as (epoch, seed, cursor) with cursor the # of batches of the epoch
+already consumed, and restored by starting the epoch at the cursor, without drawing
+(or collating) the batches before it.
+
+TokenBudgetBatchSampler: Examples of the same length form a bucket. Examples are sorted
+by length, shuffled within their bucket, and greedily packed into batches whose padded
+size (batch size x length of the longest example) stays within the token budget, or,
+when the examples of a batch are packed into rows by the encoder, whose total # of
+tokens does. The order of the batches is shuffled as well. Since the batches are packed
+in sorted order, their number (and sizes) is the same in every epoch.
+"""
+import random
+
+from torch.utils.data import Sampler
+
+
+class SeekableBatchSampler(Sampler):
+    def __init__(self, shuffle=False, seed=0):
+        """
+        shuffle: Shuffle the batches of every epoch.
+        seed: Random seed. The batches of an epoch depend on seed + epoch.
+        """
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.cursor = 0
+
+    def get_batches(self):
+        """Returns the list of batches (lists of example indices) of the current epoch."""
+        raise NotImplementedError
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.cursor = 0
+
+    def seek(self, cursor):
+        """Start the next iteration over the epoch at its cursor-th batch."""
+        self.cursor = cursor
+
+    def state_dict(self, cursor):
+        """
+        cursor: # of batches of the current epoch consumed by the trainer. The sampler
+            can't count them itself since a DataLoader draws batches ahead.
+        """
+        return {'epoch': self.epoch, 'seed': self.seed, 'cursor': cursor}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.set_epoch(state_dict['epoch'])
+        self.seek(state_dict['cursor'])
+
+    def __iter__(self):
+        batches = self.get_batches()[self.cursor:]
+        # Later iterations start at the beginning of the epoch again
+        self.cursor = 0
+        return iter(batches)
+
+
+class ShuffledBatchSampler(SeekableBatchSampler):
+    def __init__(self, num_examples, batch_size, shuffle=False, seed=0):
+        """Batches of batch_size consecutive examples of a (seeded) permutation."""
+        super(ShuffledBatchSampler, self).__init__(shuffle=shuffle, seed=seed)
+        self.num_examples = num_examples
+        self.batch_size = batch_size
+
+    def get_batches(self):
+        order = list(range(self.num_examples))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return [order[offset: offset + self.batch_size]
+                for offset in range(0, self.num_examples, self.batch_size)]
+
+    def __len__(self):
+        return (self.num_examples + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(SeekableBatchSampler):
+    def __init__(self, lengths, max_tokens, shuffle=False, max_batch_size=None, seed=0,
+                 packed=False):
+        """
+        lengths: Length (# of tokens) of every example.
+        max_tokens: Max number of tokens in a padded batch. An example longer than the
+            budget forms a batch of its own.
+        shuffle: Shuffle within length buckets and shuffle the batch order.
+        max_batch_size: Optional cap on the number of examples in a batch.
+        seed: Random seed. The batches of an epoch depend on seed + epoch.
+        packed: The examples are packed (see Encoder.pack), so the budget is on the sum of
+            their lengths instead of the padded size.
+        """
+        super(TokenBudgetBatchSampler, self).__init__(shuffle=shuffle, seed=seed)
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.packed = packed
+
+        self.batch_sizes = self.get_batch_sizes()
+
+    def get_batch_sizes(self):
+        batch_sizes = []
+        cur_size = cur_tokens = 0
+        for length in sorted(self.lengths):
+            if self.packed:
+                num_tokens = cur_tokens + length
+            else:
+                # Examples come in increasing length, so the current one sets the padded length
+                num_tokens = (cur_size + 1) * length
+            if cur_size > 0 and (num_tokens > self.max_tokens
+                                 or cur_size == self.max_batch_size):
+                batch_sizes.append(cur_size)
+                cur_size = cur_tokens = 0
+            cur_size += 1
+            cur_tokens += length
+        if cur_size > 0:
+            batch_sizes.append(cur_size)
+        return batch_sizes
+
+    def get_batches(self):
+        if self.shuffle:
+            rng = random.Random(self.seed + self.epoch)
+            # Random tie breaking shuffles the examples within each length bucket
+            tie_breaker = [rng.random() for _ in self.lengths]
+            order = sorted(range(len(self.lengths)),
+                           key=lambda idx: (self.lengths[idx], tie_breaker[idx]))
+        else:
+            order = sorted(range(len(self.lengths)), key=lambda idx: self.lengths[idx])
+
+        batches = []
+        offset = 0
+        for batch_size in self.batch_sizes:
+            batches.append(order[offset: offset + batch_size])
+            offset += batch_size
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        return len(self.batch_sizes)
+
+
+# unit test
+if __name__ == '__main__':
+    lengths = [random.randint(5, 120) for _ in range(1000)]
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=1024, shuffle=True)
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(idx for batch in batches for idx in batch) == list(range(len(lengths)))
+        assert all(len(batch) * max(lengths[idx] for idx in batch) <= 1024 for batch in batches)
+        num_tokens = sum(lengths)
+        num_padded = sum(len(batch) * max(lengths[idx] for idx in batch) for batch in batches)
+        print("Epoch %d: %d batches, padding ratio %.3f"
+              % (epoch, len(batches), num_padded / num_tokens - 1))
+
+    packed_sampler = TokenBudgetBatchSampler(lengths, max_tokens=1024, shuffle=True, packed=True)
+    batches = list(packed_sampler)
+    assert all(sum(lengths[idx] for idx in batch) <= 1024 for batch in batches)
+    print("Packed: %d batches" % len(batches))
+
+    # Resuming from the state after 10 batches gives the rest of the epoch
+    for batch_sampler in [sampler, ShuffledBatchSampler(len(lengths), 32, shuffle=True)]:
+        batch_sampler.set_epoch(3)
+        batches = list(batch_sampler)
+        state_dict = batch_sampler.state_dict(10)
+        batch_sampler.set_epoch(0)
+        batch_sampler.load_state_dict(state_dict)
+        assert list(batch_sampler) == batches[10:]
+        assert list(batch_sampler) == batches
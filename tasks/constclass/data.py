@@ -1,51 +1,124 @@
 
-import json
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
-from tasks.constclass.utils import convert_word_to_subword
+from tasks.common.binary_data import BinarySplit
+from tasks.common.preprocess import preprocess_lines
 
 
 class ConstituentDataset(Dataset):
     label_dict = dict()
     encoder = None
+    # defaults for datasets pickled in older .loader.pt files
+    binary_split = None
+    sentences = None
 
-    def __init__(self, path, encoder):
+    def __init__(self, path, encoder, group_by_sentence=False, binary=False,
+            num_workers=1):
+        """group_by_sentence: If True, each item is a sentence with all of its spans,
+            to be batched with collate_sentences_fn.
+            binary: If True, path is a split directory written by tasks.common.binary_data,
+            which is read lazily.
+            num_workers: Number of processes which tokenize the JSON file."""
         super(ConstituentDataset, self).__init__()
-        raw_data = [json.loads(line) for line in open(path)]
+        self.group_by_sentence = group_by_sentence
         self.set_encoder(encoder)
-        # preprocess
+        self.binary_split = None
+        if binary:
+            self.load_binary(path)
+            return
+        with open(path) as f:
+            lines = f.readlines()
+        # preprocess: the tokens of a sentence are stored once in self.sentences
+        # and the items only refer to them by index
         self.data = list()
-        for sentence in raw_data:
-            text = sentence['text']
-            tokenized_input, subword2word = encoder.tokenize_sentence(
-                text, get_subword_indices=True, force_split=True)
-            start_ids, end_ids = convert_word_to_subword(
-                subword2word,
-                torch.tensor([
-                    item['span1'] for item in sentence['targets']
-                ]).long().view(-1, 2),
-                encoder.start_shift
-            )
-            tokenized_span_ranges = torch.cat(
-                (start_ids.view(-1, 1), end_ids.view(-1, 1)), dim=1)
-            for i, item in enumerate(sentence['targets']):
-                label = item['label']
-                self.add_label(label)
+        self.sentences = list()
+        for token_ids, targets in preprocess_lines(
+                lines, encoder.word_tokenizer, num_workers=num_workers):
+            if len(targets) == 0:
+                continue
+            tokenized_input = torch.tensor(token_ids).long().view(1, -1)
+            # end index of the subword span is exclusive
+            tokenized_span_ranges = torch.tensor([
+                [span[0], span[1] + 1] for span, _, _ in targets
+            ]).long().view(-1, 2)
+            sent_idx = len(self.sentences)
+            self.sentences.append(tokenized_input)
+            if group_by_sentence:
+                labels = list()
+                for _, _, label in targets:
+                    self.add_label(label)
+                    labels.append(self.label_dict[label])
                 self.data.append(
                     {
-                        'text_ids': tokenized_input.cpu(),
-                        'span': tokenized_span_ranges[i].view(1, -1).cpu(),
-                        'label': self.label_dict[label]
+                        'sent_idx': sent_idx,
+                        'span': tokenized_span_ranges.cpu(),
+                        'label': labels
                     }
                 )
+            else:
+                for i, (_, _, label) in enumerate(targets):
+                    self.add_label(label)
+                    self.data.append(
+                        {
+                            'sent_idx': sent_idx,
+                            'span': tokenized_span_ranges[i].view(1, -1).cpu(),
+                            'label': self.label_dict[label]
+                        }
+                    )
                 
+    def load_binary(self, path):
+        self.binary_split = binary_split = BinarySplit(path)
+        assert binary_split.model_name == self.encoder.model_name
+        # labels.json lists the labels in the order of their first occurrence
+        for label in binary_split.label_list:
+            self.add_label(label)
+        self.label_map = np.array(
+            [self.label_dict[label] for label in binary_split.label_list], dtype=np.int64)
+        if self.group_by_sentence:
+            self.item_sent_ids = np.nonzero(binary_split.get_num_targets())[0]
+        else:
+            self.item_sent_ids = binary_split.get_target_sent_ids()
+
+    def get_binary_item(self, index):
+        binary_split = self.binary_split
+        sent_idx = self.item_sent_ids[index]
+        text_ids = torch.tensor(binary_split.get_text(sent_idx)).long().view(1, -1)
+        if self.group_by_sentence:
+            targets = slice(binary_split.target_offsets[sent_idx],
+                            binary_split.target_offsets[sent_idx + 1])
+        else:
+            targets = slice(index, index + 1)
+        # binary spans have an inclusive end
+        spans = torch.from_numpy(binary_split.spans[targets].astype(np.int64))
+        spans[:, 1] += 1
+        labels = self.label_map[binary_split.labels[targets]].tolist()
+        if self.group_by_sentence:
+            return text_ids, spans, labels
+        return text_ids, spans, labels[0]
+
     def __len__(self):
+        if self.binary_split is not None:
+            return len(self.item_sent_ids)
         return len(self.data)
     
     def __getitem__(self, index):
-        return self.data[index]['text_ids'], self.data[index]['span'], \
-            self.data[index]['label']
+        if self.binary_split is not None:
+            return self.get_binary_item(index)
+        item = self.data[index]
+        if self.sentences is None:
+            # older pickled datasets store the tokens in every item
+            return item['text_ids'], item['span'], item['label']
+        return self.sentences[item['sent_idx']], item['span'], item['label']
+
+    def get_lengths(self):
+        """Returns the number of tokens in the sentence of every item."""
+        if self.binary_split is not None:
+            return self.binary_split.get_lengths()[self.item_sent_ids].tolist()
+        if self.sentences is None:
+            return [item['text_ids'].shape[1] for item in self.data]
+        return [self.sentences[item['sent_idx']].shape[1] for item in self.data]
 
     @classmethod
     def add_label(cls, label):
@@ -70,6 +143,24 @@ def collate_fn(data):
     return padded_sents, spans, labels
 
 
+def collate_sentences_fn(data):
+    """Collates sentence-grouped items. Returns the padded sentences (B x L),
+    spans as (sentence index, start, end) rows (N x 3), and labels (N,)."""
+    sents, spans, labels = list(zip(*data))
+    max_length = max(item.shape[1] for item in sents)
+    pad_id = ConstituentDataset.encoder.tokenizer.pad_token_id
+    batch_size = len(sents)
+    padded_sents = pad_id * torch.ones(batch_size, max_length).long()
+    for i, sent in enumerate(sents):
+        padded_sents[i, :sent.shape[1]] = sent[0, :]
+    sent_ids = torch.cat([
+        i * torch.ones(item.shape[0], 1).long() for i, item in enumerate(spans)
+    ], dim=0)
+    spans = torch.cat((sent_ids, torch.cat(spans, dim=0)), dim=1)
+    labels = torch.tensor([item for sent_labels in labels for item in sent_labels])
+    return padded_sents, spans, labels
+
+
 # unit test
 if __name__ == '__main__':
     from torch.utils.data import DataLoader
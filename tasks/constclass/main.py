@@ -8,7 +8,14 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 
 from encoders.pretrained_transformers import Encoder
-from tasks.constclass.data import ConstituentDataset, collate_fn
+from encoders.pretrained_transformers.encoder import PRECISION_LIST
+from encoders.pretrained_transformers.device import setup_device
+from tasks.constclass.data import ConstituentDataset, collate_fn, collate_sentences_fn
+from tasks.common.sampler import ShuffledBatchSampler, TokenBudgetBatchSampler
+from tasks.common.async_checkpoint import atomic_save
+from tasks.common.preemption import PreemptionHandler, get_rng_states, set_rng_states
+from tasks.common.checkpoint import (trainable_state_dict, snapshot, get_base_model_ref,
+    check_base_model, load_trainable_state_dict)
 from tasks.constclass.models import SpanClassifier
 
 
@@ -33,8 +40,18 @@ class LearningRateController(object):
 
 def forward_batch(model, data, valid=False):
     sents, spans, labels = data
-    output = encoder(sents)
-    preds = model(output, spans[:, 0], spans[:, 1] - 1).view(-1)
+    packing = encoder.pack(sents)
+    output = encoder(sents, packing=packing)
+    if packing is not None:
+        # move the spans to the packed rows
+        sent_ids = (spans[:, 0] if spans.shape[1] == 3 else None)
+        span_ids, sent_ids = packing.remap(spans[:, -2:], sent_ids)
+        spans = torch.cat([sent_ids.unsqueeze(1), span_ids], dim=1)
+    if spans.shape[1] == 3:
+        # sentence-grouped batch with (sentence index, start, end) rows
+        preds = model(output, spans[:, 1], spans[:, 2] - 1, sent_ids=spans[:, 0]).view(-1)
+    else:
+        preds = model(output, spans[:, 0], spans[:, 1] - 1).view(-1)
     if valid:
         return preds
     else:
@@ -45,23 +62,38 @@ def forward_batch(model, data, valid=False):
 def validate(loader, model):
     # save the random state for recovery
     rng_state = torch.random.get_rng_state()
-    cuda_rng_state = torch.cuda.random.get_rng_state()
+    if torch.cuda.is_available():
+        cuda_rng_state = torch.cuda.random.get_rng_state()
     numerator = denominator = 0
     for sents, spans, labels in loader:
-        if torch.cuda.is_available():
-            sents = sents.cuda()
-            spans = spans.cuda()
-            labels = labels.cuda()
+        sents = sents.to(encoder.device)
+        spans = spans.to(encoder.device)
+        labels = labels.to(encoder.device)
         preds = forward_batch(model, (sents, spans, labels), True)
         pred_labels = (preds > 0.5).long()
         numerator += (pred_labels == labels).long().sum().item()
         denominator += spans.shape[0]
     # recover the random state for reproduction
     torch.random.set_rng_state(rng_state)
-    torch.cuda.random.set_rng_state(cuda_rng_state)
+    if torch.cuda.is_available():
+        torch.cuda.random.set_rng_state(cuda_rng_state)
     return float(numerator) / denominator
 
 
+def get_data_loader(data_set, split, batch_collate_fn, args):
+    if args.max_tokens is not None:
+        # batch by a max-tokens budget with length bucketing
+        batch_sampler = TokenBudgetBatchSampler(
+            data_set.get_lengths(), args.max_tokens, shuffle=(split=='train'),
+            seed=args.seed, packed=(args.pack_max_len is not None))
+    else:
+        batch_sampler = ShuffledBatchSampler(
+            len(data_set), args.batch_size, shuffle=(split=='train'), seed=args.seed)
+    # seekable, so that a resumed run starts right at the batch of its checkpoint
+    return DataLoader(data_set, batch_sampler=batch_sampler,
+        collate_fn=batch_collate_fn)
+
+
 if __name__ == '__main__':
     # arguments from snippets
     parser = argparse.ArgumentParser()
@@ -85,8 +117,25 @@ if __name__ == '__main__':
     parser.add_argument('--model-size', type=str, default='base')
     parser.add_argument('--uncased', action='store_false', dest='cased')
     parser.add_argument('--encoding-method', type=str, default='avg')
+    parser.add_argument('--segment-pooling', action='store_true', default=False)
     parser.add_argument('--use-proj', action='store_true', default=False)
     parser.add_argument('--proj-dim', type=int, default=256)
+    parser.add_argument('--group-by-sentence', action='store_true', default=False)
+    parser.add_argument('--max-tokens', type=int, default=None)
+    parser.add_argument('--binary-data-path', type=str, default=None)
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--feature-store-dir', type=str, default=None)
+    parser.add_argument('--stream-mix', action='store_true', default=False)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--num-interop-threads', type=int, default=None)
+    parser.add_argument('--pin-threads', action='store_true', default=False)
+    parser.add_argument('--dtype', type=str, default='fp32', choices=PRECISION_LIST)
+    parser.add_argument('--window-size', type=int, default=None)
+    parser.add_argument('--window-stride', type=int, default=None)
+    parser.add_argument('--layers', type=int, nargs='+', default=None)
+    parser.add_argument('--unpad', action='store_true', default=False)
+    parser.add_argument('--pack-max-len', type=int, default=None)
     args = parser.parse_args()
 
     # save arguments
@@ -101,6 +150,8 @@ if __name__ == '__main__':
     torch.manual_seed(args.seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed(args.seed)
+    device = setup_device(args.device, num_threads=args.num_threads,
+        num_interop_threads=args.num_interop_threads, pin_threads=args.pin_threads)
 
     # configure logger
     logger = logging.getLogger(__name__)
@@ -123,12 +174,23 @@ if __name__ == '__main__':
     
     # create data sets, tokenizers, and data loaders
     encoder = Encoder(args.model_type, args.model_size, 
-        args.cased, use_proj=args.use_proj, proj_dim=args.proj_dim
+        args.cased, use_proj=args.use_proj, proj_dim=args.proj_dim,
+        stream_mix=args.stream_mix, dtype=args.dtype,
+        window_size=args.window_size, window_stride=args.window_stride,
+        layers=args.layers, unpad=args.unpad, pack_max_len=args.pack_max_len
     )
+    if args.feature_store_dir:
+        encoder.attach_feature_store(args.feature_store_dir)
+    if args.group_by_sentence:
+        batch_collate_fn = collate_sentences_fn
+        loader_suffix = '.sent.loader.pt'
+    else:
+        batch_collate_fn = collate_fn
+        loader_suffix = '.loader.pt'
     data_loader_path = os.path.join(
-        args.model_path, args.model_name + '.loader.pt'
+        args.model_path, args.model_name + loader_suffix
     )
-    if os.path.exists(data_loader_path):
+    if os.path.exists(data_loader_path) and args.binary_data_path is None:
         logger.info('Loading datasets.')
         data_info = torch.load(data_loader_path)
         data_loader = data_info['data_loader']
@@ -139,30 +201,41 @@ if __name__ == '__main__':
         data_set = dict()
         data_loader = dict()
         for split in ['train', 'development', 'test']:
-            data_set[split] = ConstituentDataset(
-                os.path.join(args.data_path, f'{split}.json'),
-                encoder=encoder
+            if args.binary_data_path is not None:
+                # splits preprocessed with tasks.common.binary_data, read lazily
+                data_set[split] = ConstituentDataset(
+                    os.path.join(
+                        args.binary_data_path, encoder.model_name, split),
+                    encoder=encoder, group_by_sentence=args.group_by_sentence,
+                    binary=True
+                )
+            else:
+                data_set[split] = ConstituentDataset(
+                    os.path.join(args.data_path, f'{split}.json'),
+                    encoder=encoder, group_by_sentence=args.group_by_sentence,
+                    num_workers=args.num_workers
+                )
+            data_loader[split] = get_data_loader(
+                data_set[split], split, batch_collate_fn, args)
+        if args.binary_data_path is None:
+            torch.save(
+                {
+                    'data_loader': data_loader,
+                    'label_dict': ConstituentDataset.label_dict
+                },
+                data_loader_path
             )
-            data_loader[split] = DataLoader(data_set[split], args.batch_size, 
-                collate_fn=collate_fn, shuffle=(split=='train'))
-        torch.save(
-            {
-                'data_loader': data_loader,
-                'label_dict': ConstituentDataset.label_dict
-            },
-            data_loader_path
-        )
     assert len(ConstituentDataset.label_dict) == 2
 
     # initialize models: MLP
     logger.info('Initializing models.')
     model = SpanClassifier(
         encoder, args.use_proj, args.proj_dim, args.hidden_dims, 
-        1, pooling_method=args.encoding_method
+        1, pooling_method=args.encoding_method,
+        segment_pooling=args.segment_pooling
     )
-    if torch.cuda.is_available():
-        encoder = encoder.cuda()
-        model = model.cuda()
+    encoder = encoder.to(device)
+    model = model.to(device)
     
     # initialize optimizer
     logger.info('Initializing optimizer.')
@@ -171,58 +244,99 @@ if __name__ == '__main__':
     
     # initialize best model info, and lr controller
     best_acc = 0
+    # CPU copies of the trainable parameters of the best model
     best_model = None 
-    best_weighing_params = None
+    best_encoder = None
     lr_controller = LearningRateController()
 
     # load checkpoint, if exists
     args.start_epoch = 0 
     args.epoch_step = -1
+    train_sampler = data_loader['train'].batch_sampler
     ckpt_path = os.path.join(
         args.model_path, args.model_name + '.ckpt'
     )
     if os.path.exists(ckpt_path):
         logger.info(f'Loading checkpoint from {ckpt_path}.')
-        checkpoint = torch.load(ckpt_path)
-        model.load_state_dict(checkpoint['model'])
+        checkpoint = torch.load(ckpt_path, map_location=device)
+        check_base_model(checkpoint, encoder)
+        load_trainable_state_dict(model, checkpoint['model'])
         best_model = checkpoint['best_model']
-        best_weighing_params = checkpoint['best_weighing_params']
+        if 'encoder' in checkpoint:
+            # the layer weights (and projection) are part of the encoder state
+            load_trainable_state_dict(encoder, checkpoint['encoder'])
+            best_encoder = checkpoint['best_encoder']
+        else:
+            # older checkpoints only have the layer weights of the encoder
+            encoder.weighing_params.data = checkpoint['weighing_params'].data
+            best_encoder = snapshot(encoder)
+            best_encoder['weighing_params'] = checkpoint['best_weighing_params'].detach().cpu()
         best_acc = checkpoint['best_acc']
         optimizer.load_state_dict(checkpoint['optimizer'])
         lr_controller = checkpoint['lr_controller']
-        torch.cuda.random.set_rng_state(checkpoint['cuda_rng_state'])
+        if torch.cuda.is_available() and checkpoint['cuda_rng_state'] is not None:
+            torch.cuda.random.set_rng_state(checkpoint['cuda_rng_state'])
+        if 'rng_states' in checkpoint:
+            set_rng_states(checkpoint['rng_states'])
         args.start_epoch = checkpoint['epoch']
         args.epoch_step = checkpoint['step']
-        encoder.weighing_params.data = checkpoint['weighing_params'].data
+        if 'sampler' in checkpoint:
+            train_sampler.load_state_dict(checkpoint['sampler'])
+        else:
+            # written before sampler states: the batch after the checkpointed step
+            train_sampler.load_state_dict({'epoch': args.start_epoch, 'seed': args.seed,
+                                           'cursor': args.epoch_step + 1})
         if lr_controller.not_improved >= lr_controller.terminate_range:
             logger.info('No more optimization, testing and exiting.')
             assert best_model is not None
-            model.load_state_dict(best_model)
-            encoder.weighing_params.data = best_weighing_params.data
+            load_trainable_state_dict(model, best_model)
+            load_trainable_state_dict(encoder, best_encoder)
             model.eval()
             with torch.no_grad():
                 test_acc = validate(data_loader['test'], model)
             logger.info(f'Test Acc. {test_acc * 100:6.2f}%')
             exit(0)
 
+    def save_checkpoint(epoch, step):
+        # with just the trainable parameters and the position in the data, written to a
+        # temporary file first so that a kill mid write leaves the previous checkpoint
+        atomic_save({
+            'base_model': get_base_model_ref(encoder),
+            'encoder': trainable_state_dict(encoder),
+            'model': trainable_state_dict(model),
+            'best_model': best_model,
+            'best_encoder': best_encoder,
+            'best_acc': best_acc,
+            'optimizer': optimizer.state_dict(),
+            'epoch': epoch,
+            'step': step,
+            'lr_controller': lr_controller,
+            'cuda_rng_state': (torch.cuda.random.get_rng_state()
+                if torch.cuda.is_available() else None),
+            'rng_states': get_rng_states(),
+            # the batches of the epoch consumed so far, incl. the current one
+            'sampler': train_sampler.state_dict(step + 1),
+        }, ckpt_path)
+
     # training
+    preemption = PreemptionHandler()
+    preemption.install()
     terminate = False
-    for epoch in range(args.epochs):
+    for epoch in range(args.start_epoch, args.epochs):
         if terminate:
             break
         model.train()
+        # a resumed epoch keeps the cursor of its checkpoint
+        if epoch != train_sampler.epoch:
+            train_sampler.set_epoch(epoch)
+        start_step = train_sampler.cursor
         cummulated_loss = cummulated_num = 0
-        for step, (sents, spans, labels) in enumerate(data_loader['train']):
+        for step, (sents, spans, labels) in enumerate(data_loader['train'], start=start_step):
             if terminate:
                 break
-            # ignore batches to recover the same data loader state of checkpoint
-            if (epoch < args.start_epoch) or (epoch == args.start_epoch and \
-                    step <= args.epoch_step):
-                continue
-            if torch.cuda.is_available():
-                sents = sents.cuda()
-                spans = spans.cuda()
-                labels = labels.cuda()
+            sents = sents.to(device)
+            spans = spans.to(device)
+            labels = labels.to(device)
             preds, loss = forward_batch(model, (sents, spans, labels))
             # optimize model
             optimizer.zero_grad()
@@ -230,8 +344,8 @@ if __name__ == '__main__':
 
             optimizer.step()
             # update metadata
-            cummulated_loss += loss.item() * sents.shape[0]
-            cummulated_num += sents.shape[0]
+            cummulated_loss += loss.item() * labels.shape[0]
+            cummulated_num += labels.shape[0]
             # log
             actual_step = len(data_loader['train']) * epoch + step + 1
             if actual_step % args.log_step == 0:
@@ -253,8 +367,8 @@ if __name__ == '__main__':
                 # update when there is a new best model
                 if curr_acc > best_acc:
                     best_acc = curr_acc
-                    best_model = model.state_dict()
-                    best_weighing_params = encoder.weighing_params
+                    best_model = snapshot(model)
+                    best_encoder = snapshot(encoder)
                     logger.info('New best model!')
                 logger.info('-' * 80)
                 model.train()
@@ -276,27 +390,22 @@ if __name__ == '__main__':
                         lr=optimizer.param_groups[0]['lr'] / 2.0
                     )
                 # save checkpoint
-                torch.save({
-                    'model': model.state_dict(),
-                    'weighing_params': encoder.weighing_params,
-                    'best_model': best_model,
-                    'best_weighing_params': best_weighing_params,
-                    'best_acc': best_acc,
-                    'optimizer': optimizer.state_dict(),
-                    'epoch': epoch,
-                    'step': step,
-                    'lr_controller': lr_controller,
-                    'cuda_rng_state': torch.cuda.random.get_rng_state(),
-                }, ckpt_path)
+                save_checkpoint(epoch, step)
                 # pre-terminate to avoid saving problem
                 if (time.time() - args.start_time) >= args.time_limit:
                     logger.info('Training time is almost up -- terminating.')
                     exit(0)
+            # checkpoint and exit on preemption, after the current (accumulated) batch
+            if preemption.requested and \
+                    actual_step % (args.real_batch_size // args.batch_size) == 0:
+                save_checkpoint(epoch, step)
+                logger.info('Preempted -- checkpointed and terminating.')
+                exit(0)
 
     # finished training, testing
     assert best_model is not None
-    model.load_state_dict(best_model)
-    encoder.weighing_params.data = best_weighing_params.data
+    load_trainable_state_dict(model, best_model)
+    load_trainable_state_dict(encoder, best_encoder)
     model.eval()
     with torch.no_grad():
         test_acc = validate(data_loader['test'], model)
@@ -6,13 +6,14 @@ from encoders.pretrained_transformers.span_reprs import get_span_module
 
 class SpanClassifier(nn.Module):
     def __init__(self, encoder, use_proj, proj_dim, hidden_dims, output_dim, 
-            dropout_ratio=0.2, pooling_method='avg'):
+            dropout_ratio=0.2, pooling_method='avg', segment_pooling=False):
         super(SpanClassifier, self).__init__()
         self.span_repr = get_span_module(
             method=pooling_method, 
             input_dim=encoder.hidden_size,
             use_proj=use_proj, 
-            proj_dim=proj_dim
+            proj_dim=proj_dim,
+            segment_pooling=segment_pooling
         )
         input_dim = self.span_repr.get_output_dim()
         dims = [input_dim] + hidden_dims + [output_dim]
@@ -26,8 +27,8 @@ class SpanClassifier(nn.Module):
         layers.append(nn.Sigmoid())
         self.mlp = nn.Sequential(*layers)
     
-    def forward(self, encoded_input, start, end):
-        span_repr = self.span_repr(encoded_input, start, end)
+    def forward(self, encoded_input, start, end, sent_ids=None):
+        span_repr = self.span_repr(encoded_input, start, end, sent_ids=sent_ids)
         return self.mlp(span_repr)
     
     def __call__(self, *args, **kwargs):
@@ -1,59 +1,145 @@
 
-import json
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
-from tasks.constituent.utils import convert_word_to_subword
+from tasks.common.binary_data import BinarySplit
+from tasks.common.preprocess import preprocess_lines
 
 
 class ConstituentDataset(Dataset):
     label_dict = dict()
     encoder = None
+    # defaults for datasets pickled in older .loader.pt files
+    binary_split = None
+    sentences = None
 
-    def __init__(self, path, encoder):
+    def __init__(self, path, encoder, group_by_sentence=False, binary=False,
+            num_workers=1):
+        """group_by_sentence: If True, each item is a sentence with all of its spans,
+            to be batched with collate_sentences_fn.
+            binary: If True, path is a split directory written by tasks.common.binary_data,
+            which is read lazily.
+            num_workers: Number of processes which tokenize the JSON file."""
         super(ConstituentDataset, self).__init__()
-        raw_data = [json.loads(line) for line in open(path)]
+        self.group_by_sentence = group_by_sentence
         self.set_encoder(encoder)
-        # preprocess
+        self.binary_split = None
+        if binary:
+            self.load_binary(path)
+            return
+        with open(path) as f:
+            lines = f.readlines()
+        # preprocess: the tokens of a sentence are stored once in self.sentences
+        # and the items only refer to them by index
         self.data = list()
-        for sentence in raw_data:
-            text = sentence['text']
-            tokenized_input, subword2word = encoder.tokenize_sentence(
-                text, get_subword_indices=True, force_split=True)
+        self.sentences = list()
+        for token_ids, targets in preprocess_lines(
+                lines, encoder.word_tokenizer, num_workers=num_workers):
             curr_span_labels = dict()
-            for item in sentence['targets']:
-                span = tuple(item['span1'])
-                if span not in curr_span_labels:
-                    curr_span_labels[span] = set()
-                label = item['label']
+            subword_spans = dict()
+            for span, orig_span, label in targets:
+                orig_span = tuple(orig_span)
+                if orig_span not in curr_span_labels:
+                    curr_span_labels[orig_span] = set()
+                    # end index of the subword span is exclusive
+                    subword_spans[orig_span] = [span[0], span[1] + 1]
                 self.add_label(label)
-                curr_span_labels[span].add(self.label_dict[label])
-            start_ids, end_ids = convert_word_to_subword(
-                subword2word,
-                torch.tensor([
-                    span for span in sorted(curr_span_labels.keys())
-                ]).long().view(-1, 2),
-                encoder.start_shift
-            )
-            tokenized_input = tokenized_input.cpu()
-            tokenized_span_ranges = torch.cat(
-                (start_ids.view(-1, 1), end_ids.view(-1, 1)), dim=1)
-            for i, span in enumerate(sorted(curr_span_labels.keys())):
-                labels = curr_span_labels[span]
+                curr_span_labels[orig_span].add(self.label_dict[label])
+            if len(curr_span_labels) == 0:
+                continue
+            tokenized_input = torch.tensor(token_ids).long().view(1, -1)
+            tokenized_span_ranges = torch.tensor([
+                subword_spans[span] for span in sorted(curr_span_labels.keys())
+            ]).long().view(-1, 2)
+            sent_idx = len(self.sentences)
+            self.sentences.append(tokenized_input)
+            if group_by_sentence:
                 self.data.append(
                     {
-                        'text_ids': tokenized_input,
-                        'span': tokenized_span_ranges[i].view(1, -1).cpu(),
-                        'labels': labels
+                        'sent_idx': sent_idx,
+                        'span': tokenized_span_ranges.cpu(),
+                        'labels': [curr_span_labels[span]
+                                   for span in sorted(curr_span_labels.keys())]
                     }
                 )
+            else:
+                for i, span in enumerate(sorted(curr_span_labels.keys())):
+                    labels = curr_span_labels[span]
+                    self.data.append(
+                        {
+                            'sent_idx': sent_idx,
+                            'span': tokenized_span_ranges[i].view(1, -1).cpu(),
+                            'labels': labels
+                        }
+                    )
                 
+    def load_binary(self, path):
+        self.binary_split = binary_split = BinarySplit(path)
+        assert binary_split.model_name == self.encoder.model_name
+        # labels.json lists the labels in the order of their first occurrence
+        for label in binary_split.label_list:
+            self.add_label(label)
+        self.label_map = np.array(
+            [self.label_dict[label] for label in binary_split.label_list], dtype=np.int64)
+        # deduplicate the spans of every sentence, sorted as in the JSON path
+        target_sent_ids = binary_split.get_target_sent_ids()
+        keys = np.stack((target_sent_ids, binary_split.orig_spans[:, 0],
+                         binary_split.orig_spans[:, 1]), axis=1)
+        self.span_keys, self.span_first_target, inverse = np.unique(
+            keys.reshape(-1, 3), axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.span_targets = np.argsort(inverse, kind='stable')
+        self.span_target_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(inverse, minlength=len(self.span_keys)))))
+        if self.group_by_sentence:
+            self.sent_span_offsets = np.searchsorted(
+                self.span_keys[:, 0], np.arange(len(binary_split) + 1))
+            self.item_sent_ids = np.nonzero(np.diff(self.sent_span_offsets))[0]
+        else:
+            self.item_sent_ids = self.span_keys[:, 0]
+
+    def get_binary_span(self, span_idx):
+        """Returns the subword span (end exclusive) and the set of labels of a unique span."""
+        start, end = self.binary_split.spans[self.span_first_target[span_idx]].tolist()
+        targets = self.span_targets[
+            self.span_target_offsets[span_idx]: self.span_target_offsets[span_idx + 1]]
+        labels = set(self.label_map[self.binary_split.labels[targets]].tolist())
+        return [start, end + 1], labels
+
+    def get_binary_item(self, index):
+        sent_idx = self.item_sent_ids[index]
+        text_ids = torch.tensor(self.binary_split.get_text(sent_idx)).long().view(1, -1)
+        if self.group_by_sentence:
+            spans, labels = zip(*[
+                self.get_binary_span(span_idx) for span_idx in range(
+                    self.sent_span_offsets[sent_idx], self.sent_span_offsets[sent_idx + 1])
+            ])
+            return text_ids, torch.tensor(spans).long(), list(labels)
+        span, labels = self.get_binary_span(index)
+        return text_ids, torch.tensor([span]).long(), labels
+
     def __len__(self):
+        if self.binary_split is not None:
+            return len(self.item_sent_ids)
         return len(self.data)
     
     def __getitem__(self, index):
-        return self.data[index]['text_ids'], self.data[index]['span'], \
-            self.data[index]['labels']
+        if self.binary_split is not None:
+            return self.get_binary_item(index)
+        item = self.data[index]
+        if self.sentences is None:
+            # older pickled datasets store the tokens in every item
+            return item['text_ids'], item['span'], item['labels']
+        return self.sentences[item['sent_idx']], item['span'], item['labels']
+
+    def get_lengths(self):
+        """Returns the number of tokens in the sentence of every item."""
+        if self.binary_split is not None:
+            return self.binary_split.get_lengths()[self.item_sent_ids].tolist()
+        if self.sentences is None:
+            return [item['text_ids'].shape[1] for item in self.data]
+        return [self.sentences[item['sent_idx']].shape[1] for item in self.data]
 
     @classmethod
     def add_label(cls, label):
@@ -82,6 +168,29 @@ def collate_fn(data):
     return padded_sents, spans, one_hot_labels
 
 
+def collate_sentences_fn(data):
+    """Collates sentence-grouped items. Returns the padded sentences (B x L),
+    spans as (sentence index, start, end) rows (N x 3), and labels (N x C)."""
+    sents, spans, labels = list(zip(*data))
+    max_length = max(item.shape[1] for item in sents)
+    pad_id = ConstituentDataset.encoder.tokenizer.pad_token_id
+    batch_size = len(sents)
+    padded_sents = pad_id * torch.ones(batch_size, max_length).long()
+    for i, sent in enumerate(sents):
+        padded_sents[i, :sent.shape[1]] = sent[0, :]
+    sent_ids = torch.cat([
+        i * torch.ones(item.shape[0], 1).long() for i, item in enumerate(spans)
+    ], dim=0)
+    spans = torch.cat((sent_ids, torch.cat(spans, dim=0)), dim=1)
+    labels = [item for sent_labels in labels for item in sent_labels]
+    one_hot_labels = torch.zeros(
+        len(labels), len(ConstituentDataset.label_dict)).long()
+    for i, item in enumerate(labels):
+        for l in item:
+            one_hot_labels[i, l] = 1
+    return padded_sents, spans, one_hot_labels
+
+
 # unit test
 if __name__ == '__main__':
     from torch.utils.data import DataLoader
@@ -2,9 +2,7 @@ import torch
 
 
 def convert_word_to_subword(subword2word, spans, start_shift):
-    if torch.cuda.is_available():
-        subword2word = subword2word.cuda()
-        spans = spans.cuda()
+    spans = spans.to(subword2word.device)
     temp = torch.arange(subword2word.shape[1]).unsqueeze(0).expand_as(
         subword2word)
     start_ids = ((subword2word >= 0).long() *
@@ -1,82 +1,106 @@
 from torchtext.data import Example, Field, Dataset
 import torchtext.data as data
-import json
 import os
 
+from tasks.common.fields import get_sentence_fields
+from tasks.common.binary_data import BinarySplit
+from tasks.common.examples import LazyExamples
+from tasks.common.preprocess import preprocess_lines
+from tasks.common.iterators import TokenBudgetIterator
+
 
 class CorefDataset(Dataset):
     """Class for parsing the Ontonotes coref dataset."""
 
     def __init__(self, path, model, train_frac=1.0,
                  encoding="utf-8", separator="\t",
-                 max_seq_len=512):
+                 max_seq_len=512, group_by_sentence=False, binary=False,
+                 num_workers=1):
+        """group_by_sentence: If True, each example is a sentence with all of its targets,
+            so that a sentence is encoded only once per batch.
+            binary: If True, path is a split directory written by tasks.common.binary_data.
+            num_workers: Number of processes which tokenize the JSON file."""
         text_field = Field(sequential=True, use_vocab=False, include_lengths=True,
                            batch_first=True, pad_token=model.tokenizer.pad_token_id)
-        non_seq_field = Field(sequential=False, use_vocab=False, batch_first=True)
-        fields = [('text', text_field),
-                  ('span1', non_seq_field),
-                  ('orig_span1', non_seq_field),
-                  ('span2', non_seq_field),
-                  ('orig_span2', non_seq_field),
-                  ('label', non_seq_field)]
-
-        examples = []
-        f = open(path, encoding=encoding)
-        lines = f.readlines()
-        is_train = self.check_for_train_file(path)
+        if group_by_sentence:
+            fields = get_sentence_fields(text_field, ['span1', 'span2'])
+        else:
+            non_seq_field = Field(sequential=False, use_vocab=False, batch_first=True)
+            fields = [('text', text_field),
+                      ('span1', non_seq_field),
+                      ('orig_span1', non_seq_field),
+                      ('span2', non_seq_field),
+                      ('orig_span2', non_seq_field),
+                      ('label', non_seq_field)]
 
-        # if True:
-        if is_train and train_frac < 1.0:
-            red_num_lines = int(len(lines) * train_frac)
-            lines = lines[:red_num_lines]
-
-        for line in lines:
-            instance = json.loads(line)
-            text, subword_to_word_idx = model.tokenize(
-                instance["text"].split(), get_subword_indices=True)
-
-            for target in instance["targets"]:
-                span1_index = self.get_tokenized_span_indices(
-                    subword_to_word_idx, target["span1"])
-                span2_index = self.get_tokenized_span_indices(
-                    subword_to_word_idx, target["span2"])
-                label = target["label"]
-                examples.append(
-                    Example.fromlist([text, span1_index, target["span1"], span2_index,
-                                      target["span2"], label], fields))
+        is_train = self.check_for_train_file(path)
+        if binary:
+            binary_split = BinarySplit(path)
+            assert (binary_split.model_name == model.model_name)
+            num_sentences = len(binary_split)
+            if is_train and train_frac < 1.0:
+                num_sentences = int(num_sentences * train_frac)
+            examples = LazyExamples(binary_split, fields, group_by_sentence=group_by_sentence,
+                                    num_sentences=num_sentences)
+        else:
+            examples = []
+            f = open(path, encoding=encoding)
+            lines = f.readlines()
+
+            # if True:
+            if is_train and train_frac < 1.0:
+                red_num_lines = int(len(lines) * train_frac)
+                lines = lines[:red_num_lines]
+
+            for text, targets in preprocess_lines(lines, model.word_tokenizer,
+                                                  num_workers=num_workers):
+                if group_by_sentence:
+                    if targets:
+                        examples.append(Example.fromlist(
+                            [text] + [list(column) for column in zip(*targets)] + [len(targets)],
+                            fields))
+                else:
+                    for target in targets:
+                        examples.append(Example.fromlist([text] + target, fields))
 
         super(CorefDataset, self).__init__(examples, fields)
 
     def check_for_train_file(self, file_path):
-        if os.path.basename(file_path) == "train.json":
+        # Either the JSON file or the binary split directory
+        if os.path.splitext(os.path.basename(file_path))[0] == "train":
             return True
         return False
 
-    @staticmethod
-    def get_tokenized_span_indices(subword_to_word_idx, orig_span_indices):
-        orig_start_idx, orig_end_idx = orig_span_indices
-        start_idx = subword_to_word_idx.index(orig_start_idx)
-        # Search for the index of the last subword
-        end_idx = len(subword_to_word_idx) - 1 - subword_to_word_idx[::-1].index(orig_end_idx - 1)
-        return [start_idx, end_idx]
-
     @staticmethod
     def sort_key(example):
         return len(example.text)
 
     @classmethod
-    def iters(cls, path, model, batch_size=32, eval_batch_size=32, train_frac=1.0):
+    def iters(cls, path, model, batch_size=32, eval_batch_size=32, train_frac=1.0,
+              group_by_sentence=False, max_tokens=None, binary_dir=None, num_workers=1):
+        extension = '.json'
+        if binary_dir is not None:
+            # Splits preprocessed with tasks.common.binary_data for this tokenizer
+            path = os.path.join(binary_dir, model.model_name)
+            extension = ''
         train, val, test = CorefDataset.splits(
-            path=path, train='train.json', validation='development.json', test='test.json',
-            model=model, train_frac=train_frac)
-
-        train_iter = data.BucketIterator(
-            train, batch_size=batch_size,
-            sort_within_batch=True, shuffle=True, repeat=False)
-
-        val_iter, test_iter = data.BucketIterator.splits(
-            (val, test), batch_size=eval_batch_size,
-            sort_within_batch=True, shuffle=False, repeat=False)
+            path=path, train='train' + extension, validation='development' + extension,
+            test='test' + extension,
+            model=model, train_frac=train_frac, group_by_sentence=group_by_sentence,
+            binary=(binary_dir is not None), num_workers=num_workers)
+
+        if max_tokens is not None:
+            # Batch by a max-tokens budget instead of a fixed number of examples
+            train_iter, val_iter, test_iter = TokenBudgetIterator.splits(
+                (train, val, test), max_tokens, sort_within_batch=True, repeat=False)
+        else:
+            train_iter = data.BucketIterator(
+                train, batch_size=batch_size,
+                sort_within_batch=True, shuffle=True, repeat=False)
+
+            val_iter, test_iter = data.BucketIterator.splits(
+                (val, test), batch_size=eval_batch_size,
+                sort_within_batch=True, shuffle=False, repeat=False)
 
         return (train_iter, val_iter, test_iter)
 
@@ -10,7 +10,18 @@ import os
 import sys
 
 
+from encoders.pretrained_transformers.encoder import PRECISION_LIST
+from encoders.pretrained_transformers.device import setup_device
+from tasks.common.checkpoint import (
+    get_base_model_ref, check_base_model, trainable_state_dict, load_trainable_state_dict)
+from tasks.common.async_checkpoint import AsyncCheckpointer
+from tasks.common.preemption import PreemptionHandler, get_rng_states, set_rng_states
+
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
+# Writes the checkpoints of save_model in the background
+checkpointer = AsyncCheckpointer()
+# Checkpoints and exits on SIGTERM/SIGUSR1, see train
+preemption = PreemptionHandler()
 
 
 def parse_args():
@@ -34,8 +45,39 @@ def parse_args():
     parser.add_argument("-fine_tune", default=True, action="store_true")
     parser.add_argument("-just_last_layer", default=False, action="store_true")
     parser.add_argument("-pool_method", default="avg", type=str)
+    parser.add_argument("-segment_pooling", default=False, action="store_true",
+                        help="Pool over just the span tokens (same output as the masked pooling).")
     parser.add_argument("-train_frac", default=1.0, type=float,
                         help="Can reduce this for quick testing.")
+    parser.add_argument("-group_by_sentence", default=False, action="store_true",
+                        help="Batch sentences and encode each once for all of its targets.")
+    parser.add_argument("-max_tokens", default=None, type=int,
+                        help="Batch by a max-tokens budget instead of a fixed batch size.")
+    parser.add_argument("-binary_data_dir", default=None, type=str,
+                        help="Directory of the splits written by tasks.common.binary_data.")
+    parser.add_argument("-num_workers", default=1, type=int,
+                        help="Number of processes which tokenize the JSON data files.")
+    parser.add_argument("-device", default=None, type=str,
+                        help="Device to run on, e.g. cpu or cuda. Defaults to cuda if available.")
+    parser.add_argument("-num_threads", default=None, type=int,
+                        help="Number of intra-op threads on CPU.")
+    parser.add_argument("-num_interop_threads", default=None, type=int,
+                        help="Number of inter-op threads on CPU.")
+    parser.add_argument("-pin_threads", default=False, action="store_true",
+                        help="Pin the CPU threads to a fixed set of cores.")
+    parser.add_argument("-dtype", default="fp32", type=str, choices=PRECISION_LIST,
+                        help="Precision of the pretrained model. The span heads stay in fp32.")
+    parser.add_argument("-layers", default=None, type=int, nargs='+',
+                        help="Encoder layers to mix (0 is the embedding layer). Defaults to all.")
+    parser.add_argument("-unpad", default=False, action="store_true",
+                        help="Run the SpanBERT layers without the padding tokens.")
+    parser.add_argument("-checkpoint_layers", default=0, type=int,
+                        help="Recompute the activations of the first this many transformer "
+                        "blocks in the backward pass to fit larger batches.")
+    parser.add_argument("-window_size", default=None, type=int,
+                        help="Encode documents longer than this many subwords in windows.")
+    parser.add_argument("-window_stride", default=None, type=int,
+                        help="Subwords between the starts of consecutive windows.")
     parser.add_argument("-seed", type=int, default=0, help="Random seed")
     parser.add_argument("-eval", default=False, action="store_true")
     parser.add_argument('-slurm_id', help="Slurm ID",
@@ -45,11 +87,13 @@ def parse_args():
     return hp
 
 
-def save_model(model, optimizer, scheduler, steps_done, max_f1, num_stuck_evals, location):
+def save_model(model, optimizer, scheduler, steps_done, max_f1, num_stuck_evals, location,
+               train_iter=None):
     """Save model."""
     save_dict = {}
+    save_dict['base_model'] = get_base_model_ref(model.encoder)
     save_dict['weighing_params'] = model.encoder.weighing_params
-    save_dict['encoder'] = model.encoder.model.state_dict()
+    save_dict['encoder'] = trainable_state_dict(model.encoder.model)
     save_dict['span_net'] = model.span_net.state_dict()
     save_dict['label_net'] = model.label_net.state_dict()
 
@@ -60,8 +104,12 @@ def save_model(model, optimizer, scheduler, steps_done, max_f1, num_stuck_evals,
         'optimizer_state_dict': optimizer.state_dict(),
         'scheduler_state_dict': scheduler.state_dict(),
         'rng_state': torch.get_rng_state(),
+        'rng_states': get_rng_states(),
     })
-    torch.save(save_dict, location)
+    if train_iter is not None:
+        # Position in the training data
+        save_dict['train_iter_state'] = train_iter.state_dict()
+    checkpointer.save(save_dict, location)
     logging.info("Model saved at: %s" % (location))
 
 
@@ -111,7 +159,8 @@ def train(args, model, train_iter, val_iter, optimizer, scheduler,
                     num_stuck_evals += 1
 
                 location = path.join(model_dir, "model.pt")
-                save_model(model, optimizer, scheduler, steps_done, max_f1, num_stuck_evals, location)
+                save_model(model, optimizer, scheduler, steps_done, max_f1, num_stuck_evals,
+                           location, train_iter=train_iter)
 
                 if num_stuck_evals >= 20:
                     logging.info("No improvement for 20 evaluations")
@@ -119,6 +168,15 @@ def train(args, model, train_iter, val_iter, optimizer, scheduler,
 
                 sys.stdout.flush()
 
+            if (idx % batch_size_fac == 0) and preemption.requested:
+                # Checkpoint with the position in the data and exit, to be requeued
+                location = path.join(model_dir, "model.pt")
+                save_model(model, optimizer, scheduler, steps_done, max_f1, num_stuck_evals,
+                           location, train_iter=train_iter)
+                checkpointer.flush()
+                logging.info("Preempted at %d steps, exiting" % steps_done)
+                sys.exit(0)
+
         logging.info("Epoch done!\n")
 
     logging.info("Training done!\n")
@@ -134,7 +192,7 @@ def eval(model, val_iter):
     all_res = []
     with torch.no_grad():
         for batch_data in val_iter:
-            label = batch_data.label.cuda().float()
+            label = batch_data.label.to(model.encoder.device).float()
             _, pred = model(batch_data)
             pred = (pred > 0.5).float()
 
@@ -180,6 +238,22 @@ def get_model_name(hp):
     str_repr = str(opt_dict.items())
     hash_idx = hashlib.md5(str_repr.encode("utf-8")).hexdigest()
     model_name = "ft_coref_" + str(hash_idx)
+    if hp.group_by_sentence:
+        model_name += "_sent"
+        logging.info("group_by_sentence\tTrue")
+    if hp.max_tokens is not None:
+        model_name += "_mt" + str(hp.max_tokens)
+        logging.info("max_tokens\t%d" % hp.max_tokens)
+    if hp.dtype != 'fp32':
+        model_name += "_" + hp.dtype
+        logging.info("dtype\t%s" % hp.dtype)
+    if hp.layers is not None:
+        model_name += "_l" + "-".join([str(layer) for layer in sorted(set(hp.layers))])
+        logging.info("layers\t%s" % hp.layers)
+    if hp.window_size is not None:
+        model_name += "_w" + str(hp.window_size)
+        logging.info("window_size\t%d" % hp.window_size)
+
     return model_name
 
 
@@ -206,12 +280,13 @@ def final_eval(hp, model, best_model_dir, val_iter, test_iter):
     location = path.join(best_model_dir, "model.pt")
     model_dir = path.dirname(best_model_dir)
     if path.exists(location):
-        checkpoint = torch.load(location)
+        checkpoint = torch.load(location, map_location=model.encoder.device)
+        check_base_model(checkpoint, model.encoder)
         model.span_net.load_state_dict(checkpoint['span_net'])
         model.label_net.load_state_dict(checkpoint['label_net'])
         model.encoder.weighing_params = checkpoint['weighing_params']
         if hp.fine_tune:
-            model.encoder.model.load_state_dict(checkpoint['encoder'])
+            load_trainable_state_dict(model.encoder.model, checkpoint['encoder'])
         val_f1, val_res = eval(model, val_iter)
         val_file = path.join(model_dir, "val_log.tsv")
         write_res(val_res, val_file)
@@ -240,16 +315,21 @@ def main():
 
     # Set random seed
     torch.manual_seed(hp.seed)
+    device = setup_device(hp.device, num_threads=hp.num_threads,
+                          num_interop_threads=hp.num_interop_threads,
+                          pin_threads=hp.pin_threads)
 
     # Initialize the model
-    model = CorefModel(**vars(hp)).cuda()
+    model = CorefModel(**vars(hp)).to(device)
     sys.stdout.flush()
 
     # Load data
     logging.info("Loading data")
     train_iter, val_iter, test_iter = CorefDataset.iters(
         hp.data_dir, model.encoder, batch_size=hp.batch_size,
-        eval_batch_size=hp.eval_batch_size, train_frac=hp.train_frac)
+        eval_batch_size=hp.eval_batch_size, train_frac=hp.train_frac,
+        group_by_sentence=hp.group_by_sentence, max_tokens=hp.max_tokens,
+        binary_dir=hp.binary_data_dir, num_workers=hp.num_workers)
     logging.info("Data loaded")
 
     # optimizer_tune = None
@@ -263,7 +343,11 @@ def main():
     steps_done = 0
     max_f1 = 0
     init_num_stuck_evals = 0
-    num_steps = (hp.n_epochs * len(train_iter.data())) // hp.real_batch_size
+    if hp.max_tokens is not None:
+        # The number of batches per epoch depends on the lengths of the examples
+        num_steps = (hp.n_epochs * len(train_iter)) // (hp.real_batch_size // hp.batch_size)
+    else:
+        num_steps = (hp.n_epochs * len(train_iter.data())) // hp.real_batch_size
     # Quantize the number of training steps to eval steps
     num_steps = (num_steps // hp.eval_steps) * hp.eval_steps
     logging.info("Total training steps: %d" % num_steps)
@@ -271,12 +355,13 @@ def main():
     location = path.join(model_path, "model.pt")
     if path.exists(location):
         logging.info("Loading previous checkpoint")
-        checkpoint = torch.load(location)
+        checkpoint = torch.load(location, map_location=device)
+        check_base_model(checkpoint, model.encoder)
         model.encoder.weighing_params = checkpoint['weighing_params']
         model.span_net.load_state_dict(checkpoint['span_net'])
         model.label_net.load_state_dict(checkpoint['label_net'])
         if hp.fine_tune:
-            model.encoder.model.load_state_dict(checkpoint['encoder'])
+            load_trainable_state_dict(model.encoder.model, checkpoint['encoder'])
         optimizer.load_state_dict(
             checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(
@@ -285,14 +370,22 @@ def main():
         init_num_stuck_evals = checkpoint['num_stuck_evals']
         max_f1 = checkpoint['max_f1']
         torch.set_rng_state(checkpoint['rng_state'])
+        if 'rng_states' in checkpoint:
+            set_rng_states(checkpoint['rng_states'])
+        if 'train_iter_state' in checkpoint:
+            # Resume within the epoch of the checkpoint
+            train_iter.load_state_dict(checkpoint['train_iter_state'])
         logging.info("Steps done: %d, Max F1: %.3f" % (steps_done, max_f1))
 
+    preemption.install()
     if not hp.eval:
         train(hp, model, train_iter, val_iter, optimizer, scheduler,
               model_path, best_model_path, init_steps=steps_done, max_f1=max_f1,
               eval_steps=hp.eval_steps, num_steps=num_steps,
               init_num_stuck_evals=init_num_stuck_evals)
 
+    # The best model is read back from disk
+    checkpointer.flush()
     val_f1, test_f1 = final_eval(hp, model, best_model_path, val_iter, test_iter)
     perf_dir = path.join(hp.model_dir, "perf")
     if not path.exists(perf_dir):
@@ -7,7 +7,9 @@ from encoders.pretrained_transformers.span_reprs import get_span_module
 class CorefModel(nn.Module):
     def __init__(self, model='bert', model_size='base',
                  span_dim=256, pool_method='avg', fine_tune=False,
-                 no_proj=False, no_layer_weight=False,
+                 no_proj=False, no_layer_weight=False, stream_mix=False,
+                 segment_pooling=False, dtype='fp32', window_size=None,
+                 window_stride=None, layers=None, unpad=False,
                  **kwargs):
         super(CorefModel, self).__init__()
 
@@ -16,12 +18,14 @@ class CorefModel(nn.Module):
         self.no_proj = no_proj
         self.no_layer_weight = no_layer_weight
         self.encoder = Encoder(model=model, model_size=model_size, fine_tune=fine_tune,
-                               cased=True)
+                               cased=True, stream_mix=stream_mix, dtype=dtype,
+                               window_size=window_size, window_stride=window_stride,
+                               layers=layers, unpad=unpad)
         self.span_net = nn.ModuleDict()
 
         self.span_net['0'] = get_span_module(
             method=pool_method, input_dim=self.encoder.hidden_size,
-            use_proj=(not no_proj), proj_dim=span_dim)
+            use_proj=(not no_proj), proj_dim=span_dim, segment_pooling=segment_pooling)
 
         self.pooled_dim = self.span_net['0'].get_output_dim()
 
@@ -56,30 +60,39 @@ class CorefModel(nn.Module):
     def get_core_params(self):
         return self.encoder.model.parameters()
 
-    def calc_span_repr(self, encoded_input, span_indices, index='0'):
+    def calc_span_repr(self, encoded_input, span_indices, index='0', sent_ids=None):
         span_start, span_end = span_indices[:, 0], span_indices[:, 1]
-        span_repr = self.span_net[index](encoded_input, span_start, span_end)
+        span_repr = self.span_net[index](encoded_input, span_start, span_end, sent_ids=sent_ids)
         # if self.no_proj:
         #     span_repr = self.proj_net(span_repr)
         return span_repr
 
     def forward(self, batch_data):
         text, text_len = batch_data.text
+        device = self.encoder.device
         if self.no_layer_weight:
             with torch.no_grad():
-                encoded_input = self.encoder(text.cuda())
+                encoded_input = self.encoder(text.to(device))
         else:
-            encoded_input = self.encoder(text.cuda())
+            encoded_input = self.encoder(text.to(device))
 
-        s1_repr = self.calc_span_repr(encoded_input, batch_data.span1.cuda(), index='0')
+        # Only present in sentence-grouped batches
+        sent_ids = getattr(batch_data, 'sent_ids', None)
+        if sent_ids is not None:
+            sent_ids = sent_ids.to(device)
+
+        s1_repr = self.calc_span_repr(encoded_input, batch_data.span1.to(device), index='0',
+                                      sent_ids=sent_ids)
         if self.num_spans > 1:
-            s2_repr = self.calc_span_repr(encoded_input, batch_data.span2.cuda(), index='1')
+            s2_repr = self.calc_span_repr(encoded_input, batch_data.span2.to(device), index='1',
+                                          sent_ids=sent_ids)
         else:
-            s2_repr = self.calc_span_repr(encoded_input, batch_data.span2.cuda(), index='0')
+            s2_repr = self.calc_span_repr(encoded_input, batch_data.span2.to(device), index='0',
+                                          sent_ids=sent_ids)
 
         pred_label = self.label_net(torch.cat([s1_repr, s2_repr], dim=-1))
         pred_label = torch.squeeze(pred_label, dim=-1)
-        loss = self.training_criterion(pred_label, batch_data.label.cuda().float())
+        loss = self.training_criterion(pred_label, batch_data.label.to(device).float())
         if self.training:
             return loss
         else:
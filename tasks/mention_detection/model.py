@@ -6,7 +6,7 @@ from encoders.pretrained_transformers.span_reprs import get_span_module
 class TaskModel(nn.Module):
     def __init__(self, encoder,
                  span_dim=256, pool_method='avg', just_last_layer=False,
-                 **kwargs):
+                 segment_pooling=False, **kwargs):
         super(TaskModel, self).__init__()
         self.encoder = encoder
         self.just_last_layer = just_last_layer
@@ -14,7 +14,7 @@ class TaskModel(nn.Module):
         self.span_net = nn.ModuleDict()
         self.span_net['0'] = get_span_module(
             method=pool_method, input_dim=self.encoder.hidden_size,
-            use_proj=True, proj_dim=span_dim)
+            use_proj=True, proj_dim=span_dim, segment_pooling=segment_pooling)
         self.pooled_dim = self.span_net['0'].get_output_dim()
 
         self.label_net = nn.Sequential(
@@ -46,19 +46,25 @@ class TaskModel(nn.Module):
     def get_core_params(self):
         return self.encoder.model.parameters()
 
-    def calc_span_repr(self, encoded_input, span_indices, index='0'):
+    def calc_span_repr(self, encoded_input, span_indices, index='0', sent_ids=None):
         span_start, span_end = span_indices[:, 0], span_indices[:, 1]
-        span_repr = self.span_net[index](encoded_input, span_start, span_end)
+        span_repr = self.span_net[index](encoded_input, span_start, span_end, sent_ids=sent_ids)
         return span_repr
 
     def forward(self, batch_data):
         text, text_len = batch_data.text
-        encoded_input = self.encoder(text.cuda(), just_last_layer=self.just_last_layer)
+        device = self.encoder.device
+        encoded_input = self.encoder(text.to(device), just_last_layer=self.just_last_layer)
 
-        s_repr = self.calc_span_repr(encoded_input, batch_data.span.cuda())
+        # Only present in sentence-grouped batches
+        sent_ids = getattr(batch_data, 'sent_ids', None)
+        if sent_ids is not None:
+            sent_ids = sent_ids.to(device)
+
+        s_repr = self.calc_span_repr(encoded_input, batch_data.span.to(device), sent_ids=sent_ids)
         pred_label = self.label_net(s_repr)
         pred_label = torch.squeeze(pred_label, dim=-1)
-        label = batch_data.label.cuda().float()
+        label = batch_data.label.to(device).float()
         loss = self.training_criterion(pred_label, label)
         if self.training:
             return loss
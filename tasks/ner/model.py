@@ -6,14 +6,14 @@ from encoders.pretrained_transformers.span_reprs import get_span_module
 class NERModel(nn.Module):
     def __init__(self, encoder,
                  span_dim=256, pool_method='avg', num_labels=1,
-                 **kwargs):
+                 segment_pooling=False, **kwargs):
         super(NERModel, self).__init__()
         self.encoder = encoder
         self.pool_method = pool_method
         self.span_net = nn.ModuleDict()
         self.span_net['0'] = get_span_module(
             method=pool_method, input_dim=self.encoder.hidden_size,
-            use_proj=True, proj_dim=span_dim)
+            use_proj=True, proj_dim=span_dim, segment_pooling=segment_pooling)
         self.pooled_dim = self.span_net['0'].get_output_dim()
 
         self.label_net = nn.Sequential(
@@ -45,21 +45,33 @@ class NERModel(nn.Module):
     def get_core_params(self):
         return self.encoder.model.parameters()
 
-    def calc_span_repr(self, encoded_input, span_indices, index='0'):
+    def calc_span_repr(self, encoded_input, span_indices, index='0', sent_ids=None):
         span_start, span_end = span_indices[:, 0], span_indices[:, 1]
-        span_repr = self.span_net[index](encoded_input, span_start, span_end)
+        span_repr = self.span_net[index](encoded_input, span_start, span_end, sent_ids=sent_ids)
         return span_repr
 
     def forward(self, batch_data):
         text, text_len = batch_data.text
-        encoded_input = self.encoder(text.cuda())
+        device = self.encoder.device
+        text = text.to(device)
+        packing = self.encoder.pack(text)
+        encoded_input = self.encoder(text, packing=packing)
 
-        s_repr = self.calc_span_repr(encoded_input, batch_data.span.cuda())
+        # Only present in sentence-grouped batches
+        sent_ids = getattr(batch_data, 'sent_ids', None)
+        if sent_ids is not None:
+            sent_ids = sent_ids.to(device)
+
+        span = batch_data.span.to(device)
+        if packing is not None:
+            # Move the spans to the packed rows
+            span, sent_ids = packing.remap(span, sent_ids)
+        s_repr = self.calc_span_repr(encoded_input, span, sent_ids=sent_ids)
         pred_label = self.label_net(s_repr)
 
         label = torch.zeros_like(pred_label)
-        label.scatter_(1, batch_data.label.cuda().unsqueeze(dim=1), 1)
-        label = label.cuda().float()
+        label.scatter_(1, batch_data.label.to(device).unsqueeze(dim=1), 1)
+        label = label.float()
         loss = self.training_criterion(pred_label, label)
         if self.training:
             return loss